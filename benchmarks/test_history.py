@@ -0,0 +1,139 @@
+"""
+The history-benchmark scenarios, run with pytest-benchmark.
+
+  python -m pytest benchmarks
+
+The message history is generated the same way as with history-benchmark
+generate, with the shape given by the HISTORY_BENCHMARK_MESSAGES and
+HISTORY_BENCHMARK_CONVERSATIONS environment variables, or a copy of the one
+generated in the HISTORY_BENCHMARK_FIXTURE directory is used. The tests are
+skipped when pytest-benchmark or the dependencies of Blink are missing.
+"""
+
+import importlib.machinery
+import importlib.util
+import json
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+pytest.importorskip('PyQt5')
+pytest.importorskip('sipsimple')
+pytest.importorskip('sqlobject')
+
+
+def load_script(name):
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), name)
+    loader = importlib.machinery.SourceFileLoader(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    return module
+
+
+history_benchmark = load_script('history-benchmark')
+
+
+@pytest.fixture(scope='session')
+def application():
+    from PyQt5.QtWidgets import QApplication
+    # the history requeues some of its work through the GUI thread, which needs the application to live until the end
+    application = QApplication.instance() or QApplication(['history-benchmark'])
+    application.setApplicationName('history-benchmark')
+    return application
+
+
+@pytest.fixture(scope='session')
+def history(application, tmp_path_factory):
+    # MessageHistory is a singleton, so all the benchmarks of the session run on the same history
+    directory = str(tmp_path_factory.mktemp('history'))
+    fixture = os.environ.get('HISTORY_BENCHMARK_FIXTURE')
+    if fixture:
+        with open(os.path.join(fixture, 'shape.json')) as f:
+            shape = history_benchmark.FixtureShape(**json.load(f))
+        shutil.copy(os.path.join(fixture, 'message_history.db'), directory)
+        return history_benchmark.start_history(directory, shape.account_ids)
+    shape = history_benchmark.FixtureShape(accounts=2, conversations=int(os.environ.get('HISTORY_BENCHMARK_CONVERSATIONS', 100)),
+                                           messages=int(os.environ.get('HISTORY_BENCHMARK_MESSAGES', 20000)),
+                                           days=365, pgp=0.1, images=0.02, failed=0.01, pending=0.01, unread=0.02, seed=0)
+    history_benchmark.generate(directory, shape)
+    from blink.history import MessageHistory
+    return MessageHistory()
+
+
+@pytest.fixture(scope='session')
+def conversations(history):
+    return history_benchmark.Benchmark(history, repeat=1).conversations
+
+
+def query(history, query, parameters=()):
+    connection = history.db.getConnection()
+    try:
+        return connection.execute(query, parameters).fetchall()
+    finally:
+        history.db.releaseConnection(connection)
+
+
+def run_in_db(benchmark, function, *args, rounds=5, **kw):
+    # the functions run in the db thread, the way they do in Blink
+    benchmark.pedantic(history_benchmark.run_in_db, args=(function,) + args, kwargs=kw, rounds=rounds, iterations=1)
+
+
+def test_load(benchmark, history, conversations):
+    account_id, remote_uri, size = conversations[0]
+    run_in_db(benchmark, history.load, remote_uri, history_benchmark.BenchmarkSession(), entries=100)
+
+
+def test_load_older_page(benchmark, history, conversations):
+    account_id, remote_uri, size = conversations[0]
+    timestamp, id = query(history, 'select timestamp, id from messages where remote_uri = ? order by timestamp desc, id desc limit 1 offset ?', (remote_uri, size // 2))[0]
+    run_in_db(benchmark, history.load, remote_uri, history_benchmark.BenchmarkSession(), entries=100, before=(timestamp, id))
+
+
+@pytest.mark.parametrize('unread', [False, True], ids=['all', 'unread'])
+def test_get_last_contacts(benchmark, history, unread):
+    run_in_db(benchmark, history.get_last_contacts, 25, unread=unread)
+
+
+def test_get_unread_messages(benchmark, history):
+    run_in_db(benchmark, history.get_unread_messages)
+
+
+def test_retry_failed_messages(benchmark, history):
+    # the host address is not checked, so the failed messages are loaded offline as well
+    run_in_db(benchmark, history._select_messages, "state = 'failed-local'")
+
+
+def test_update(benchmark, history):
+    rounds = 5
+    message_ids = [message_id for message_id, in query(history, "select message_id from messages where direction = 'incoming' and state != 'displayed' limit ?", (500 * rounds,))]
+    pages = iter([message_ids[index * 500:(index + 1) * 500] for index in range(rounds)])
+
+    def update():
+        for message_id in next(pages):
+            history.update(message_id, 'displayed')
+        history.writer.flush()
+
+    run_in_db(benchmark, update, rounds=rounds)
+
+
+def test_remove_contact_messages(benchmark, history, conversations):
+    # each round removes a different conversation of about the median size, until the conversation is loaded again
+    from sipsimple.account import AccountManager
+
+    session = history_benchmark.BenchmarkSession()
+    targets = conversations[len(conversations) // 2:][:5]
+    remaining = iter(targets)
+
+    def remove():
+        account_id, remote_uri, size = next(remaining)
+        waiter = history_benchmark.NotificationWaiter('BlinkMessageHistoryLoadDidSucceed', session)
+        history.remove_contact_messages(AccountManager().get_account(account_id), remote_uri, session=session)
+        history_benchmark.wait(waiter.event)
+
+    benchmark.pedantic(remove, rounds=len(targets), iterations=1)
+
+
+def test_addressbook(benchmark, application):
+    benchmark.pedantic(history_benchmark.addressbook, args=(5000, 2, 100000, 0.5, 0), rounds=3, iterations=1)
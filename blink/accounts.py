@@ -2,12 +2,12 @@
 import json
 import os
 import re
+import requests
 import sys
 try:
     from PyQt5 import sip
 except ImportError:
     import sip
-import urllib.request, urllib.parse, urllib.error
 
 from PyQt5 import uic
 from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QSortFilterProxyModel, QUrl, QUrlQuery
@@ -33,6 +33,7 @@ from sipsimple.util import user_info
 
 from blink.configuration.settings import BlinkSettings
 from blink.contacts import URIUtils
+from blink.httpclient import HTTPClient
 from blink.resources import ApplicationData, IconManager, Resources
 from blink.sessions import SessionManager, StreamDescription
 from blink.widgets.labels import Status
@@ -519,9 +520,9 @@ class AddAccountDialog(base_class, ui_class, metaclass=QSingleton):
                                tzinfo=timezone)
         try:
             settings = SIPSimpleSettings()
-            data = urllib.parse.urlencode(dict(enrollment_data))
-            response = urllib.request.urlopen(settings.server.enrollment_url, data.encode())
-            response_data = json.loads(response.read().decode('utf-8').replace(r'\/', '/'))
+            response = HTTPClient().post(settings.server.enrollment_url, data=enrollment_data)
+            response.raise_for_status()
+            response_data = json.loads(response.content.decode('utf-8').replace(r'\/', '/'))
             response_data = defaultdict(lambda: None, response_data)
             if response_data['success']:
                 try:
@@ -554,8 +555,8 @@ class AddAccountDialog(base_class, ui_class, metaclass=QSingleton):
                 call_in_gui_thread(setattr, self.create_status_label, 'value', Status(response_data['error_message'], color=red))
         except (json.decoder.JSONDecodeError, KeyError):
             call_in_gui_thread(setattr, self.create_status_label, 'value', Status(translate('add_account_dialog', 'Illegal server response'), color=red))
-        except urllib.error.URLError as e:
-            call_in_gui_thread(setattr, self.create_status_label, 'value', Status(translate('add_account_dialog', 'Failed to contact server: %s') % e.reason, color=red))
+        except requests.RequestException as e:
+            call_in_gui_thread(setattr, self.create_status_label, 'value', Status(translate('add_account_dialog', 'Failed to contact server: %s') % e, color=red))
         finally:
             call_in_gui_thread(self.setEnabled, True)
 
@@ -7,6 +7,7 @@ import re
 import uuid
 import sys
 import json
+import time
 import platform
 
 from PyQt5 import uic
@@ -771,13 +772,19 @@ class FileDescriptor(object):
 
 class ChatJSInterface(QObject):
     contextMenuEvent = pyqtSignal(str)
+    operationsApplied = pyqtSignal(int, float)  # number of operations, duration in seconds
     js_file = open(Resources.get('chat/js_helper_functions.js')).read()
 
     def __init__(self, page, parent=None):
         super(ChatJSInterface, self).__init__(parent)
         self.page = page
         self.loaded = False
+        self.detached = {}  # the HTML of the messages the page detached from the chat view, by placeholder id
         self._js_operations_queue = deque()
+        self._js_timer = QTimer(self)
+        self._js_timer.setSingleShot(True)
+        self._js_timer.setInterval(0)
+        self._js_timer.timeout.connect(self._run_js)
         self.page.mainFrame().addToJavaScriptWindowObject('chat', self)
         self.page.mainFrame().javaScriptWindowObjectCleared.connect(self.attach_object)
 
@@ -791,6 +798,7 @@ class ChatJSInterface(QObject):
         return script
 
     def attach_object(self):
+        self.detached.clear()
         self.page.mainFrame().addToJavaScriptWindowObject('chat', self)
 
     @pyqtSlot(bool)
@@ -799,73 +807,89 @@ class ChatJSInterface(QObject):
             self.loaded = True
             self._run_js()
 
-    def _js_operation(self, operation):
-        self._js_operations_queue.append(operation)
+    @pyqtSlot(str, str)
+    def _JH_StoreDetached(self, id, html):
+        self.detached[id] = html
+
+    @pyqtSlot(str, result=str)
+    def _JH_RestoreDetached(self, id):
+        return self.detached.pop(id, '')
+
+    @pyqtSlot()
+    def _JH_ClearDetached(self):
+        self.detached.clear()
+
+    def _js_operation(self, function, *args, callback=None):
+        # The operations queued during one pass of the event loop are applied together, in order, by a single script
+        self._js_operations_queue.append((function, args, callback))
+        if self.loaded and not self._js_timer.isActive():
+            self._js_timer.start()
+
+    def flush(self):
         self._run_js()
 
     def _run_js(self):
-        if not self.loaded:
+        self._js_timer.stop()
+        if not self.loaded or not self._js_operations_queue:
             return
-        while self._js_operations_queue:
-            operation = self._js_operations_queue.popleft()
-            if isinstance(operation, tuple):
-                pass
-            else:
-                self.page.mainFrame().evaluateJavaScript(operation)
+        operations = list(self._js_operations_queue)
+        self._js_operations_queue.clear()
+        start = time.perf_counter()
+        results = self.page.mainFrame().evaluateJavaScript(f'applyOperations({json.dumps([[function, *args] for function, args, callback in operations])})')
+        duration = time.perf_counter() - start
+        log.debug(f'Applied {len(operations)} chat view operations in {duration * 1000:.1f}ms')
+        self.operationsApplied.emit(len(operations), duration)
+        for (function, args, callback), result in zip(operations, results or [None] * len(operations)):
+            if callback is not None:
+                callback(result)
 
     def append_element(self, query, content):
-        content = json.dumps(content)
-        self._js_operation(f"appendElement('{query}', {content})")
+        self._js_operation('appendElement', query, content)
 
     def update_element(self, query, content):
-        content = json.dumps(content)
-        self._js_operation(f"updateElement('{query}', {content})")
+        self._js_operation('updateElement', query, content)
 
     def replace_element(self, query, content):
-        content = json.dumps(content)
-        self._js_operation(f"replaceElement('{query}', {content})")
+        self._js_operation('replaceElement', query, content)
 
     def remove_element(self, query):
-        self._js_operation(f"removeElement('{query}')")
+        self._js_operation('removeElement', query)
 
     def empty_element(self, query):
-        self._js_operation(f"emptyElement('{query}')")
+        self._js_operation('emptyElement', query)
 
     def previous_sibling(self, query, content):
-        content = json.dumps(content)
-        self._js_operation(f"previousSibling('{query}', {content})")
+        self._js_operation('previousSibling', query, content)
 
     def insert_as_parent(self, query, content, new_consecutive):
-        content = json.dumps(content)
-        new_consecutive = json.dumps(new_consecutive)
-        self._js_operation(f"insertAsParent('{query}', {content}, {new_consecutive})")
+        self._js_operation('insertAsParent', query, content, new_consecutive)
 
     def prepend_outside_element(self, query, content):
-        content = json.dumps(content)
-        self._js_operation(f"prependOutside('{query}', {content})")
+        self._js_operation('prependOutside', query, content)
 
     def append_outside_element(self, query, content):
-        content = json.dumps(content)
-        self._js_operation(f"appendOutside('{query}', {content})")
+        self._js_operation('appendOutside', query, content)
 
     def set_style_property_element(self, query, property, value):
-        self._js_operation(f"styleElement('{query}', '{property}', '{value}')")
+        self._js_operation('styleElement', query, property, value)
 
     def get_height_element(self, query, callback):
-        self._js_operation((f"getHeightElement('{query}')", callback))
+        self._js_operation('getHeightElement', query, callback=callback)
+
+    def insert_html(self, id, position, content):
+        self._js_operation('insertHtml', id, position, content)
 
     def scroll_to_bottom(self):
-        self._js_operation('scrollToBottom()')
+        self._js_operation('scrollToBottom')
 
     def append_message_to_chat(self, content, id=None):
-        content = json.dumps(content)
-        self._js_operation(f"appendMessageToChat({content})")
+        self._js_operation('appendMessageToChat', content)
         if id:
             self.add_context_menu(id)
 
     def add_context_menu(self, id):
         if id is not None:
-            self._js_operation(f"addContextMenuToElement('#message-{id}')")
+            self._js_operation('addContextMenuToElement', f'#message-{id}')
 
     @pyqtSlot(str)
     def handleContextMenuEvent(self, id):
@@ -996,6 +1020,7 @@ class ChatWidget(base_class, ui_class):
     loading_template = open(Resources.get('chat/loading.html')).read()
 
     image_data_re = re.compile(r"data:(?P<type>image/.+?);base64,(?P<data>.*)", re.I|re.U)
+    insert_re = re.compile(r'<(div|span) id="insert"></\1>')
 
     def __init__(self, session, parent=None):
         super(ChatWidget, self).__init__(parent)
@@ -1017,7 +1042,12 @@ class ChatWidget(base_class, ui_class):
         self.last_message = None
         self.session = session
         self.history_loaded = False
+        self.history_cursor = None
+        self.history_has_more = False
+        self.history_page_pending = False
+        self.history_page_height = None
         self.timestamp_rendered_messages = []
+        self.rendered_messages = {}
         self.pending_decryption = []
         self.remove_requests = RequestList()
         self.size = QSizeF()
@@ -1033,6 +1063,7 @@ class ChatWidget(base_class, ui_class):
         self.chat_view.sizeChanged.connect(self._SH_ChatViewSizeChanged)
 
         self.chat_view.page().mainFrame().contentsSizeChanged.connect(self._SH_ChatViewFrameContentsSizeChanged)
+        self.chat_view.page().scrollRequested.connect(self._SH_ChatViewScrollRequested)
         self.chat_view.page().linkClicked.connect(self._SH_LinkClicked)
         self.chat_js.contextMenuEvent.connect(self._SH_ContextMenuEvent)
 
@@ -1052,52 +1083,55 @@ class ChatWidget(base_class, ui_class):
             if self.last_message is not None and not self.last_message.history and message.history:
                 message.history = False
 
-            for i, (timestamp, id, rendered_message) in enumerate(self.timestamp_rendered_messages):
-                if id == message.id:
-                    return
+            if message.id in self.rendered_messages:
+                return
 
+            # timestamp_rendered_messages is kept sorted by (timestamp, id), in the same order as the messages in the chat view
+            i = bisect.bisect_left(self.timestamp_rendered_messages, (message.timestamp, message.id))
+            if i < len(self.timestamp_rendered_messages):
+                (timestamp, id, rendered_message) = self.timestamp_rendered_messages[i]
                 (prev_timestamp, prev_id, previous_rendered_message) = self.timestamp_rendered_messages[i-1]
-                if timestamp >= message.timestamp:
-                    if message.is_related_to(previous_rendered_message):
-                        print(f'consecutive {message_id} to previous {previous_rendered_message.id} {timestamp} > {message.timestamp}')
+                if message.is_related_to(previous_rendered_message):
+                    log.debug(f'Message {message_id} is consecutive to {previous_rendered_message.id} ({prev_timestamp} <= {message.timestamp})')
+                    message.consecutive = True
+                    html_message = message.to_html(self.style, user_icons=self.user_icons_css_class).replace("<div id=\"insert\"></div>", '').replace("<span id=\"insert\"></span>", '')
+                    if previous_rendered_message.consecutive:
+                        self.chat_js.append_outside_element(f'message-{previous_rendered_message.id}', html_message)
+                    else:
+                        if message.is_related_to(rendered_message):
+                            self.chat_js.prepend_outside_element(f'message-{id}', html_message)
+                        else:
+                            self.chat_js.append_element(f'#message-{prev_id}', html_message)
+                    self.chat_js.add_context_menu(message.id)
+                elif message.is_related_to(rendered_message):
+                    if rendered_message.consecutive:
                         message.consecutive = True
                         html_message = message.to_html(self.style, user_icons=self.user_icons_css_class).replace("<div id=\"insert\"></div>", '').replace("<span id=\"insert\"></span>", '')
-                        if previous_rendered_message.consecutive:
-                            self.chat_js.append_outside_element(f'message-{previous_rendered_message.id}', html_message)
-                        else:
-                            if message.is_related_to(rendered_message):
-                                self.chat_js.prepend_outside_element(f'message-{id}', html_message)
-                            else:
-                                self.chat_js.append_element(f'#message-{prev_id}', html_message)
+                        self.chat_js.previous_sibling(f'message-{id}', html_message)
                         self.chat_js.add_context_menu(message.id)
-                    elif message.is_related_to(rendered_message):
-                        if rendered_message.consecutive:
-                            message.consecutive = True
-                            html_message = message.to_html(self.style, user_icons=self.user_icons_css_class).replace("<div id=\"insert\"></div>", '').replace("<span id=\"insert\"></span>", '')
-                            self.chat_js.previous_sibling(f'message-{id}', html_message)
-                            self.chat_js.add_context_menu(message.id)
-                        else:
-                            html_message = message.to_html(self.style, user_icons=self.user_icons_css_class)
-                            rendered_message.consecutive = True
-                            html_rendered_message = rendered_message.to_html(self.style, user_icons=self.user_icons_css_class).replace("<div id=\"insert\"></div>", '').replace("<span id=\"insert\"></span>", '')
-                            self.timestamp_rendered_messages[i] = (rendered_message.timestamp, rendered_message.id, rendered_message)
-                            self.chat_js.insert_as_parent(f'message-{id}', html_message, html_rendered_message)
-                            self.chat_js.add_context_menu(message.id)
                     else:
-                        html_message = message.to_html(self.style, user_icons=self.user_icons_css_class).replace("<div id=\"insert\"></div>", '').replace("<span id=\"insert\"></span>", '')
-                        self.chat_js.prepend_outside_element(f'message-{id}', html_message)
+                        html_message = message.to_html(self.style, user_icons=self.user_icons_css_class)
+                        rendered_message.consecutive = True
+                        html_rendered_message = rendered_message.to_html(self.style, user_icons=self.user_icons_css_class).replace("<div id=\"insert\"></div>", '').replace("<span id=\"insert\"></span>", '')
+                        self.timestamp_rendered_messages[i] = (rendered_message.timestamp, rendered_message.id, rendered_message)
+                        self.chat_js.insert_as_parent(f'message-{id}', html_message, html_rendered_message)
                         self.chat_js.add_context_menu(message.id)
-                    self.timestamp_rendered_messages.insert(i, (message.timestamp, message.id, message))
+                else:
+                    html_message = message.to_html(self.style, user_icons=self.user_icons_css_class).replace("<div id=\"insert\"></div>", '').replace("<span id=\"insert\"></span>", '')
+                    self.chat_js.prepend_outside_element(f'message-{id}', html_message)
+                    self.chat_js.add_context_menu(message.id)
+                self.timestamp_rendered_messages.insert(i, (message.timestamp, message.id, message))
+                self.rendered_messages[message.id] = message
 
-                    try:
-                        if self.last_message.timestamp < message.timestamp:
-                            self.last_message = message
-                    except (TypeError, AttributeError):
-                        self.last_message.timestamp = self.last_message.timestamp.replace(tzinfo=tzlocal())
-                        if self.last_message.timestamp < message.timestamp:
-                            self.last_message = message
+                try:
+                    if self.last_message.timestamp < message.timestamp:
+                        self.last_message = message
+                except (TypeError, AttributeError):
+                    self.last_message.timestamp = self.last_message.timestamp.replace(tzinfo=tzlocal())
+                    if self.last_message.timestamp < message.timestamp:
+                        self.last_message = message
 
-                    return
+                return
 
         if message.is_related_to(self.last_message):
             message.consecutive = True
@@ -1110,8 +1144,71 @@ class ChatWidget(base_class, ui_class):
 
         if hasattr(message, 'id'):
             self.timestamp_rendered_messages.append((message.timestamp, message.id, message))
+            self.rendered_messages[message.id] = message
         self.last_message = message
 
+    def add_messages(self, messages):
+        # A page of messages in chronological order that all go before or all go after the ones already shown is rendered into a single
+        # HTML fragment, with the consecutive messages grouped the same way add_message groups them, and inserted with one operation
+        messages = list({message.id: message for message in messages if message.id not in self.rendered_messages}.values())
+        keys = [(message.timestamp, message.id) for message in messages]
+        if len(messages) < 2 or any(key >= next_key for key, next_key in zip(keys, keys[1:])):
+            for message in messages:
+                self.add_message(message)
+        elif not self.timestamp_rendered_messages or self.timestamp_rendered_messages[-1][:2] < keys[0]:
+            self._add_message_group(messages, append=True)
+        elif keys[-1] < self.timestamp_rendered_messages[0][:2]:
+            # the last one is added separately, add_message decides how it joins the first message already shown
+            self._add_message_group(messages[:-1], append=False)
+            self.add_message(messages[-1])
+        else:
+            for message in messages:
+                self.add_message(message)
+
+    def _add_message_group(self, messages, append):
+        groups = []
+        continuation = False
+        last_message = self.last_message if append else None
+        for message in messages:
+            if self.last_message is not None and not self.last_message.history and message.history:
+                message.history = False
+            if message.is_related_to(last_message):
+                message.consecutive = True
+                html_message = message.to_html(self.style, user_icons=self.user_icons_css_class)
+                if groups and append:
+                    groups[-1] = self.insert_re.sub(lambda match: html_message, groups[-1], count=1)
+                elif groups:
+                    # add_message puts the consecutive messages inserted above the ones already shown next to each other instead of nesting them
+                    html_message = self.insert_re.sub('', html_message, count=1)
+                    groups[-1] = self.insert_re.sub(lambda match: html_message + match.group(0), groups[-1], count=1)
+                else:
+                    continuation = True
+                    groups.append(html_message)
+            else:
+                html_message = message.to_html(self.style, user_icons=self.user_icons_css_class)
+                if groups:
+                    groups[-1] = self.insert_re.sub('', groups[-1], count=1)
+                groups.append(html_message)
+            last_message = message
+            if append:
+                self.last_message = message
+
+        entries = [(message.timestamp, message.id, message) for message in messages]
+        if append:
+            if continuation:
+                self.chat_js.replace_element('#insert', groups.pop(0))
+            if groups:
+                self.chat_js.remove_element('#insert')
+                self.chat_js.insert_html('chat', 'beforeend', ''.join(groups))
+            self.timestamp_rendered_messages.extend(entries)
+        else:
+            groups[-1] = self.insert_re.sub('', groups[-1], count=1)
+            self.chat_js.insert_html(f'message-{self.timestamp_rendered_messages[0][1]}', 'beforebegin', ''.join(groups))
+            self.timestamp_rendered_messages[0:0] = entries
+        for message in messages:
+            self.rendered_messages[message.id] = message
+            self.chat_js.add_context_menu(message.id)
+
     def replace_message(self, id, message):
         html = message.to_html(self.style, user_icons=self.user_icons_css_class).replace("<div id=\"insert\"></div>", '')
         self.chat_js.replace_element(f'#message-{id}', html)
@@ -1119,10 +1216,10 @@ class ChatWidget(base_class, ui_class):
 
     def update_message_text(self, id, text):
         self.chat_js.update_element(f'#text-{id}', text)
-        for i, (timestamp, rendered_id, rendered_message) in enumerate(self.timestamp_rendered_messages):
-            if rendered_id == id:
-                rendered_message.message = text
-                self.timestamp_rendered_messages[i] = (rendered_message.timestamp, rendered_message.id, rendered_message)
+        try:
+            self.rendered_messages[id].message = text
+        except KeyError:
+            pass
 
     def update_message_status(self, id, status):
         if status == 'pending':
@@ -1210,12 +1307,31 @@ class ChatWidget(base_class, ui_class):
             self._scroll_to_bottom()
 
     def _align_chat(self, scroll=False):
+        self.chat_js.flush()
         content_height = self.chat_element.geometry().height()
         self._process_height(content_height, scroll=scroll)
 
     def _scroll_to_bottom(self):
         self.chat_js.scroll_to_bottom()
 
+    def load_older_history(self):
+        if self.session is None or not self.history_loaded or not self.history_has_more or self.history_page_pending:
+            return
+        self.history_page_pending = True
+        blink_session = self.session.blink_session
+        HistoryManager().load(blink_session.contact.uri.uri, blink_session, before=self.history_cursor)
+
+    def begin_history_page(self):
+        # Queued before the operations that add an older page, the height of the messages shown before it is used to keep them in place
+        self.chat_js.get_height_element('#chat', callback=self._SH_HistoryPageBegan)
+
+    def end_history_page(self):
+        # Queued after the operations that add an older page, which ends once they were applied
+        self.chat_js.get_height_element('#chat', callback=self._SH_HistoryPageApplied)
+
+    def fill_view_with_history(self):
+        # The view can only be scrolled to the top to load the older messages once they fill it
+        self.chat_js.get_height_element('#chat', callback=self._SH_HistoryHeightMeasured)
 
     def dragEnterEvent(self, event):
         mime_data = event.mimeData()
@@ -1328,7 +1444,7 @@ class ChatWidget(base_class, ui_class):
     def _SH_MessageDelete(self, id):
         blink_session = self.session.blink_session
 
-        messages = [message for (timestamp, msg_id, message) in self.timestamp_rendered_messages if msg_id == id]
+        messages = [self.rendered_messages[id]]
         if messages[0].direction == 'outgoing':
             account_manager = AccountManager()
             account = account_manager.get_account(messages[0].sender.uri)
@@ -1352,9 +1468,30 @@ class ChatWidget(base_class, ui_class):
 
     def _SH_ChatViewFrameContentsSizeChanged(self, size):
         # print("frame contents size changed to %r (current=%r)" % (self.size, self.chat_view.page().contentsSize()))
-        self._align_chat(scroll=size.height() > self.size.height())
+        # while an older page is added above the visible messages the view is kept in place by _SH_HistoryPageApplied
+        self._align_chat(scroll=size.height() > self.size.height() and not self.history_page_pending)
         self.size = size
 
+    def _SH_HistoryPageBegan(self, height):
+        self.history_page_height = height
+
+    def _SH_HistoryPageApplied(self, height):
+        frame = self.chat_view.page().mainFrame()
+        if height is not None and self.history_page_height is not None:
+            frame.setScrollPosition(frame.scrollPosition() + QPoint(0, int(height - self.history_page_height)))
+        self.size = frame.contentsSize()
+        self.history_page_height = None
+        self.history_page_pending = False
+        self._SH_HistoryHeightMeasured(height)
+
+    def _SH_HistoryHeightMeasured(self, height):
+        if height is not None and height < self.chat_view.size().height():
+            self.load_older_history()
+
+    def _SH_ChatViewScrollRequested(self, dx, dy, rect):
+        if self.chat_view.page().mainFrame().scrollPosition().y() == 0:
+            self.load_older_history()
+
     def _SH_ChatInputTextChanged(self):
         if self.session.blink_session.chat_type is None:
             manager = MessageManager()
@@ -1469,7 +1606,7 @@ class ChatWidget(base_class, ui_class):
         item = notification.data.item
         blink_session = self.session.blink_session
 
-        messages = [message for (timestamp, msg_id, message) in self.timestamp_rendered_messages if msg_id == item.id]
+        messages = [self.rendered_messages[item.id]] if item.id in self.rendered_messages else []
         account_manager = AccountManager()
 
         try:
@@ -3224,7 +3361,7 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
             if self.selected_session is session and not self.isMinimized() and self.isActiveWindow():
                 pass
             else:
-                NotificationCenter().post_notification('BlinkMessageNewUnread', sender=uri)
+                NotificationCenter().post_notification('BlinkMessageNewUnread', sender=uri, data=NotificationData(account=received_account, count=1))
 
         if direction != 'outgoing':
             if self.selected_session is session and not self.isMinimized() and self.isActiveWindow():
@@ -3324,10 +3461,13 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
         session = blink_session.items.chat
         message = notification.data.message
 
-        if session is None:
+        if isinstance(message, BlinkMessage):
             return
 
-        if isinstance(message, BlinkMessage):
+        # history messages are detached rows, the decrypted content must be stored explicitly
+        HistoryManager().message_history.update_content(message.message_id, message.content)
+
+        if session is None:
             return
 
         if message in session.chat_widget.pending_decryption:
@@ -3428,9 +3568,13 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
         if session is None:
             return
 
+        older_page = notification.data.before is not None
+        if older_page:
+            session.chat_widget.begin_history_page()
         last_account = None
         last_timestamp = None
         newest_timestamp = None
+        page = []
         for message in messages:
             encrypted = False
             state = message.state
@@ -3467,23 +3611,9 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
                     timestamp = message.timestamp.replace(tzinfo=timezone.utc).astimezone(tzlocal())
                     continue
             elif message.content_type.lower() == 'application/blink-call-history':
-                content_list = eval(message.content)
-
-                media_types = {'audio': translate('chat_window', 'audio'),
-                               'video': translate('chat_window', 'video'),
-                               'file-transfer': translate('chat_window', 'file-transfer')}
-                try:
-                    media_type = media_types[content_list[2]]
-                except KeyError:
-                    media_type = media_types['audio']
-                session_type = translate('chat_window', 'call') if media_type != 'file-transfer' else ''
-
-                if message.state != 'failed':
-                    content = '%s %s %s %s' % (message.direction.capitalize(), media_type, session_type, content_list[0])
-                    content = f'<div style="color: #000000">{content}</div>'
-                else:
-                    content = translate('chat_window', '%s %s %s failed (%s)') % (message.direction.capitalize(), media_type, session_type, content_list[1])
-                    content = f'<div style="color: #800000">{content}</div>'
+                if message.call is None:
+                    continue
+                content = self._call_history_content(message.call)
             else:
                 continue
 
@@ -3510,8 +3640,11 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
             else:
                 chat_message = ChatMessage(content, sender, message.direction, id=message.message_id, timestamp=timestamp, history=True, account=account)
 
-            session.chat_widget.add_message(chat_message)
+            page.append((message, chat_message, account, encrypted))
 
+        session.chat_widget.add_messages([chat_message for message, chat_message, account, encrypted in page])
+
+        for message, chat_message, account, encrypted in page:
             if message.direction == "outgoing":
                 session.chat_widget.update_message_status(id=message.message_id, status=message.state)
             elif message.state != 'displayed':
@@ -3535,6 +3668,13 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
             elif 'OTR' in message.encryption_type:
                 session.chat_widget.update_message_encryption(message.message_id, True)
         session.chat_widget.history_loaded = True
+        if notification.data.more is not None:
+            session.chat_widget.history_cursor = notification.data.cursor
+            session.chat_widget.history_has_more = notification.data.more
+
+        if older_page:
+            session.chat_widget.end_history_page()
+            return
 
         while self.render_after_load:
             (found_session, received_account, message) = self.render_after_load.popleft()
@@ -3561,10 +3701,14 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
                 SessionManager().get_file_from_url(blink_session, file)
         session.chat_widget.show_loading_screen(False)
         session.chat_widget._align_chat(True)
+        session.chat_widget.fill_view_with_history()
 
     def _NH_BlinkMessageHistoryLoadDidFail(self, notification):
         blink_session = notification.sender
         session = blink_session.items.chat
+        if notification.data.before is not None:
+            session.chat_widget.history_page_pending = False
+            return
         # TODO Should we attempt to reload history if it fails? -- Tijmen
         session.chat_widget.history_loaded = True
         session.chat_widget.show_loading_screen(False)
@@ -3576,6 +3720,23 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
             # allow the user to select the 1st session
             message_manager.create_message_session(contact, display_name, selected=False)
 
+    def _call_history_content(self, call):
+        media_types = {'audio': translate('chat_window', 'audio'),
+                       'video': translate('chat_window', 'video'),
+                       'file-transfer': translate('chat_window', 'file-transfer')}
+        try:
+            media_type = media_types[call.media]
+        except KeyError:
+            media_type = media_types['audio']
+        session_type = translate('chat_window', 'call') if media_type != 'file-transfer' else ''
+
+        if not call.failed:
+            content = '%s %s %s%s' % (call.direction.capitalize(), media_type, session_type, call.duration_text)
+            return f'<div style="color: #000000">{content}</div>'
+        else:
+            content = translate('chat_window', '%s %s %s failed (%s)') % (call.direction.capitalize(), media_type, session_type, (call.reason or '').title())
+            return f'<div style="color: #800000">{content}</div>'
+
     def _NH_BlinkMessageHistoryCallHistoryDidStore(self, notification):
         message = notification.data.message
         contact, contact_uri = URIUtils.find_contact(message.remote_uri, display_name=message.display_name)
@@ -3595,25 +3756,8 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
         if account is None or not account.enabled:
             return
 
-        if message.content_type.lower() == 'application/blink-call-history':
-            content_list = eval(message.content)
-
-            media_types = {'audio': translate('chat_window', 'audio'),
-                           'video': translate('chat_window', 'video'),
-                           'file-transfer': translate('chat_window', 'file-transfer')}
-            try:
-                media_type = media_types[content_list[2]]
-            except KeyError:
-                media_type = media_types['audio']
-            session_type = translate('chat_window', 'call') if media_type != 'file-transfer' else ''
-
-            if message.state != 'failed':
-                content = '%s %s %s %s' % (message.direction.capitalize(), media_type, session_type, content_list[0])
-                content = f'<div style="color: #000000">{content}</div>'
-            else:
-                content = translate('chat_window', '%s %s %s failed (%s)') % (message.direction.capitalize(), media_type, session_type, content_list[1])
-                content = f'<div style="color: #800000">{content}</div>'
-
+        if message.content_type.lower() == 'application/blink-call-history' and message.call is not None:
+            content = self._call_history_content(message.call)
             timestamp = message.timestamp.replace(tzinfo=timezone.utc).astimezone(tzlocal())
             chat_message = ChatEvent(content, message.direction, id=message.message_id, timestamp=timestamp)
             blink_session.items.chat.chat_widget.add_message(chat_message)
@@ -3624,7 +3768,10 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
             session.chat_widget.history_loaded = False
             session.chat_widget.show_loading_screen(True)
             session.chat_widget.last_message = None
+            session.chat_widget.history_cursor = None
+            session.chat_widget.history_has_more = False
             session.chat_widget.timestamp_rendered_messages = []
+            session.chat_widget.rendered_messages = {}
 
             session.chat_widget.chat_js.empty_element('#chat')
 
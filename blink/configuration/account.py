@@ -68,6 +68,10 @@ class SMSSettings(SettingsGroup):
     enable_pgp = Setting(type=bool, default=True)
     public_key = Setting(type=ApplicationDataPath, default=None, nillable=True)
     private_key = Setting(type=ApplicationDataPath, default=None, nillable=True)
+    history_retention_days = Setting(type=NonNegativeInteger, default=0)
+    history_retention_messages = Setting(type=NonNegativeInteger, default=0)
+    history_tombstone_days = Setting(type=NonNegativeInteger, default=30)
+    history_archive = Setting(type=bool, default=False)
 
 
 class SMSSettingsExtension(SMSSettings):
@@ -5,6 +5,7 @@ __all__ = ['ContactExtension', 'GroupExtension']
 
 from sipsimple.addressbook import ContactExtension, GroupExtension, PresenceSettings, SharedSetting
 from sipsimple.configuration import Setting, RuntimeSetting
+from sipsimple.configuration.datatypes import NonNegativeInteger
 
 from blink.configuration.datatypes import IconDescriptor
 
@@ -23,6 +24,8 @@ class ContactExtension(ContactExtension):
     alternate_icon = Setting(type=IconDescriptor, nillable=True, default=None)
     preferred_media = SharedSetting(type=str, default='audio')
     auto_answer = Setting(type=bool, default=False)
+    history_retention_days = Setting(type=NonNegativeInteger, default=None, nillable=True)
+    history_retention_messages = Setting(type=NonNegativeInteger, default=None, nillable=True)
 
 
 class GroupExtension(GroupExtension):
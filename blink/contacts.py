@@ -3,6 +3,7 @@ import pickle as pickle
 import locale
 import os
 import re
+import requests
 import socket
 import sys
 
@@ -27,7 +28,7 @@ from functools import partial
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from heapq import heappush
-from httplib2 import Http, HttpLib2Error
+from httplib2 import HttpLib2Error
 from itertools import count
 from oauth2client.client import OAuth2WebServerFlow, AccessTokenRefreshError
 from oauth2client.file import Storage
@@ -46,6 +47,7 @@ from sipsimple.threading import run_in_thread
 
 from blink.configuration.datatypes import IconDescriptor, FileURL
 from blink.configuration.settings import BlinkSettings
+from blink.httpclient import HTTPClient
 from blink.resources import ApplicationData, Resources, IconManager
 from blink.sessions import SessionManager, StreamDescription
 from blink.messages import MessageManager
@@ -680,48 +682,52 @@ class GoogleContactIconRetriever(object):
     def run(self):
         owner = self.contact.name or self.contact.organization or self.contact.id
         icon = self.contact.icon
-        http = self.credentials.authorize(Http(timeout=5))
         try:
             if icon.url is not None:
-                response, content = http.request(icon.url + '?size={}'.format(IconManager.max_size))
+                response = self._get(icon.url + '?size={}'.format(IconManager.max_size))
             else:
-                response = content = None
-        except (HttpLib2Error, socket.error) as e:
+                response = None
+        except (HttpLib2Error, AccessTokenRefreshError, requests.RequestException, socket.error) as e:
             log.warning('could not retrieve icon for {owner}: {exception!s}'.format(owner=owner, exception=e))
         else:
             if response is None:
                 icon_manager = IconManager()
                 icon_manager.store_data(self.contact.id, None)
                 icon.downloaded_url = None
-            elif response['status'] == '200' and response['content-type'].startswith('image/'):
+            elif response.status_code == 200 and response.headers.get('content-type', '').startswith('image/'):
                 icon_manager = IconManager()
                 try:
-                    icon_manager.store_data(self.contact.id, content)
+                    icon_manager.store_data(self.contact.id, response.content)
                 except Exception as e:
                     log.error('could not store icon for {owner}: {exception!s}'.format(owner=owner, exception=e))
                 else:
                     icon.downloaded_url = icon.url
-            elif response['status'] in ('403', '404') and icon.alternate_url:  # private or unavailable photo. use old GData protocol if alternate_url is available.
+            elif response.status_code in (403, 404) and icon.alternate_url:  # private or unavailable photo. use old GData protocol if alternate_url is available.
                 try:
-                    response, content = http.request(icon.alternate_url, headers={'GData-Version': '3.0'})
-                except (HttpLib2Error, socket.error) as e:
+                    response = self._get(icon.alternate_url, headers={'GData-Version': '3.0'})
+                except (HttpLib2Error, AccessTokenRefreshError, requests.RequestException, socket.error) as e:
                     log.warning('could not retrieve icon for {owner}: {exception!s}'.format(owner=owner, exception=e))
                 else:
-                    if response['status'] == '200' and response['content-type'].startswith('image/'):
+                    if response.status_code == 200 and response.headers.get('content-type', '').startswith('image/'):
                         icon_manager = IconManager()
                         try:
-                            icon_manager.store_data(self.contact.id, content)
+                            icon_manager.store_data(self.contact.id, response.content)
                         except Exception as e:
                             log.error('could not store icon for {owner}: {exception!s}'.format(owner=owner, exception=e))
                         else:
                             icon.downloaded_url = icon.url
                     else:
-                        log.error('could not retrieve icon for {} (status={}, content-type={!r})'.format(owner, response['status'], response['content-type']))
+                        log.error('could not retrieve icon for {} (status={}, content-type={!r})'.format(owner, response.status_code, response.headers.get('content-type')))
             else:
-                log.error('could not retrieve icon for {} (status={}, content-type={!r})'.format(owner, response['status'], response['content-type']))
+                log.error('could not retrieve icon for {} (status={}, content-type={!r})'.format(owner, response.status_code, response.headers.get('content-type')))
         finally:
             self._event.set()
 
+    def _get(self, url, headers=None):
+        # the access token is refreshed here when it expired, the icon itself is fetched over the shared connections
+        headers = dict(headers or {}, Authorization='Bearer {}'.format(self.credentials.get_access_token().access_token))
+        return HTTPClient().get(url, headers=headers, timeout=5)
+
 
 class GoogleContactURI(object):
     id = property(lambda self: self.uri)
@@ -2529,6 +2535,7 @@ class ContactModel(QAbstractListModel):
         notification_center.add_observer(self, name='VirtualGroupDidAddContact')
         notification_center.add_observer(self, name='VirtualGroupDidRemoveContact')
         notification_center.add_observer(self, name='BlinkContactDidChange')
+        notification_center.add_observer(self, name='BlinkUnreadMessagesChanged')
 
     @property
     def bonjour_group(self):
@@ -2802,6 +2809,13 @@ class ContactModel(QAbstractListModel):
         index = self.index(self.items.index(contact))
         self.dataChanged.emit(index, index)
 
+    def _NH_BlinkUnreadMessagesChanged(self, notification):
+        remote_uris = notification.data.remote_uris
+        for position, item in enumerate(self.items):
+            if isinstance(item, Contact) and item.uri is not None and item.uri.uri in remote_uris:
+                index = self.index(position)
+                self.dataChanged.emit(index, index)
+
     def _NH_SIPAccountManagerDidStart(self, notification):
         if notification.sender.default_account is BonjourAccount():
             groups = self.items[GroupList]
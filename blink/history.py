@@ -1,9 +1,15 @@
 
+import ast
 import bisect
+import gzip
+import hashlib
+import json
 import pickle as pickle
 import os
 import re
+import sqlite3
 import uuid
+import zlib
 from PyQt5.QtCore import QTimer
 from PyQt5.QtGui import QIcon
 
@@ -12,7 +18,12 @@ from application.python import Null
 from application.python.types import Singleton
 from application.system import host, makedirs, unlink
 
-from datetime import date, timezone
+from collections import OrderedDict, deque
+from datetime import date, datetime, timedelta, timezone
+from functools import partial
+from itertools import islice
+from threading import Lock
+from time import monotonic
 from dateutil.parser import parse
 from dateutil.tz import tzlocal
 from zope.interface import implementer
@@ -30,10 +41,10 @@ from blink.messages import BlinkMessage
 from blink.resources import ApplicationData, Resources
 from blink.sessions import BlinkSession
 
-from blink.util import run_in_gui_thread, translate
+from blink.util import call_in_gui_thread, call_later, run_in_gui_thread, translate
 import traceback
 
-from sqlobject import SQLObject, StringCol, DateTimeCol, IntCol, UnicodeCol, DatabaseIndex, AND
+from sqlobject import SQLObject, StringCol, DateTimeCol, IntCol, UnicodeCol, BoolCol, DatabaseIndex
 from sqlobject import connectionForURI
 from sqlobject import dberrors
 
@@ -48,8 +59,12 @@ class HistoryManager(object, metaclass=Singleton):
 
     def __init__(self):
         self.calls = []
+        self.calls_cursor = None
+        self.calls_size = self.history_size  # the number of calls that are kept, with the older pages that were loaded
+        self.more_calls = False
         self.message_history = MessageHistory()
         self.download_history = DownloadHistory()
+        self.unread_messages = UnreadMessages()
 
         notification_center = NotificationCenter()
         notification_center.add_observer(self, name='SIPApplicationDidStart')
@@ -71,7 +86,9 @@ class HistoryManager(object, metaclass=Singleton):
         notification_center.add_observer(self, name='BlinkConversationWillRemove')
         notification_center.add_observer(self, name='BlinkGotDispositionNotification')
         notification_center.add_observer(self, name='BlinkDidSendDispositionNotification')
+        notification_center.add_observer(self, name='BlinkGotMessageReference')
         notification_center.add_observer(self, name='BlinkGotHistoryMessage')
+        notification_center.add_observer(self, name='BlinkGotHistoryMessages')
         notification_center.add_observer(self, name='BlinkGotHistoryMessageDelete')
         notification_center.add_observer(self, name='BlinkGotHistoryMessageUpdate')
         notification_center.add_observer(self, name='BlinkGotHistoryConversationRemove')
@@ -80,14 +97,14 @@ class HistoryManager(object, metaclass=Singleton):
         notification_center.add_observer(self, name='BlinkMessageContactsDidChange')
         notification_center.add_observer(self, name='MessageContactsManagerDidActivate')
         notification_center.add_observer(self, name='CFGSettingsObjectDidChange')
+        notification_center.add_observer(self, name='BlinkMessageHistoryCallsDidLoad')
 
-    @run_in_thread('file-io')
-    def save(self):
-        with open(ApplicationData.get('calls_history'), 'wb+') as history_file:
-            pickle.dump(self.calls, history_file)
+    def load_older_calls(self):
+        if self.more_calls:
+            self.message_history.load_calls(self.history_size, before=self.calls_cursor)
 
-    def load(self, uri, session, entries=100):
-        return self.message_history.load(uri, session, entries=entries)
+    def load(self, uri, session, entries=100, before=None):
+        return self.message_history.load(uri, session, entries=entries, before=before)
 
     def reload_pending_encrypted(self, uri, session, entries=100):
         return self.message_history.reload_pending_encrypted(uri, session, entries=entries)
@@ -95,6 +112,18 @@ class HistoryManager(object, metaclass=Singleton):
     def get_last_contacts(self, number=10, unread=False):
         return self.message_history.get_last_contacts(number, unread=unread)
 
+    def search(self, query, account=None, remote_uri=None, limit=50, cursor=None):
+        return self.message_history.search(query, account=account, remote_uri=remote_uri, limit=limit, cursor=cursor)
+
+    def export(self, path, account=None, remote_uri=None):
+        return self.message_history.export(path, account=account, remote_uri=remote_uri)
+
+    def import_(self, path):
+        return self.message_history.import_(path)
+
+    def compact(self):
+        return self.message_history.compact()
+
     def get_decrypted_filename(self, file):
         return self.download_history.get_decrypted_filename(file)
 
@@ -105,25 +134,13 @@ class HistoryManager(object, metaclass=Singleton):
 
     def _NH_CFGSettingsObjectDidChange(self, notification):
         if isinstance(notification.sender, (Account, BonjourAccount)):
-            account_manager = AccountManager()
             account = notification.sender
             if 'sms.private_key' in notification.data.modified:
                 self.message_history.reset_decryption(str(account.id))
-            if 'enabled' in notification.data.modified:
-                self.message_history.get_unread_messages()
 
 
     def _NH_SIPApplicationDidStart(self, notification):
-        try:
-            data = pickle.load(open(ApplicationData.get('calls_history'), "rb"))
-            if not isinstance(data, list) or not all(isinstance(item, HistoryEntry) and item.text and isinstance(item.call_time, ISOTimestamp) for item in data):
-                raise ValueError("invalid save data")
-        except FileNotFoundError:
-            pass
-        except Exception as e:
-            traceback.print_exc()
-        else:
-            self.calls = data[-self.history_size:]
+        self.message_history.load_calls(self.history_size)
         self.message_history._retry_failed_messages()
         self.message_history.get_unread_messages()
 
@@ -132,10 +149,8 @@ class HistoryManager(object, metaclass=Singleton):
             return
         session = notification.sender
         entry = HistoryEntry.from_session(session)
-        bisect.insort(self.calls, entry)
-        self.calls = self.calls[-self.history_size:]
-        self.save()
-        self.message_history.add_call_history_entry(entry, session)
+        self._add_call(entry)
+        self.message_history.add_call(entry, session)
 
     def _NH_SIPSessionDidFail(self, notification):
         if notification.sender.account is BonjourAccount():
@@ -154,10 +169,20 @@ class HistoryManager(object, metaclass=Singleton):
             else:
                 entry.reason = notification.data.reason or notification.data.failure_reason
             entry.failed = True
+        self._add_call(entry)
+        self.message_history.add_call(entry, session)
+
+    def _add_call(self, entry):
         bisect.insort(self.calls, entry)
-        self.calls = self.calls[-self.history_size:]
-        self.save()
-        self.message_history.add_call_history_entry(entry, session)
+        self._trim_calls()
+
+    def _trim_calls(self):
+        if len(self.calls) > self.calls_size:
+            del self.calls[:-self.calls_size]
+            # the calls that were dropped can be loaded again, the ones that are not stored yet have no id and are newer than them
+            oldest = self.calls[0]
+            self.calls_cursor = (oldest.call_time, oldest.id if oldest.id is not None else 0)
+            self.more_calls = True
 
     def _NH_ChatStreamGotMessage(self, notification):
         message = notification.data.message
@@ -198,6 +223,9 @@ class HistoryManager(object, metaclass=Singleton):
         account = notification.sender
         self.message_history.add_from_server_history(account, **notification.data.__dict__)
 
+    def _NH_BlinkGotHistoryMessages(self, notification):
+        self.message_history.add_from_server_history_batch(notification.sender, notification.data.messages, notification.data.cursor)
+
     def _NH_BlinkGotHistoryMessageDelete(self, notification):
         self.message_history.remove_message(notification.data)
         self.download_history.remove(notification.data)
@@ -255,6 +283,9 @@ class HistoryManager(object, metaclass=Singleton):
         data = notification.data
         self.message_history.update(data.id, data.status)
 
+    def _NH_BlinkGotMessageReference(self, notification):
+        self.message_history.find_message(notification.sender, notification.data.id)
+
     def _NH_BlinkFileTransferDidEnd(self, notification):
         if not notification.data.error:
             if type(notification.sender) is not BlinkSession:
@@ -267,10 +298,229 @@ class HistoryManager(object, metaclass=Singleton):
     def _NH_BlinkMessageContactsDidChange(self, notification):
         self.message_history.get_all_contacts()
 
+    def _NH_BlinkMessageHistoryCallsDidLoad(self, notification):
+        data = notification.data
+        if data.before is None:
+            # keep the calls that ended while the history was loading
+            self.calls = data.calls + [entry for entry in self.calls if not data.calls or entry.call_time > data.calls[-1].call_time]
+            self.calls_size = self.history_size
+        else:
+            self.calls = data.calls + self.calls
+            self.calls_size += len(data.calls)
+        self.calls_cursor = data.cursor
+        self.more_calls = data.more
+        self._trim_calls()
+        notification.center.post_notification('BlinkCallHistoryDidChange', sender=self)
+
     def _NH_MessageContactsManagerDidActivate(self, notification):
         self.message_history.get_all_contacts()
 
 
+@implementer(IObserver)
+class UnreadMessages(object, metaclass=Singleton):
+    """
+    The number of unread incoming messages per remote URI. The counts are loaded
+    once from the conversations table and then updated from the notifications,
+    the changes are posted at most once every update_interval milliseconds. The
+    changes that arrive after the counts were queried are applied again to the
+    loaded counts, so that they are not lost.
+    """
+
+    update_interval = 100  # milliseconds
+    changes_size = 1000  # the number of recent changes kept to be applied again to the loaded counts
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self._accounts = {}
+        self._changes = deque(maxlen=self.changes_size)  # (time, function, args) of the changes to _accounts
+        self._changed_uris = set()
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(self.update_interval)
+        self._timer.timeout.connect(self._post_changes)
+
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='BlinkMessageHistoryUnreadMessagesDidLoad')
+        notification_center.add_observer(self, name='BlinkMessageNewUnread')
+        notification_center.add_observer(self, name='BlinkSessionConfirmReadMessages')
+        notification_center.add_observer(self, name='BlinkConfirmReadMessagesOnOtherDevice')
+        notification_center.add_observer(self, name='SIPAccountManagerDidRemoveAccount')
+        notification_center.add_observer(self, name='CFGSettingsObjectDidChange')
+
+    def __getitem__(self, uri):
+        return self.counts.get(uri, 0)
+
+    def add(self, uri, count=1, account=None):
+        account_id = str(account.id) if account is not None else None
+        self._change(self._add_count, account_id, uri, count)
+        if account is None or account.enabled:
+            self.counts[uri] = self.counts.get(uri, 0) + count
+            self.total += count
+            self._changed(uri)
+
+    def clear(self, uri):
+        self._change(self._clear_count, uri)
+        count = self.counts.pop(uri, 0)
+        if count:
+            self.total -= count
+            self._changed(uri)
+
+    def _change(self, function, *args):
+        self._changes.append((monotonic(), function, args))
+        function(*args)
+
+    def _add_count(self, account_id, uri, count):
+        counts = self._accounts.setdefault(account_id, {})
+        counts[uri] = counts.get(uri, 0) + count
+
+    def _clear_count(self, uri):
+        for counts in self._accounts.values():
+            counts.pop(uri, None)
+
+    def _remove_account(self, account_id):
+        self._accounts.pop(account_id, None)
+
+    def _changed(self, *uris):
+        self._changed_uris.update(uris)
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def _update(self):
+        # only the enabled accounts are counted, a change of account doesn't need the counts to be loaded again
+        enabled_accounts = {str(account.id) for account in AccountManager().iter_accounts() if account.enabled}
+        enabled_accounts.add(None)
+        counts = {}
+        for account_id, account_counts in self._accounts.items():
+            if account_id in enabled_accounts:
+                for uri, count in account_counts.items():
+                    counts[uri] = counts.get(uri, 0) + count
+        changed_uris = {uri for uri in counts.keys() | self.counts.keys() if counts.get(uri) != self.counts.get(uri)}
+        self.counts = counts
+        self.total = sum(counts.values())
+        if changed_uris:
+            self._changed(*changed_uris)
+
+    def _post_changes(self):
+        changed_uris, self._changed_uris = self._changed_uris, set()
+        NotificationCenter().post_notification('BlinkUnreadMessagesChanged', sender=self, data=NotificationData(remote_uris=changed_uris, total=self.total))
+
+    @run_in_gui_thread
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_BlinkMessageHistoryUnreadMessagesDidLoad(self, notification):
+        # the changes that arrived since the counts were queried are not in them
+        query_time = notification.data.query_time
+        self._accounts = notification.data.unread_messages
+        self._changes = deque(((change_time, function, args) for change_time, function, args in self._changes if change_time > query_time), maxlen=self.changes_size)
+        for change_time, function, args in self._changes:
+            function(*args)
+        self._update()
+
+    def _NH_BlinkMessageNewUnread(self, notification):
+        self.add(notification.sender, getattr(notification.data, 'count', None) or 1, getattr(notification.data, 'account', None))
+
+    def _NH_BlinkSessionConfirmReadMessages(self, notification):
+        self.clear(str(notification.sender.uri).partition(':')[2])
+
+    def _NH_BlinkConfirmReadMessagesOnOtherDevice(self, notification):
+        self.clear(notification.data.remote_uri)
+
+    def _NH_SIPAccountManagerDidRemoveAccount(self, notification):
+        self._change(self._remove_account, str(notification.data.account.id))
+        self._update()
+
+    def _NH_CFGSettingsObjectDidChange(self, notification):
+        if isinstance(notification.sender, (Account, BonjourAccount)) and 'enabled' in notification.data.modified:
+            self._update()
+
+
+@implementer(IObserver)
+class AddressbookIndex(object, metaclass=Singleton):
+    """
+    The addressbook contacts by URI, without the sip: prefix and in lower case.
+    It is kept up to date from the addressbook notifications, in the db thread,
+    where most of the lookups are done. The lookups from other threads, like
+    the GUI one, are safe.
+    """
+
+    sip_prefix_re = re.compile('^sips?:')
+
+    def __init__(self):
+        self._lock = Lock()
+        self._contacts = {}
+        self._contact_uris = {}
+        self._uris = {}
+
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='AddressbookContactWasActivated')
+        notification_center.add_observer(self, name='AddressbookContactWasCreated')
+        notification_center.add_observer(self, name='AddressbookContactDidChange')
+        notification_center.add_observer(self, name='AddressbookContactWasDeleted')
+        self._load()
+
+    @run_in_thread('db')
+    def _load(self):
+        for contact in AddressbookManager().get_contacts():
+            self.add(contact)
+
+    @classmethod
+    def normalize(cls, uri):
+        return cls.sip_prefix_re.sub('', str(uri)).lower()
+
+    def add(self, contact):
+        uris = {self.normalize(address.uri) for address in contact.uris}
+        with self._lock:
+            self._remove(contact)
+            self._contacts[contact.id] = contact
+            self._contact_uris[contact.id] = uris
+            for uri in uris:
+                self._uris.setdefault(uri, []).append(contact.id)
+
+    def remove(self, contact):
+        with self._lock:
+            self._remove(contact)
+
+    def _remove(self, contact):
+        self._contacts.pop(contact.id, None)
+        for uri in self._contact_uris.pop(contact.id, ()):
+            contact_ids = self._uris[uri]
+            contact_ids.remove(contact.id)
+            if not contact_ids:
+                del self._uris[uri]
+
+    def find(self, uri):
+        uri = self.normalize(uri)
+        with self._lock:
+            try:
+                return self._contacts[self._uris[uri][0]]
+            except (KeyError, IndexError):
+                return None
+
+    def display_name(self, uri, default=''):
+        contact = self.find(uri)
+        return contact.name if contact is not None else default
+
+    @run_in_thread('db')
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_AddressbookContactWasActivated(self, notification):
+        self.add(notification.sender)
+
+    def _NH_AddressbookContactWasCreated(self, notification):
+        self.add(notification.sender)
+
+    def _NH_AddressbookContactDidChange(self, notification):
+        self.add(notification.sender)
+
+    def _NH_AddressbookContactWasDeleted(self, notification):
+        self.remove(notification.sender)
+
+
 class TableVersion(SQLObject):
     class sqlmeta:
         table = 'table_versions'
@@ -295,9 +545,56 @@ class Message(SQLObject):
     decrypted       = StringCol(default='0')
     decryption_error= StringCol(sqlType='LONGTEXT')
     disposition     = StringCol(default='')
+    kind            = StringCol(default='chat')
+    content_hash    = StringCol(default=None)
     remote_idx      = DatabaseIndex('remote_uri')
     id_idx          = DatabaseIndex('message_id')
     unq_idx         = DatabaseIndex(message_id, account_id, remote_uri, unique=True)
+    conversation_idx    = DatabaseIndex('remote_uri', 'timestamp')
+    remote_state_idx    = DatabaseIndex('remote_uri', 'direction', 'state', 'timestamp')
+    direction_state_idx = DatabaseIndex('direction', 'state', 'account_id', 'remote_uri')
+    state_idx           = DatabaseIndex('state')
+    kind_idx            = DatabaseIndex('kind', 'remote_uri', 'account_id', 'state', 'timestamp')
+    content_hash_idx    = DatabaseIndex('content_hash')
+
+
+class Conversation(SQLObject):
+    class sqlmeta:
+        table = 'conversations'
+    account_id      = UnicodeCol(length=128)
+    remote_uri      = UnicodeCol(length=128)
+    display_name    = UnicodeCol(length=128, default='')
+    last_timestamp  = DateTimeCol()
+    message_count   = IntCol(default=0)
+    unread          = IntCol(default=0)
+    unq_idx         = DatabaseIndex(account_id, remote_uri, unique=True)
+    timestamp_idx   = DatabaseIndex('last_timestamp')
+
+
+class Call(SQLObject):
+    class sqlmeta:
+        table = 'calls'
+    account_id      = UnicodeCol(length=128)
+    remote_uri      = UnicodeCol(length=128)
+    display_name    = UnicodeCol(length=128, default='')
+    direction       = StringCol()
+    media           = StringCol(default='audio')
+    call_time       = DateTimeCol()
+    duration        = IntCol(default=None)
+    reason          = UnicodeCol(default='')
+    failed          = BoolCol(default=False)
+    message_id      = StringCol(default=None)
+    time_idx        = DatabaseIndex('call_time')
+    remote_idx      = DatabaseIndex('remote_uri', 'call_time')
+    message_idx     = DatabaseIndex('message_id')
+
+
+class MessageBlob(SQLObject):
+    class sqlmeta:
+        table = 'message_blobs'
+    hash            = StringCol(alternateID=True)
+    content         = UnicodeCol(sqlType='LONGTEXT')
+    size            = IntCol()
 
 
 class DownloadedFiles(SQLObject):
@@ -311,6 +608,296 @@ class DownloadedFiles(SQLObject):
     unq_idx            = DatabaseIndex(file_id, filename, account_id, unique=True)
 
 
+def sql_timestamp(timestamp):
+    # the same representation SQLObject uses for DateTimeCol values
+    return timestamp.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def parse_sql_timestamp(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def message_kind(content_type):
+    # chat messages are the ones shown in conversations, everything else is kept out of the contact lists
+    content_type = content_type.lower()
+    if content_type == 'application/blink-call-history':
+        return 'call'
+    elif 'pgp' in content_type:
+        return 'pgp'
+    elif 'sylk-api' in content_type:
+        return 'api'
+    return 'chat'
+
+
+class MessageRow(object):
+    """
+    A messages table row as returned by the read queries, with the same attributes
+    as Message. For call history entries, call is the HistoryEntry of the call.
+    The content of the messages kept in the blob table is read from there.
+    """
+
+    columns = ('id', 'message_id', 'account_id', 'remote_uri', 'display_name', 'uri', 'timestamp', 'direction', 'content',
+               'content_type', 'state', 'encryption_type', 'decrypted', 'decryption_error', 'disposition', 'kind')
+
+    content_expression = f'coalesce(content, (select content from {MessageBlob.sqlmeta.table} where hash = content_hash))'
+
+    __slots__ = columns + ('call',)
+
+    def __init__(self, id, message_id, account_id, remote_uri, display_name, uri, timestamp, direction, content,
+                 content_type, state, encryption_type, decrypted, decryption_error, disposition, kind):
+        self.id = id
+        self.message_id = message_id
+        self.account_id = account_id
+        self.remote_uri = remote_uri
+        self.display_name = display_name
+        self.uri = uri
+        self.timestamp = parse_sql_timestamp(timestamp)
+        self.direction = direction
+        self.content = content
+        self.content_type = content_type
+        self.state = state
+        self.encryption_type = encryption_type
+        self.decrypted = decrypted
+        self.decryption_error = decryption_error
+        self.disposition = disposition
+        self.kind = kind
+        self.call = None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.id!r}, {self.message_id!r}, {self.remote_uri!r}, {self.state!r})'
+
+    @classmethod
+    def select_list(cls, columns=None):
+        return ', '.join(cls.content_expression if column == 'content' else column for column in columns or cls.columns)
+
+
+class MessageSearchResult(object):
+    __slots__ = 'message_id', 'account_id', 'remote_uri', 'display_name', 'direction', 'timestamp', 'snippet', 'rank'
+
+    def __init__(self, message_id, account_id, remote_uri, display_name, direction, timestamp, snippet, rank):
+        self.message_id = message_id
+        self.account_id = account_id
+        self.remote_uri = remote_uri
+        self.display_name = display_name
+        self.direction = direction
+        self.timestamp = parse_sql_timestamp(timestamp)
+        self.snippet = snippet
+        self.rank = rank
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.message_id!r}, {self.remote_uri!r}, {self.snippet!r})'
+
+
+class HistoryWriteOperation(object):
+    __slots__ = 'query', 'parameters', 'callback'
+
+    def __init__(self, query, parameters=(), callback=None):
+        self.query = query
+        self.parameters = parameters
+        self.callback = callback
+
+
+class HistoryWriter(object):
+    """
+    Collects the writes to the message history database and applies them
+    in a single transaction, either when the current burst of writes has
+    been queued (one tick) or when batch_size operations are pending.
+    All methods must be called from the db thread. The callbacks of the
+    operations that modified the database are called after the commit,
+    with the id of the last inserted row as argument.
+
+    Message state changes are coalesced: only the resulting state of each
+    message is kept and they are written at the end of the transaction
+    with one UPDATE per target state.
+
+    If the transaction cannot be started or committed or one of its
+    statements fails, for example because the database is locked, it is
+    rolled back and the operations are queued again and retried after
+    retry_interval seconds, doubled after every failed attempt. Until then
+    flush does nothing and run fails, so that the reads and the other writes
+    do not use up the attempts or overtake the queued operations. After
+    max_retries attempts the statement that failed is dropped, or all the
+    operations if the transaction itself failed, and
+    BlinkMessageHistoryWriteDidFail is posted.
+    """
+
+    batch_size = 500
+    flush_interval = 0.2  # seconds
+    retry_interval = 1  # seconds
+    max_retries = 5
+
+    # auto_vacuum only applies to new databases, existing ones are converted by MessageHistory._vacuum
+    pragmas = ['PRAGMA auto_vacuum=INCREMENTAL',
+               'PRAGMA journal_mode=WAL',
+               'PRAGMA synchronous=NORMAL',
+               'PRAGMA temp_store=MEMORY',
+               'PRAGMA cache_size=-16000',
+               'PRAGMA busy_timeout=5000']
+
+    def __init__(self, db):
+        self.db = db
+        self._operations = []
+        self._states = {}
+        self._flush_scheduled = False
+        self._retries = 0
+
+    def configure(self):
+        connection = self.db.getConnection()
+        try:
+            for pragma in self.pragmas:
+                try:
+                    connection.execute(pragma).fetchall()
+                except sqlite3.Error as e:
+                    log.warning(f'Failed to configure message history database ({pragma}): {e}')
+        finally:
+            self.db.releaseConnection(connection)
+
+    def execute(self, query, parameters=(), callback=None):
+        self._operations.append(HistoryWriteOperation(query, parameters, callback))
+        self._schedule_flush()
+
+    def update_state(self, message_id, state):
+        # The same transitions as the ones enforced by the UPDATE statements: displayed can only be followed
+        # by deleted and received is ignored for outgoing messages. The direction is not known here, so a
+        # pending state followed by received is written in order instead of being merged.
+        pending = self._states.get(message_id)
+        if pending == 'displayed' and state != 'deleted':
+            return
+        if state == 'received' and pending not in (None, state):
+            self._operations.extend(self._state_operations(pending, [message_id]))
+        self._states[message_id] = state
+        self._schedule_flush()
+
+    def _state_operations(self, state, message_ids):
+        conditions = ['state != ?']
+        if state != 'deleted':
+            conditions.append("state != 'displayed'")
+        if state == 'received':
+            conditions.append("direction != 'outgoing'")
+        for index in range(0, len(message_ids), 500):
+            chunk = message_ids[index:index + 500]
+            query = f"update {Message.sqlmeta.table} set state = ? where message_id in ({', '.join('?' * len(chunk))}) and {' and '.join(conditions)}"
+            yield HistoryWriteOperation(query, [state] + chunk + [state])
+
+    def _schedule_flush(self):
+        if len(self._operations) + len(self._states) >= self.batch_size and not self._retries:
+            self.flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            call_in_gui_thread(call_later, self.flush_interval, self.request_flush)
+
+    @run_in_thread('db')
+    def request_flush(self, retry=False):
+        if retry:
+            self._flush()
+        else:
+            self.flush()
+
+    def flush(self):
+        if self._retries:
+            return
+        self._flush()
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if not self._operations and not self._states:
+            return
+        operations, self._operations = self._operations, []
+        states, self._states = self._states, {}
+        message_ids = {}
+        for message_id, state in states.items():
+            message_ids.setdefault(state, []).append(message_id)
+        for state, ids in message_ids.items():
+            operations.extend(self._state_operations(state, ids))
+        callbacks = []
+        operation = None
+        connection = self.db.getConnection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            for operation in operations:
+                cursor.execute(operation.query, operation.parameters)
+                if cursor.rowcount > 0 and operation.callback is not None:
+                    callbacks.append((operation.callback, cursor.lastrowid))
+            operation = None
+            cursor.execute('COMMIT')
+        except sqlite3.Error as e:
+            try:
+                connection.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+            self._retry(operations, e, operation)
+            return
+        finally:
+            self.db.releaseConnection(connection)
+        self._retries = 0
+        log.debug(f'== Committed {len(operations)} message history changes')
+        for callback, rowid in callbacks:
+            try:
+                callback(rowid)
+            except Exception:
+                traceback.print_exc()
+
+    def _retry(self, operations, error, failed_operation=None):
+        # failed_operation is the statement that failed, None if it was the transaction itself
+        self._retries += 1
+        if self._retries > self.max_retries:
+            self._retries = 0
+            notification_center = NotificationCenter()
+            if failed_operation is None:
+                log.error(f'Failed to commit {len(operations)} message history changes after {self.max_retries} retries, dropping them: {error}')
+                notification_center.post_notification('BlinkMessageHistoryWriteDidFail', sender=self, data=NotificationData(operations=len(operations), error=str(error)))
+                return
+            log.error(f'Failed to write to message history after {self.max_retries} retries, dropping {failed_operation.query!r}: {error}')
+            notification_center.post_notification('BlinkMessageHistoryWriteDidFail', sender=self, data=NotificationData(operations=1, error=str(error)))
+            # the other operations did not fail, they are applied without the one that did
+            self._operations[:0] = [operation for operation in operations if operation is not failed_operation]
+            self._schedule_flush()
+            return
+        delay = self.retry_interval * 2 ** (self._retries - 1)
+        log.warning(f'Failed to write {len(operations)} message history changes, retrying in {delay} seconds: {error}')
+        # the operations queued meanwhile are applied after these ones, in the same transaction
+        self._operations[:0] = operations
+        self._flush_scheduled = True
+        call_in_gui_thread(call_later, delay, self.request_flush, retry=True)
+
+    def execute_many(self, query, rows):
+        # Applies the pending operations first, then runs the query once per row in its own transaction.
+        # Returns the number of modified rows or None if the transaction failed.
+        def execute(cursor):
+            cursor.executemany(query, rows)
+            return cursor.rowcount
+        rowcount = self.run(execute)
+        if rowcount is not None:
+            log.debug(f'== Committed {rowcount} of {len(rows)} message history rows')
+        return rowcount
+
+    def run(self, function):
+        # Applies the pending operations first, then calls function with a cursor in its own transaction.
+        # Returns the result of function or None if the transaction failed, or if the pending operations are
+        # waiting to be retried, since they have to be applied first.
+        self.flush()
+        if self._retries:
+            log.warning('Cannot write to message history while a failed write is waiting to be retried')
+            return None
+        connection = self.db.getConnection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            result = function(cursor)
+            cursor.execute('COMMIT')
+        except sqlite3.Error as e:
+            log.error(f'Failed to commit message history changes: {e}')
+            try:
+                connection.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+            return None
+        finally:
+            self.db.releaseConnection(connection)
+        return result
+
+
 class TableVersions(object, metaclass=Singleton):
     __version__ = 1
     __versions__ = {}
@@ -328,7 +915,7 @@ class TableVersions(object, metaclass=Singleton):
         if not TableVersion.tableExists():
             try:
                 TableVersion.createTable()
-            except Exception as e:
+            except Exception:
                 pass
             else:
                 self.set_version(TableVersion.sqlmeta.table, self.__version__)
@@ -355,9 +942,9 @@ class TableVersions(object, metaclass=Singleton):
             try:
                 record = TableVersion.selectBy(table_name=table).getOne()
                 record.version = version
-            except Exception as e:
+            except Exception:
                 pass
-        except Exception as e:
+        except Exception:
             pass
         self.__versions__[table] = version
 
@@ -380,7 +967,7 @@ class DownloadHistory(object, metaclass=Singleton):
         if not DownloadedFiles.tableExists():
             try:
                 DownloadedFiles.createTable()
-            except Exception as e:
+            except Exception:
                 pass
             else:
                 self.table_versions.set_version(DownloadedFiles.sqlmeta.table, self.__version__)
@@ -423,7 +1010,7 @@ class DownloadHistory(object, metaclass=Singleton):
     def get_decrypted_filename(self, file):
         try:
             return DownloadedFiles.selectBy(file_id=file.id).getOne().filename
-        except Exception as e:
+        except Exception:
             return file.name
 
     @run_in_thread('db')
@@ -437,15 +1024,23 @@ class DownloadHistory(object, metaclass=Singleton):
 
     @run_in_thread('file-io')
     def remove_cache_file(self, file):
-        filename = os.path.basename(file.filename)
+        self._remove_cache_file(file.file_id, file.filename)
+
+    @run_in_thread('file-io')
+    def remove_cache_files(self, files):
+        for file_id, filename in files:
+            self._remove_cache_file(file_id, filename)
+
+    def _remove_cache_file(self, file_id, filename):
+        filename = os.path.basename(filename)
         if filename.endswith('.asc'):
             filename = filename.rsplit('.', 1)[0]
-        cached_file = os.path.join(ApplicationData.get('downloads'), file.file_id, filename)
+        cached_file = os.path.join(ApplicationData.get('downloads'), file_id, filename)
         file_in_cache = os.path.exists(cached_file)
         if not file_in_cache:
-            #log.info(f'== Not removing file, not present in cache: {file.file_id} {cached_file}')
+            #log.info(f'== Not removing file, not present in cache: {file_id} {cached_file}')
             return
-        log.info(f'== Removing file from cache: {file.file_id} {cached_file}')
+        log.info(f'== Removing file from cache: {file_id} {cached_file}')
         unlink(cached_file)
         try:
             os.rmdir(os.path.dirname(cached_file))
@@ -455,10 +1050,18 @@ class DownloadHistory(object, metaclass=Singleton):
     @run_in_thread('db')
     def remove_contact_files(self, account, contact):
         log.info(f'== Removing file entries and files from cache between {account.id} <-> {contact}')
-        result = DownloadedFiles.selectBy(remote_uri=contact, account_id=str(account.id))
-        for file in result:
-            self.remove_cache_file(file)
-            file.destroySelf()
+        table = DownloadedFiles.sqlmeta.table
+        connection = self.db.getConnection()
+        try:
+            files = connection.execute(f'select file_id, filename from {table} where account_id = ? and remote_uri = ?', (str(account.id), contact)).fetchall()
+            connection.execute(f'delete from {table} where account_id = ? and remote_uri = ?', (str(account.id), contact))
+        except sqlite3.Error as e:
+            log.warning(f'Failed to remove the file entries of {contact}: {e}')
+            return
+        finally:
+            self.db.releaseConnection(connection)
+        if files:
+            self.remove_cache_files(files)
 
     @run_in_thread('db')
     def update(self, id, state):
@@ -474,13 +1077,41 @@ class DownloadHistory(object, metaclass=Singleton):
 
 @implementer(IObserver)
 class MessageHistory(object, metaclass=Singleton):
-    __version__ = 4
+    __version__ = 6
+    __conversations_version__ = 2
+    __search_version__ = 1
+    __calls_version__ = 1
+    __blobs_version__ = 1
     phone_number_re = re.compile(r'^(?P<number>(0|00|\+)[1-9]\d{7,14})@')
 
+    removal_chunk_size = 1000
+
+    # payloads from this size on, which are not indexed for search, are kept once in the blob table
+    blob_threshold = 4096
+    blob_chunk_size = 200
+
+    export_chunk_size = 5000
+    import_chunk_size = 1000
+
+    retention_delay = 300  # seconds
+    retention_interval = 0.5  # seconds
+    retention_chunk_size = 500
+    vacuum_pages = 1024
+
+    known_messages_size = 10000  # the number of stored message ids find_message knows without a query
+    missing_messages_size = 1000  # the number of message ids find_message already reported as not found
+
+    message_defaults = dict(uri='', content_type='text', state='pending', encryption_type='', decrypted='0', decryption_error='', disposition='', content_hash=None)
+    silent_content_types = {IsComposingDocument.content_type, IMDNDocument.content_type, 'text/pgp-public-key', 'text/pgp-private-key', 'application/sylk-message-remove'}
+
     def __init__(self):
         notification_center = NotificationCenter()
         notification_center.add_observer(self, name='NetworkConditionsDidChange')
+        notification_center.add_observer(self, name='SIPApplicationWillEnd')
 
+        self.addressbook = AddressbookIndex()
+        self._known_messages = OrderedDict()  # (account_id, message_id) -> None, only used from the db thread
+        self._missing_messages = OrderedDict()  # (account_id, message_id) -> None, only used from the db thread
         db_file = ApplicationData.get('message_history.db')
         db_uri = f'sqlite:{db_file}'
         makedirs(ApplicationData.directory)
@@ -489,6 +1120,12 @@ class MessageHistory(object, metaclass=Singleton):
         self._retry_timer.setInterval(60 * 1000)  # a minute (in milliseconds)
         self._retry_timer.timeout.connect(self._retry_failed_messages)
         self._retry_timer.start()
+        self._retention_tasks = []
+        self._retention_timer = QTimer()
+        self._retention_timer.setInterval(6 * 3600 * 1000)  # 6 hours (in milliseconds)
+        self._retention_timer.timeout.connect(self.apply_retention)
+        self._retention_timer.start()
+        call_later(self.retention_delay, self.apply_retention)
 
     @run_in_gui_thread
     def handle_notification(self, notification):
@@ -498,67 +1135,372 @@ class MessageHistory(object, metaclass=Singleton):
     def _NH_NetworkConditionsDidChange(self, notification):
         self._retry_failed_messages()
 
+    def _NH_SIPApplicationWillEnd(self, notification):
+        self.writer.request_flush()
+
     @run_in_thread('db')
     def _initialize(self, db_uri):
         self.db = connectionForURI(db_uri)
         Message._connection = self.db
+        self.writer = HistoryWriter(self.db)
+        self.writer.configure()
         self.table_versions = TableVersions()
         if not Message.tableExists():
             try:
                 Message.createTable()
-            except Exception as e:
+            except Exception:
                 pass
             else:
                 self.table_versions.set_version(Message.sqlmeta.table, self.__version__)
         else:
             self._check_table_version()
 
+        Conversation._connection = self.db
+        if not Conversation.tableExists():
+            try:
+                Conversation.createTable()
+            except Exception:
+                pass
+            else:
+                self._initialize_conversations()
+                self.table_versions.set_version(Conversation.sqlmeta.table, self.__conversations_version__)
+        elif self.table_versions.version(Conversation.sqlmeta.table) != self.__conversations_version__:
+            self._upgrade_conversations()
+
+        Call._connection = self.db
+        if not Call.tableExists():
+            try:
+                Call.createTable()
+            except Exception:
+                pass
+            else:
+                self._initialize_calls()
+                self.table_versions.set_version(Call.sqlmeta.table, self.__calls_version__)
+
+        MessageBlob._connection = self.db
+        if not MessageBlob.tableExists():
+            try:
+                MessageBlob.createTable()
+            except Exception:
+                pass
+            else:
+                self._initialize_blobs()
+        # the payloads can only be moved once the messages table has the content_hash column
+        if self.table_versions.version(Message.sqlmeta.table) == self.__version__ and self.table_versions.version(MessageBlob.sqlmeta.table) != self.__blobs_version__:
+            log.info(f'== Moving the large message payloads to {MessageBlob.sqlmeta.table}')
+            call_in_gui_thread(call_later, self.retention_delay, self._migrate_blobs)
+
+        self.search_table = f'{Message.sqlmeta.table}_fts'
+        self.search_available = self._initialize_search()
+
+    def _initialize_blobs(self):
+        # A blob is removed with the last message that references it
+        messages = Message.sqlmeta.table
+        blobs = MessageBlob.sqlmeta.table
+        remove_blob = f"""
+            BEGIN
+                DELETE FROM {blobs} WHERE hash = old.content_hash AND NOT EXISTS (SELECT 1 FROM {messages} WHERE content_hash = old.content_hash);
+            END"""
+        self.writer.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {blobs}_delete AFTER DELETE ON {messages} WHEN old.content_hash IS NOT NULL{remove_blob}""")
+        self.writer.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {blobs}_update AFTER UPDATE OF content_hash ON {messages}
+            WHEN old.content_hash IS NOT NULL AND old.content_hash IS NOT new.content_hash{remove_blob}""")
+        self.writer.flush()
+
+    @run_in_thread('db')
+    def _migrate_blobs(self, last_id=0):
+        # Moves the payloads stored before the blob table existed, one chunk at a time
+        table = Message.sqlmeta.table
+        query = f"""select id, content from {table} where id > ? and content_hash is null and length(content) >= ?
+            and (kind != 'chat' or content_type not like 'text/%' or content like '-----BEGIN PGP MESSAGE-----%')
+            order by id limit ?"""
+
+        def migrate(cursor):
+            rows = cursor.execute(query, (last_id, self.blob_threshold, self.blob_chunk_size)).fetchall()
+            blobs = [(hashlib.sha256(content.encode()).hexdigest(), content, len(content)) for id, content in rows]
+            cursor.executemany(f'insert or ignore into {MessageBlob.sqlmeta.table} (hash, content, size) values (?, ?, ?)', blobs)
+            cursor.executemany(f'update {table} set content = null, content_hash = ? where id = ?', [(blob[0], row[0]) for blob, row in zip(blobs, rows)])
+            return [id for id, content in rows]
+
+        ids = self.writer.run(migrate)
+        if ids is None:
+            return
+        if len(ids) == self.blob_chunk_size:
+            call_in_gui_thread(call_later, self.retention_interval, self._migrate_blobs, ids[-1])
+        else:
+            log.info(f'== Moved the large message payloads to {MessageBlob.sqlmeta.table}')
+            self.table_versions.set_version(MessageBlob.sqlmeta.table, self.__blobs_version__)
+
+    def _blob(self, values):
+        # Moves a large payload out of the message values, returns the blob row or None
+        content = values['content']
+        if content is None or len(content) < self.blob_threshold:
+            return None
+        if values['kind'] == 'chat' and values['content_type'].lower().startswith('text/') and not content.startswith('-----BEGIN PGP MESSAGE-----'):
+            return None
+        values['content'] = None
+        values['content_hash'] = hashlib.sha256(content.encode()).hexdigest()
+        return values['content_hash'], content, len(content)
+
+    def _initialize_search(self):
+        # An external content FTS5 index over the text of the chat messages. Encrypted messages, images,
+        # call history entries and application payloads are not indexed.
+        if self.table_versions.version(self.search_table) == self.__search_version__:
+            return True
+        messages = Message.sqlmeta.table
+        searchable = "{0}.kind = 'chat' AND {0}.content_type LIKE 'text/%' AND {0}.content NOT LIKE '-----BEGIN PGP MESSAGE-----%'"
+        try:
+            self.db.queryAll(f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.search_table} USING fts5(content, content='{messages}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+        except Exception as e:
+            log.warning(f'Message history search is not available: {e}')
+            return False
+        log.info(f'== Building {self.search_table} index')
+        self.writer.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {self.search_table}_insert AFTER INSERT ON {messages} WHEN {searchable.format('new')}
+            BEGIN
+                INSERT INTO {self.search_table} (rowid, content) VALUES (new.id, new.content);
+            END""")
+        self.writer.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {self.search_table}_delete AFTER DELETE ON {messages} WHEN {searchable.format('old')}
+            BEGIN
+                INSERT INTO {self.search_table} ({self.search_table}, rowid, content) VALUES ('delete', old.id, old.content);
+            END""")
+        self.writer.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {self.search_table}_update_delete AFTER UPDATE OF content ON {messages} WHEN {searchable.format('old')}
+            BEGIN
+                INSERT INTO {self.search_table} ({self.search_table}, rowid, content) VALUES ('delete', old.id, old.content);
+            END""")
+        self.writer.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {self.search_table}_update_insert AFTER UPDATE OF content ON {messages} WHEN {searchable.format('new')}
+            BEGIN
+                INSERT INTO {self.search_table} (rowid, content) VALUES (new.id, new.content);
+            END""")
+        self.writer.execute(f"INSERT INTO {self.search_table} ({self.search_table}) VALUES ('delete-all')")
+        self.writer.execute(f"INSERT INTO {self.search_table} (rowid, content) SELECT id, content FROM {messages} WHERE {searchable.format(messages)}")
+        self.writer.flush()
+        self.table_versions.set_version(self.search_table, self.__search_version__)
+        return True
+
+    def _initialize_conversations(self):
+        # The conversations table is a summary of the chat messages for each (account, remote party), which is
+        # kept up to date by triggers, in the same transaction as the messages insert, state update or delete.
+        messages = Message.sqlmeta.table
+        conversations = Conversation.sqlmeta.table
+        is_unread = "direction = 'incoming' AND state NOT IN ('deleted', 'displayed')"
+        log.info(f'== Building {conversations} table')
+        self.writer.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {messages}_conversation_insert AFTER INSERT ON {messages}
+            WHEN new.kind = 'chat' AND new.state != 'deleted'
+            BEGIN
+                INSERT INTO {conversations} (account_id, remote_uri, display_name, last_timestamp, message_count, unread)
+                VALUES (new.account_id, new.remote_uri,
+                        CASE WHEN new.direction = 'incoming' AND new.display_name != new.remote_uri THEN coalesce(new.display_name, '') ELSE '' END,
+                        new.timestamp, 1, new.direction = 'incoming' AND new.state != 'displayed')
+                ON CONFLICT (account_id, remote_uri) DO UPDATE SET
+                    display_name = CASE WHEN excluded.display_name != '' THEN excluded.display_name ELSE display_name END,
+                    last_timestamp = max(last_timestamp, excluded.last_timestamp),
+                    message_count = message_count + 1,
+                    unread = unread + excluded.unread;
+            END""")
+        for query in self._conversation_removal_triggers():
+            self.writer.execute(query)
+        self.writer.execute(f"""
+            INSERT OR REPLACE INTO {conversations} (account_id, remote_uri, display_name, last_timestamp, message_count, unread)
+            SELECT account_id, remote_uri,
+                coalesce((SELECT display_name FROM {messages} AS im
+                          WHERE im.remote_uri = am.remote_uri AND im.direction = 'incoming' AND im.account_id = am.account_id
+                          AND im.display_name != im.remote_uri AND im.display_name != ''
+                          ORDER BY im.timestamp DESC LIMIT 1), ''),
+                max(timestamp), count(*), sum({is_unread})
+            FROM {messages} AS am WHERE kind = 'chat' AND state != 'deleted'
+            GROUP BY account_id, remote_uri""")
+        self.writer.flush()
+
+    @staticmethod
+    def _conversation_removal_triggers():
+        # When the most recent message of a conversation is deleted, last_timestamp is taken from the remaining ones
+        messages = Message.sqlmeta.table
+        conversations = Conversation.sqlmeta.table
+        is_unread = "{0}.direction = 'incoming' AND {0}.state NOT IN ('deleted', 'displayed')"
+        last_timestamp = f"""coalesce((SELECT max(timestamp) FROM {messages}
+                          WHERE account_id = {{0}}.account_id AND remote_uri = {{0}}.remote_uri AND kind = 'chat' AND state != 'deleted'), last_timestamp)"""
+        return [f"""
+            CREATE TRIGGER IF NOT EXISTS {messages}_conversation_update AFTER UPDATE OF state ON {messages}
+            WHEN new.kind = 'chat' AND old.state != new.state
+            BEGIN
+                UPDATE {conversations} SET
+                    message_count = message_count + (new.state != 'deleted') - (old.state != 'deleted'),
+                    unread = unread + ({is_unread.format('new')}) - ({is_unread.format('old')}),
+                    last_timestamp = CASE
+                        WHEN new.state = 'deleted' AND old.timestamp >= last_timestamp THEN {last_timestamp.format('new')}
+                        WHEN old.state = 'deleted' THEN max(last_timestamp, new.timestamp)
+                        ELSE last_timestamp END
+                WHERE account_id = new.account_id AND remote_uri = new.remote_uri;
+                DELETE FROM {conversations} WHERE account_id = new.account_id AND remote_uri = new.remote_uri AND message_count <= 0;
+            END""", f"""
+            CREATE TRIGGER IF NOT EXISTS {messages}_conversation_delete AFTER DELETE ON {messages}
+            WHEN old.kind = 'chat' AND old.state != 'deleted'
+            BEGIN
+                UPDATE {conversations} SET
+                    message_count = message_count - 1,
+                    unread = unread - ({is_unread.format('old')}),
+                    last_timestamp = CASE WHEN old.timestamp >= last_timestamp THEN {last_timestamp.format('old')} ELSE last_timestamp END
+                WHERE account_id = old.account_id AND remote_uri = old.remote_uri;
+                DELETE FROM {conversations} WHERE account_id = old.account_id AND remote_uri = old.remote_uri AND message_count <= 0;
+            END"""]
+
+    def _upgrade_conversations(self):
+        # Version 2 recomputes last_timestamp when messages are removed, the one of the existing conversations is fixed
+        messages = Message.sqlmeta.table
+        conversations = Conversation.sqlmeta.table
+
+        def upgrade(cursor):
+            cursor.execute(f'DROP TRIGGER IF EXISTS {messages}_conversation_update')
+            cursor.execute(f'DROP TRIGGER IF EXISTS {messages}_conversation_delete')
+            for query in self._conversation_removal_triggers():
+                cursor.execute(query)
+            cursor.execute(f"""UPDATE {conversations} SET last_timestamp = coalesce((SELECT max(timestamp) FROM {messages} AS m
+                WHERE m.account_id = {conversations}.account_id AND m.remote_uri = {conversations}.remote_uri AND m.kind = 'chat' AND m.state != 'deleted'), last_timestamp)""")
+            return True
+
+        log.info(f'== Upgrading {conversations} table to version {self.__conversations_version__}')
+        if self.writer.run(upgrade):
+            self.table_versions.set_version(conversations, self.__conversations_version__)
+
+    def _initialize_calls(self):
+        # The calls are imported from the call history entries of the conversations and from the calls_history
+        # file used before, which also has the calls that were not added to any conversation.
+        log.info(f'== Building {Call.sqlmeta.table} table')
+        connection = self.db.getConnection()
+        try:
+            messages = connection.execute(f"select message_id, account_id, remote_uri, display_name, direction, timestamp, content from {Message.sqlmeta.table} where kind = 'call'").fetchall()
+        except sqlite3.Error as e:
+            log.warning(f'Failed to load the call history messages: {e}')
+            messages = []
+        finally:
+            self.db.releaseConnection(connection)
+
+        stored = set()
+        for message_id, account_id, remote_uri, display_name, direction, timestamp, content in messages:
+            try:
+                duration, reason, media = ast.literal_eval(content)
+            except (ValueError, SyntaxError, TypeError):
+                continue
+            duration = self._parse_call_duration(duration)
+            self._store_call(dict(account_id=account_id,
+                                  remote_uri=remote_uri,
+                                  display_name=display_name or '',
+                                  direction=direction,
+                                  media=media,
+                                  call_time=timestamp,
+                                  duration=duration,
+                                  reason=reason,
+                                  failed=int(duration is None),
+                                  message_id=message_id))
+            stored.add((account_id, remote_uri, timestamp))
+
+        try:
+            with open(ApplicationData.get('calls_history'), 'rb') as history_file:
+                entries = pickle.load(history_file)
+        except FileNotFoundError:
+            entries = []
+        except Exception as e:
+            log.warning(f'Failed to load the calls history file: {e}')
+            entries = []
+
+        for entry in entries:
+            if not isinstance(entry, HistoryEntry) or not isinstance(entry.call_time, datetime):
+                continue
+            values = self._call_values(entry)
+            if (values['account_id'], values['remote_uri'], values['call_time']) not in stored:
+                self._store_call(values)
+        self.writer.flush()
+
+    @staticmethod
+    def _parse_call_duration(text):
+        # the duration of the call history messages, as formatted by HistoryEntry.duration_text
+        match = re.search(r'(?:(\d+)h)?(\d+)\'(\d+)"', text) if isinstance(text, str) else None
+        if match is None:
+            return None
+        hours, minutes, seconds = match.groups()
+        return int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds)
+
     def _check_table_version(self):
-        db_table_version = self.table_versions.version(Message.sqlmeta.table)
-        if self.__version__ != db_table_version:
-            if db_table_version == 1:
-                query = f'CREATE UNIQUE INDEX messages_msg_id ON {Message.sqlmeta.table} (message_id, account_id, remote_uri)'
-                try:
-                    self.db.queryAll(query)
-                except (dberrors.IntegrityError, dberrors.DuplicateEntryError):
-                    fix_query = f'select message_id from {Message.sqlmeta.table} group by message_id having count(id) > 1'
-                    result = self.db.queryAll(fix_query)
-                    for row in result:
-                        messages = Message.selectBy(message_id=row[0])
-                        for message in list(messages)[1:]:
-                            message.destroySelf()
-                    try:
-                        self.db.queryAll(query)
-                    except (dberrors.IntegrityError, dberrors.DuplicateEntryError):
-                        pass
-                    else:
-                        self.table_versions.set_version(Message.sqlmeta.table, self.__version__)
-                else:
-                    self.table_versions.set_version(Message.sqlmeta.table, self.__version__)
-            elif db_table_version == 2:
-                query = "delete from messages where content_type='application/sylk-api-pgp-key-lookup'"
-                try:
-                    self.db.queryAll(query)
-                except (dberrors.IntegrityError, dberrors.DuplicateEntryError):
-                    pass
-                else:
-                    self.table_versions.set_version(Message.sqlmeta.table, self.__version__)
+        # All the upgrades from the stored version are applied in one transaction and the version is only stored if
+        # all of them succeeded, otherwise they are applied again on the next start.
+        table = Message.sqlmeta.table
+        db_table_version = self.table_versions.version(table)
+        if db_table_version == self.__version__:
+            return
+        if db_table_version is None:
+            # The table exists without a stored version, so it can be any of the older ones. The upgrades that only
+            # apply to a known version are skipped, the others only add what is missing.
+            log.info(f'== The version of the {table} table is unknown, upgrading it to version {self.__version__}')
+            from_version = 3
+        else:
+            log.info(f'== Upgrading {table} table from version {db_table_version} to version {self.__version__}')
+            from_version = db_table_version
+
+        def upgrade(cursor):
+            if from_version < 2:
+                self._upgrade_to_v2(cursor)
+            if from_version < 3:
+                cursor.execute(f"delete from {table} where content_type = 'application/sylk-api-pgp-key-lookup'")
+            if from_version < 4:
+                self._add_column(cursor, table, 'decrypted', "TEXT DEFAULT '0'")
+                self._add_column(cursor, table, 'decryption_error', "LONGTEXT DEFAULT ''")
+            if from_version < 5:
+                self._upgrade_to_v5(cursor)
+            if from_version < 6:
+                self._upgrade_to_v6(cursor)
+            return True
+
+        if self.writer.run(upgrade):
+            self.table_versions.set_version(table, self.__version__)
+        else:
+            log.error(f'Failed to upgrade the {table} table to version {self.__version__}, the upgrade will be retried on the next start')
 
-            elif db_table_version == 3:
+    @staticmethod
+    def _add_column(cursor, table, name, definition):
+        if name not in {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
 
-                query = "ALTER TABLE messages add column decrypted TEXT DEFAULT '0'"
-                try:
-                    self.db.queryAll(query)
-                except (dberrors.OperationalError):
-                    pass
+    @staticmethod
+    def _upgrade_to_v2(cursor):
+        table = Message.sqlmeta.table
+        index = f'CREATE UNIQUE INDEX IF NOT EXISTS messages_msg_id ON {table} (message_id, account_id, remote_uri)'
+        try:
+            cursor.execute(index)
+        except sqlite3.IntegrityError:
+            # only the first copy of the duplicated messages is kept
+            cursor.execute(f'delete from {table} where id not in (select min(id) from {table} group by message_id)')
+            cursor.execute(index)
 
-                query = "ALTER TABLE messages add column decryption_error LONGTEXT DEFAULT ''"
-                try:
-                    self.db.queryAll(query)
-                except (dberrors.OperationalError):
-                    pass
+    @classmethod
+    def _upgrade_to_v5(cls, cursor):
+        # Adds the kind column, which replaces the content_type LIKE filters, and the composite indexes
+        # used by the conversation, unread and contact queries
+        table = Message.sqlmeta.table
+        cls._add_column(cursor, table, 'kind', "TEXT DEFAULT 'chat'")
+        cursor.execute(f"""update {table} set kind = case
+            when content_type = 'application/blink-call-history' then 'call'
+            when content_type like '%pgp%' then 'pgp'
+            when content_type like '%sylk-api%' then 'api'
+            else 'chat' end
+            where kind = 'chat'""")
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_conversation_idx ON {table} (remote_uri, timestamp)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_remote_state_idx ON {table} (remote_uri, direction, state, timestamp)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_direction_state_idx ON {table} (direction, state, account_id, remote_uri)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_state_idx ON {table} (state)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_kind_idx ON {table} (kind, remote_uri, account_id, state, timestamp)')
 
-                self.table_versions.set_version(Message.sqlmeta.table, self.__version__)
+    @classmethod
+    def _upgrade_to_v6(cls, cursor):
+        # Adds the reference to the blob table, the payloads are moved there by _migrate_blobs
+        table = Message.sqlmeta.table
+        cls._add_column(cursor, table, 'content_hash', 'TEXT DEFAULT NULL')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_content_hash_idx ON {table} (content_hash)')
 
     def _get_enabled_account_filter(self, prefix=None):
         account_manager = AccountManager()
@@ -572,81 +1514,159 @@ class MessageHistory(object, metaclass=Singleton):
         if host.default_ip is None:
             return
 
-        messages = Message.selectBy(state='failed-local')
-        if len(list(messages)) > 0:
-            log.debug(f"==  {len(list(messages))} failed local messages from history")
-            NotificationCenter().post_notification('BlinkMessageHistoryFailedLocalFound', data=NotificationData(messages=list(messages)))
+        self.writer.flush()
+        try:
+            messages = self._select_messages("state = 'failed-local'")
+        except sqlite3.Error as e:
+            log.warning(f'Failed to load the failed local messages: {e}')
+            return
+        if messages:
+            messages.reverse()
+            log.debug(f"==  {len(messages)} failed local messages from history")
+            NotificationCenter().post_notification('BlinkMessageHistoryFailedLocalFound', data=NotificationData(messages=messages))
+
+    def _select_messages(self, condition, parameters=(), limit=None):
+        # Returns the matching messages as MessageRow instances, the most recent first
+        query = f"select {MessageRow.select_list()} from {Message.sqlmeta.table} where {condition} order by timestamp desc, id desc"
+        if limit is not None:
+            query += ' limit ?'
+            parameters = tuple(parameters) + (limit,)
+        connection = self.db.getConnection()
+        try:
+            messages = [MessageRow(*row) for row in connection.execute(query, parameters)]
+            calls = {message.message_id: message for message in messages if message.kind == 'call'}
+            message_ids = list(calls)
+            for index in range(0, len(message_ids), 500):
+                chunk = message_ids[index:index + 500]
+                query = f"select {', '.join(HistoryEntry.columns)} from {Call.sqlmeta.table} where message_id in ({', '.join('?' * len(chunk))})"
+                for row in connection.execute(query, chunk):
+                    entry = HistoryEntry.from_row(*row)
+                    calls[entry.message_id].call = entry
+            return messages
+        finally:
+            self.db.releaseConnection(connection)
+
+    @staticmethod
+    def _call_values(entry, message_id=None):
+        return dict(account_id=str(entry.account_id),
+                    remote_uri=entry.uri,
+                    display_name=entry.name or '',
+                    direction=entry.direction,
+                    media=entry.media,
+                    call_time=sql_timestamp(entry.call_time.astimezone(timezone.utc)),
+                    duration=int(entry.duration.total_seconds()) if entry.duration else None,
+                    reason=entry.reason or '',
+                    failed=int(entry.failed),
+                    message_id=message_id)
+
+    def _store_call(self, values, callback=None):
+        fields = ', '.join(values)
+        placeholders = ', '.join('?' * len(values))
+        self.writer.execute(f'insert into {Call.sqlmeta.table} ({fields}) values ({placeholders})', tuple(values.values()), callback)
+
+    def _store(self, values, callback=None, update_content=False):
+        # A message that is already stored is left as it is, or only gets the new content if update_content is true,
+        # in which case the callback is also called when the content changed
+        values = dict(self.message_defaults, **values)
+        values['kind'] = message_kind(values['content_type'])
+        blob = self._blob(values)
+        if blob is not None:
+            self.writer.execute(f'insert or ignore into {MessageBlob.sqlmeta.table} (hash, content, size) values (?, ?, ?)', blob)
+        fields = ', '.join(values)
+        placeholders = ', '.join('?' * len(values))
+        if update_content:
+            query = (f'insert into {Message.sqlmeta.table} ({fields}) values ({placeholders}) on conflict (message_id, account_id, remote_uri) '
+                     f'do update set content = excluded.content, content_hash = excluded.content_hash '
+                     f'where content is not excluded.content or content_hash is not excluded.content_hash')
+        else:
+            query = f'insert or ignore into {Message.sqlmeta.table} ({fields}) values ({placeholders})'
+        self.writer.execute(query, tuple(values.values()), callback)
+        self._remember_message(values['account_id'], values['message_id'])
+
+    def _remember_message(self, account_id, message_id):
+        key = account_id, message_id
+        self._missing_messages.pop(key, None)
+        self._known_messages[key] = None
+        self._known_messages.move_to_end(key)
+        if len(self._known_messages) > self.known_messages_size:
+            self._known_messages.popitem(last=False)
 
-    @classmethod
     @run_in_thread('db')
-    def add_call_history_entry(cls, entry, session):
-        timestamp_native = entry.call_time
-        timestamp_utc = timestamp_native.replace(tzinfo=timezone.utc)
-        timestamp_fixed = timestamp_utc - entry.call_time.utcoffset()
-        timestamp = parse(str(timestamp_fixed))
-        media = "audio"
+    def add_call(self, entry, session):
+        # Audio and video calls are also added to the conversation with the remote party
+        streams = [stream.type for stream in session.streams or session.proposed_streams or ()]
+        message_id = str(uuid.uuid4()) if 'audio' in streams or 'video' in streams else None
 
-        if not session.streams and not session.proposed_streams:
-            return
+        log.info(f"== Adding call history entry to storage: {entry.direction} {entry.media} to {entry.uri}")
+        self._store_call(self._call_values(entry, message_id))
 
-        streams = [stream.type for stream in session.streams] if session.streams else [stream.type for stream in session.proposed_streams]
-        if 'audio' not in streams and 'video' not in streams:
+        if message_id is None:
             return
 
-        media = 'video' if 'video' in streams else 'audio'
-        media = 'file-transfer' if 'file-transfer' in streams else media
-
-        log.info(f"== Adding call history message to storage: {entry.direction} {media} to {entry.uri}")
+        def message_stored(rowid):
+            try:
+                message = self._select_messages('id = ?', (rowid,))[0]
+            except (sqlite3.Error, IndexError):
+                return
+            NotificationCenter().post_notification('BlinkMessageHistoryCallHistoryDidStore', sender=session, data=NotificationData(message=message))
 
-        uri = str(entry.uri)
+        # the content is kept in the format used before the calls table for the older versions reading the same database
+        self._store(dict(remote_uri=entry.uri,
+                         display_name=entry.name,
+                         uri=str(entry.uri),
+                         content=str([entry.duration_text or 0, entry.reason.title() if entry.reason else '', entry.media]),
+                         content_type='application/blink-call-history',
+                         message_id=message_id,
+                         account_id=str(entry.account_id),
+                         direction=entry.direction,
+                         timestamp=sql_timestamp(entry.call_time.astimezone(timezone.utc)),
+                         state='displayed'),
+                    message_stored)
 
-        result = 0
-        if entry.duration:
-            seconds = int(entry.duration.total_seconds())
-            if seconds >= 3600:
-                result = """ (%dh%02d'%02d")""" % (seconds / 3600, (seconds % 3600) / 60, seconds % 60)
-            else:
-                result = """ (%d'%02d")""" % (seconds / 60, seconds % 60)
+    @run_in_thread('db')
+    def load_calls(self, count=20, before=None):
+        """
+        Load the count most recent calls, or the ones older than the (call_time, id)
+        cursor given in before. The calls are returned in chronological order.
+        """
+        self.writer.flush()
+        condition = ''
+        parameters = ()
+        if before is not None:
+            call_time, id = before
+            call_time = sql_timestamp(call_time.astimezone(timezone.utc))
+            condition = 'where call_time < ? or (call_time = ? and id < ?)'
+            parameters = (call_time, call_time, id)
+        query = f"select {', '.join(HistoryEntry.columns)} from {Call.sqlmeta.table} {condition} order by call_time desc, id desc limit ?"
+
+        connection = self.db.getConnection()
         try:
-            message = Message(remote_uri=entry.uri,
-                              display_name=entry.name,
-                              uri=uri,
-                              content=str([result, entry.reason.title() if entry.reason else '', media]),
-                              content_type='application/blink-call-history',
-                              message_id=str(uuid.uuid4()),
-                              account_id=str(entry.account_id),
-                              direction=entry.direction,
-                              timestamp=timestamp,
-                              decrypted='0',
-                              decryption_error='',
-                              disposition='',
-                              state='displayed')
-        except dberrors.DuplicateEntryError:
-            pass
-        else:
-            NotificationCenter().post_notification('BlinkMessageHistoryCallHistoryDidStore', sender=session, data=NotificationData(message=message))
+            calls = [HistoryEntry.from_row(*row) for row in connection.execute(query, parameters + (count,))]
+        except sqlite3.Error as e:
+            log.warning(f'Failed to load the call history: {e}')
+            return
+        finally:
+            self.db.releaseConnection(connection)
+
+        calls.reverse()
+        cursor = (calls[0].call_time, calls[0].id) if calls else before
+        NotificationCenter().post_notification('BlinkMessageHistoryCallsDidLoad', data=NotificationData(calls=calls, before=before, cursor=cursor, more=len(calls) == count))
 
-    @classmethod
     @run_in_thread('db')
-    def add_from_server_history(cls, account, remote_uri, message, state=None, encryption=None):
+    def add_from_server_history(self, account, remote_uri, message, state=None, encryption=None):
         if message.content.startswith('?OTRv'):
             return
 
         log.info(f"== Adding {message.direction} history message to storage: {message.id} {state} {remote_uri}")
 
-        match = cls.phone_number_re.match(remote_uri)
+        match = self.phone_number_re.match(remote_uri)
         if match:
             remote_uri = match.group('number')
 
         if message.direction == 'outgoing':
             display_name = message.sender.display_name
         else:
-            try:
-                contact = next(contact for contact in AddressbookManager().get_contacts() if remote_uri in (addr.uri for addr in contact.uris))
-            except StopIteration:
-                display_name = ''
-            else:
-                display_name = contact.name
+            display_name = self.addressbook.display_name(remote_uri)
 
         timestamp_native = message.timestamp
         timestamp_utc = timestamp_native.replace(tzinfo=timezone.utc)
@@ -664,30 +1684,131 @@ class MessageHistory(object, metaclass=Singleton):
         if not uri.startswith(('sip:', 'sips:')):
             uri = f'sip:{uri}'
 
-        try:
-            Message(remote_uri=remote_uri,
-                    display_name=display_name,
-                    uri=uri,
-                    content=message.content,
-                    content_type=message.content_type,
-                    message_id=message.id,
-                    account_id=str(account.id),
-                    direction=message.direction,
-                    timestamp=timestamp,
-                    decrypted='0',
-                    decryption_error='',
-                    disposition=str(message.disposition),
-                    **optional_fields)
-        except dberrors.DuplicateEntryError:
-            pass
-        else:
-            if message.content_type not in {IsComposingDocument.content_type, IMDNDocument.content_type, 'text/pgp-public-key', 'text/pgp-private-key', 'application/sylk-message-remove'}:
+        def message_stored(rowid):
+            if message.content_type not in self.silent_content_types:
                 notification_center = NotificationCenter()
                 notification_center.post_notification('BlinkMessageHistoryMessageDidStore', sender=account, data=NotificationData(remote_uri=remote_uri, state=state, direction=message.direction))
 
-    @classmethod
+        self._store(dict(remote_uri=remote_uri,
+                         display_name=display_name,
+                         uri=uri,
+                         content=message.content,
+                         content_type=message.content_type,
+                         message_id=message.id,
+                         account_id=str(account.id),
+                         direction=message.direction,
+                         timestamp=sql_timestamp(timestamp),
+                         disposition=str(message.disposition),
+                         **optional_fields),
+                    message_stored)
+
     @run_in_thread('db')
-    def add_from_session(cls, session, message, direction, state=None):
+    def add_from_server_history_batch(self, account, entries, cursor=None):
+        # entries have the same attributes as the arguments of add_from_server_history. The cursor identifies the page
+        # of the server history the entries came from and is posted back once they are stored.
+        stored = self._add_from_server_history_batch(account, entries)
+        if cursor is not None:
+            notification_center = NotificationCenter()
+            notification_center.post_notification('BlinkMessageHistoryServerHistoryDidStore' if stored else 'BlinkMessageHistoryServerHistoryDidFail', sender=account, data=NotificationData(cursor=cursor))
+
+    def _add_from_server_history_batch(self, account, entries):
+        if not entries:
+            return True
+
+        account_id = str(account.id)
+        rows = {}
+        blobs = {}
+        for entry in entries:
+            message = entry.message
+            if message.content.startswith('?OTRv') or message.id in rows:
+                continue
+
+            remote_uri = entry.remote_uri
+            match = self.phone_number_re.match(remote_uri)
+            if match:
+                remote_uri = match.group('number')
+
+            if message.direction == 'outgoing':
+                display_name = message.sender.display_name
+            else:
+                display_name = self.addressbook.display_name(remote_uri)
+
+            timestamp = message.timestamp.replace(tzinfo=timezone.utc) - message.timestamp.utcoffset()
+
+            uri = str(message.sender.uri)
+            if not uri.startswith(('sip:', 'sips:')):
+                uri = f'sip:{uri}'
+
+            values = dict(self.message_defaults,
+                          message_id=message.id,
+                          account_id=account_id,
+                          remote_uri=remote_uri,
+                          display_name=display_name,
+                          uri=uri,
+                          timestamp=sql_timestamp(timestamp),
+                          direction=message.direction,
+                          content=message.content,
+                          content_type=message.content_type,
+                          disposition=str(message.disposition),
+                          kind=message_kind(message.content_type))
+            if entry.state is not None:
+                values['state'] = entry.state
+            if entry.encryption is not None:
+                values['encryption_type'] = str([f'{entry.encryption}'])
+            rows[message.id] = values
+            blob = self._blob(values)
+            if blob is not None:
+                blobs[blob[0]] = blob
+
+        # drop the messages stored by a previous synchronization, so that only the new ones are notified
+        self.writer.flush()
+        message_ids = list(rows)
+        connection = self.db.getConnection()
+        try:
+            for index in range(0, len(message_ids), 500):
+                chunk = message_ids[index:index + 500]
+                query = f"select message_id from {Message.sqlmeta.table} where account_id = ? and message_id in ({', '.join('?' * len(chunk))})"
+                for message_id, in connection.execute(query, [account_id] + chunk):
+                    rows.pop(message_id, None)
+        except sqlite3.Error as e:
+            log.warning(f'Failed to look up stored history messages: {e}')
+        finally:
+            self.db.releaseConnection(connection)
+
+        if not rows:
+            return True
+
+        fields = tuple(next(iter(rows.values())))
+        query = f"insert or ignore into {Message.sqlmeta.table} ({', '.join(fields)}) values ({', '.join('?' * len(fields))})"
+
+        def store(cursor):
+            cursor.executemany(f'insert or ignore into {MessageBlob.sqlmeta.table} (hash, content, size) values (?, ?, ?)', [blob for blob in blobs.values() if blob[0] in used_blobs])
+            cursor.executemany(query, [tuple(values[field] for field in fields) for values in rows.values()])
+            return cursor.rowcount
+
+        used_blobs = {values['content_hash'] for values in rows.values()}
+        if self.writer.run(store) is None:
+            return False
+
+        log.info(f'== Added {len(rows)} history messages of {account.id} to storage')
+        for message_id in rows:
+            self._remember_message(account_id, message_id)
+
+        conversations = {}
+        for values in rows.values():
+            if values['content_type'] not in self.silent_content_types:
+                conversation = conversations.setdefault(values['remote_uri'], NotificationData(remote_uri=values['remote_uri'], count=0))
+                conversation.count += 1
+                conversation.state = values['state']
+                conversation.direction = values['direction']
+
+        notification_center = NotificationCenter()
+        for data in conversations.values():
+            notification_center.post_notification('BlinkMessageHistoryMessageDidStore', sender=account, data=data)
+        return True
+
+    @run_in_thread('db')
+    def add_from_session(self, session, message, direction, state=None):
         if message.content.startswith('?OTRv'):
             return
 
@@ -701,19 +1822,18 @@ class MessageHistory(object, metaclass=Singleton):
             domain = domain.decode() if isinstance(domain, bytes) else domain
 
             remote_uri = '%s@%s' % (user, domain)
-            match = cls.phone_number_re.match(remote_uri)
+            match = self.phone_number_re.match(remote_uri)
             if match:
                 remote_uri = match.group('number')
 
         if direction == 'outgoing':
             display_name = message.sender.display_name
         else:
-            try:
-                contact = next(contact for contact in AddressbookManager().get_contacts() if remote_uri in (addr.uri for addr in contact.uris))
-            except StopIteration:
-                display_name = message.sender.display_name
+            contact = self.addressbook.find(remote_uri)
+            if contact is not None and contact.name != remote_uri:
+                display_name = contact.name
             else:
-                display_name = contact.name if contact.name != remote_uri else message.sender.display_name
+                display_name = message.sender.display_name
 
         timestamp_native = message.timestamp
         timestamp_utc = timestamp_native.replace(tzinfo=timezone.utc)
@@ -736,68 +1856,87 @@ class MessageHistory(object, metaclass=Singleton):
             message_info = session.info.streams.messages
             if message_info.encryption is not None and message.is_secure:
                 optional_fields['encryption_type'] = str([f'{message_info.encryption}'])
-        try:
-            Message(remote_uri=remote_uri,
-                    display_name=display_name,
-                    uri=str(message.sender.uri),
-                    content=message.content,
-                    content_type=message.content_type,
-                    message_id=message.id,
-                    account_id=str(session.account.id),
-                    direction=direction,
-                    timestamp=timestamp,
-                    decrypted='0',
-                    decryption_error='',
-                    disposition=str(message.disposition),
-                    **optional_fields)
-        except dberrors.DuplicateEntryError:
-            try:
-                dbmessage = Message.selectBy(message_id=message.id)[0]
-            except IndexError:
-                pass
-            else:
-                if message.content != dbmessage.content:
-                    dbmessage.content = message.content
-        else:
+
+        account = session.account
+
+        def message_stored(rowid):
             if direction == 'outgoing':
                 log.info(f"Message {message.id} to {remote_uri} stored")
             else:
                 log.info(f"Message {message.id} from {remote_uri} stored")
 
-            if message.content_type not in {IsComposingDocument.content_type, IMDNDocument.content_type, 'text/pgp-public-key', 'text/pgp-private-key', 'application/sylk-message-remove'}:
+            if message.content_type not in self.silent_content_types:
                 notification_center = NotificationCenter()
-                notification_center.post_notification('BlinkMessageHistoryMessageDidStore', sender=session.account, data=NotificationData(remote_uri=remote_uri, state=state, direction=direction))
+                notification_center.post_notification('BlinkMessageHistoryMessageDidStore', sender=account, data=NotificationData(remote_uri=remote_uri, state=state, direction=direction))
+
+        self._store(dict(remote_uri=remote_uri,
+                         display_name=display_name,
+                         uri=str(message.sender.uri),
+                         content=message.content,
+                         content_type=message.content_type,
+                         message_id=message.id,
+                         account_id=str(account.id),
+                         direction=direction,
+                         timestamp=sql_timestamp(timestamp),
+                         disposition=str(message.disposition),
+                         **optional_fields),
+                    message_stored, update_content=True)
 
     @run_in_thread('db')
     def update_message(self, notification):
         message = notification.data
+        self.update_content(message.id, message.content)
 
-        db_message = Message.selectBy(message_id=message.id)[0]
-        if db_message.content != message.content:
-            db_message.content = message.content
+    @run_in_thread('db')
+    def update_content(self, id, content):
+        # the content of a message kept in the blob table is compared through its hash
+        content_hash = hashlib.sha256(content.encode()).hexdigest()
+        self.writer.execute(f'update {Message.sqlmeta.table} set content = ?, content_hash = null where message_id = ? and content is not ? and content_hash is not ?',
+                            (content, id, content, content_hash))
 
     @run_in_thread('db')
     def update(self, id, state):
-        messages = Message.selectBy(message_id=id)
-        for message in messages:
-            if message.direction == 'outgoing' and state == 'received':
-                continue
+        log.debug(f'Message {id} state will change to {state}')
+        self.writer.update_state(id, state)
 
-            if (state == 'deleted' or message.state != 'displayed') and message.state != state:
-                if message.direction == 'outgoing':
-                    log.info(f'Message {id} to {message.remote_uri} state changed {message.state} -> {state}')
-                else:
-                    log.info(f'Message {id} from {message.remote_uri} state changed {message.state} -> {state}')
-                message.state = state
+    @run_in_thread('db')
+    def find_message(self, account, id):
+        # Posts BlinkMessageHistoryMessageWasNotFound if the account has no message with this id. The messages that
+        # were stored or found recently are known without a query, including the ones whose writes are still queued,
+        # so the query is a plain read that does not flush the writer. A message that was not found is only reported
+        # once, the other references to it are ignored until it is stored.
+        account_id = str(account.id)
+        if (account_id, id) in self._known_messages:
+            self._known_messages.move_to_end((account_id, id))
+            return
+        if (account_id, id) in self._missing_messages:
+            return
+        connection = self.db.getConnection()
+        try:
+            found = connection.execute(f'select 1 from {Message.sqlmeta.table} where message_id = ? and account_id = ? limit 1', (id, account_id)).fetchone() is not None
+        except sqlite3.Error as e:
+            log.warning(f'Failed to look up message {id}: {e}')
+            return
+        finally:
+            self.db.releaseConnection(connection)
+        if found:
+            self._remember_message(account_id, id)
+        else:
+            self._missing_messages[account_id, id] = None
+            if len(self._missing_messages) > self.missing_messages_size:
+                self._missing_messages.popitem(last=False)
+            notification_center = NotificationCenter()
+            notification_center.post_notification('BlinkMessageHistoryMessageWasNotFound', sender=account, data=NotificationData(id=id))
 
     @run_in_thread('db')
     def update_displayed_for_uri(self, remote_uri):
+        self.writer.flush()
         query = f"""update messages set state = 'displayed' where direction = 'incoming'
         and remote_uri = {Message.sqlrepr(remote_uri)} and state != 'displayed'
         """
         try:
-            result = self.db.queryAll(query)
-        except Exception as e:
+            self.db.queryAll(query)
+        except Exception:
             pass
         else:
             pass
@@ -805,14 +1944,15 @@ class MessageHistory(object, metaclass=Singleton):
 
     @run_in_thread('db')
     def reset_decryption(self, account):
+        self.writer.flush()
         query = f"""
             update messages set decrypted = '3', decryption_error = ''
             where account_id = {Message.sqlrepr(account)} and decrypted = '2'
             """
         try:
-            result = self.db.queryAll(query)
+            self.db.queryAll(query)
         except Exception as e:
-            print('SQL Error: %s' % str(e))
+            log.warning(f'Failed to reset the decryption state of the messages of {account}: {e}')
         else:
             notification_center = NotificationCenter()
             notification_center.post_notification('BlinkMessageHistoryMustReload', data=NotificationData(account=account))
@@ -830,192 +1970,482 @@ class MessageHistory(object, metaclass=Singleton):
             message_id = message.id
 
         if message_info.encryption is not None and message.is_secure:
-            db_messages = Message.selectBy(message_id=message_id)
-            for db_message in db_messages:
-                encryption_type = str(f'{message_info.encryption}')
-                if db_message.encryption_type != encryption_type:
-                    db_message.encryption_type = encryption_type
-
-                # 0 not encrypted message
-                # 1 decrypted incoming messages
-                # 2 failed to decrypt incoming messages
-                decrypted_sql = '1' if decrypted else '2'
-                if decrypted is not None:
-                    # log.debug(f'Update {message.direction} {message_id} decrypted to {decrypted_sql}')
-                    db_message.decrypted = decrypted_sql
-                    if not decrypted:
-                        db_message.decryption_error = notification.data.error
+            encryption_type = str(f'{message_info.encryption}')
+            self.writer.execute(f'update {Message.sqlmeta.table} set encryption_type = ? where message_id = ? and encryption_type != ?', (encryption_type, message_id, encryption_type))
+
+            # 0 not encrypted message
+            # 1 decrypted incoming messages
+            # 2 failed to decrypt incoming messages
+            if decrypted:
+                self.writer.execute(f"update {Message.sqlmeta.table} set decrypted = '1' where message_id = ?", (message_id,))
+            elif decrypted is not None:
+                self.writer.execute(f"update {Message.sqlmeta.table} set decrypted = '2', decryption_error = ? where message_id = ?", (notification.data.error, message_id))
 
     @run_in_thread('db')
-    def load(self, uri, session, entries=100):
+    def load(self, uri, session, entries=100, before=None):
+        """
+        Load a page of at most entries messages, older than the (timestamp, id)
+        cursor given in before, or the most recent ones if before is None.
+        The cursor for the next (older) page is returned in the notification.
+        """
+        self.writer.flush()
         notification_center = NotificationCenter()
         remote_uri = '%s@local' % session.remote_instance_id if session.remote_instance_id else uri
+        condition = "remote_uri = ? and state != 'deleted'"
+        parameters = (remote_uri,)
+        if before is not None:
+            timestamp, id = before
+            condition += ' and (timestamp < ? or (timestamp = ? and id < ?))'
+            parameters += (sql_timestamp(timestamp), sql_timestamp(timestamp), id)
         try:
-            result = Message.select(AND(Message.q.remote_uri == remote_uri, Message.q.state != 'deleted')).orderBy('timestamp')[-entries:]
-        except Exception as e:
-            notification_center.post_notification('BlinkMessageHistoryLoadDidFail', sender=session, data=NotificationData(uri=uri))
+            result = self._select_messages(condition, parameters, limit=entries)
+        except sqlite3.Error:
+            notification_center.post_notification('BlinkMessageHistoryLoadDidFail', sender=session, data=NotificationData(uri=uri, before=before))
             return
-        log.debug(f"== Loaded {len(list(result))} messages for {remote_uri} from history")
-        notification_center.post_notification('BlinkMessageHistoryLoadDidSucceed', sender=session, data=NotificationData(messages=list(result), uri=uri))
+        result.reverse()
+        cursor = (result[0].timestamp, result[0].id) if result else before
+        log.debug(f"== Loaded {len(result)} messages for {remote_uri} from history")
+        notification_center.post_notification('BlinkMessageHistoryLoadDidSucceed', sender=session, data=NotificationData(messages=result, uri=uri, before=before, cursor=cursor, more=len(result) == entries))
 
     @run_in_thread('db')
     def reload_pending_encrypted(self, uri, session, entries=100):
+        self.writer.flush()
         notification_center = NotificationCenter()
         remote_uri = '%s@local' % session.remote_instance_id if session.remote_instance_id else uri
         try:
-            result = Message.select(AND(Message.q.remote_uri == remote_uri, Message.q.state != 'deleted', Message.q.decrypted == '3')).orderBy('timestamp')[-entries:]
-        except Exception as e:
+            result = self._select_messages("remote_uri = ? and state != 'deleted' and decrypted = '3'", (remote_uri,), limit=entries)
+        except sqlite3.Error:
             return
-        log.debug(f"== ReLoaded {len(list(result))} messages for {remote_uri} from history")
-        notification_center.post_notification('BlinkMessageHistoryLoadDidSucceed', sender=session, data=NotificationData(messages=list(result), uri=uri))
+        result.reverse()
+        log.debug(f"== ReLoaded {len(result)} messages for {remote_uri} from history")
+        notification_center.post_notification('BlinkMessageHistoryLoadDidSucceed', sender=session, data=NotificationData(messages=result, uri=uri, before=None, cursor=None, more=None))
 
     @run_in_thread('db')
     def get_last_contacts(self, number=25, unread=False):
+        self.writer.flush()
         log.info(f'== Getting last {number} contacts with messages unread={unread}')
 
-        if unread:
-            query = f"""
-                select im.display_name, am.remote_uri, max(am.timestamp) from messages as am
-                left join (select display_name, remote_uri from messages where direction="incoming" group by remote_uri) as im
-                on am.remote_uri = im.remote_uri
-                where
-                am.content_type not like "%pgp%"
-                and am.direction="incoming"
-                and am.content_type not like "%sylk-api%"
-                and am.content_type != "application/blink-call-history"
-                and am.state not in ('deleted', 'displayed')
-                and {self._get_enabled_account_filter('am')}
-                group by am.remote_uri order by am.timestamp desc"""
-        else:
-            query = f"""
-                select im.display_name, am.remote_uri, max(am.timestamp) from messages as am
-                left join (select display_name, remote_uri from messages where direction="incoming" group by remote_uri) as im
-                on am.remote_uri = im.remote_uri
-                where
-                am.content_type not like "%pgp%"
-                and am.content_type not like "%sylk-api%"
-                and am.content_type != "application/blink-call-history"
-                and am.state != 'deleted'
-                and {self._get_enabled_account_filter('am')}
-                group by am.remote_uri order by am.timestamp desc limit {Message.sqlrepr(number)}"""
+        # a remote party can have a conversation with each account, the display name is the one of the most recent
+        query = f"""
+            select display_name, remote_uri, last_timestamp from (
+                select display_name, remote_uri, last_timestamp, row_number() over (partition by remote_uri order by last_timestamp desc) as position
+                from {Conversation.sqlmeta.table}
+                where {'unread > 0 and ' if unread else ''}{self._get_enabled_account_filter()})
+            where position = 1 order by last_timestamp desc"""
+        if not unread:
+            query += f" limit {Conversation.sqlrepr(number)}"
 
         notification_center = NotificationCenter()
         try:
-            result = self.db.queryAll(query)
-        except Exception as e:
+            results = self.db.queryAll(query)
+        except Exception:
             return
 
-        #log.debug(f"== Contacts fetched: {len(list(result))}")
-        #result = [(display_name, uri) for (display_name, uri, timestamp) in result]
-        #results = list(result)
-
-        results = []
-        for r in result:
-            # find the display name sent by remote party
-            display_name = r[0]
-            uri = r[1]
-            timestamp = r[2]
-            query = f"""select display_name from messages
-                where remote_uri = '{uri}'
-                and direction = 'incoming' and remote_uri != display_name"""
-            try:
-                c = self.db.queryAll(query)
-            except Exception as e:
-                pass
-            else:
-                if len(list(c)) > 0:
-                    display_name = list(c)[0][0]
+        notification_center.post_notification('BlinkMessageHistoryLastContactsDidSucceed', data=NotificationData(contacts=results))
 
-            results.append((display_name, uri, timestamp))
+    @staticmethod
+    def _search_expression(text):
+        # every word must match, the last one as a prefix, so results can be shown while typing
+        terms = ['"%s"' % term.replace('"', '""') for term in text.split()]
+        if terms:
+            terms[-1] += '*'
+        return ' '.join(terms)
 
-        results = sorted(results, key=lambda tup: tup[2])
-        results.reverse()
-        notification_center.post_notification('BlinkMessageHistoryLastContactsDidSucceed', data=NotificationData(contacts=results))
+    @run_in_thread('db')
+    def search(self, query, account=None, remote_uri=None, limit=50, cursor=None):
+        """
+        Search the text of the chat messages, returning the best matches first. The
+        cursor returned in the notification is used to fetch the next page of results.
+        """
+        self.writer.flush()
+        notification_center = NotificationCenter()
+        expression = self._search_expression(query)
+        if not self.search_available or not expression:
+            notification_center.post_notification('BlinkMessageHistorySearchDidFail', data=NotificationData(query=query, account=account, remote_uri=remote_uri))
+            return
+
+        offset = cursor or 0
+        conditions = [f'{self.search_table} match ?', "m.state != 'deleted'"]
+        parameters = [expression]
+        if account is not None:
+            conditions.append('m.account_id = ?')
+            parameters.append(str(account.id))
+        if remote_uri is not None:
+            conditions.append('m.remote_uri = ?')
+            parameters.append(remote_uri)
+        parameters.extend([limit, offset])
+
+        search_query = f"""
+            select m.message_id, m.account_id, m.remote_uri, m.display_name, m.direction, m.timestamp,
+                snippet({self.search_table}, 0, '<b>', '</b>', '...', 16), bm25({self.search_table})
+            from {self.search_table} join {Message.sqlmeta.table} as m on m.id = {self.search_table}.rowid
+            where {' and '.join(conditions)}
+            order by rank limit ? offset ?"""
+
+        connection = self.db.getConnection()
+        try:
+            results = [MessageSearchResult(*row) for row in connection.execute(search_query, parameters)]
+        except sqlite3.Error as e:
+            log.warning(f'Message history search for {query!r} failed: {e}')
+            notification_center.post_notification('BlinkMessageHistorySearchDidFail', data=NotificationData(query=query, account=account, remote_uri=remote_uri))
+            return
+        finally:
+            self.db.releaseConnection(connection)
+
+        next_cursor = offset + len(results) if len(results) == limit else None
+        notification_center.post_notification('BlinkMessageHistorySearchDidSucceed', data=NotificationData(query=query, account=account, remote_uri=remote_uri, results=results, cursor=next_cursor))
+
+    @run_in_thread('db')
+    def export(self, path, account=None, remote_uri=None):
+        """
+        Write the messages, only the ones of the given account and/or remote party
+        if specified, to path as gzip compressed JSON Lines, one message per line.
+        The messages are read in chunks, so the other queries are not blocked.
+        """
+        self.writer.flush()
+        conditions = ['id > ?']
+        parameters = []
+        if account is not None:
+            conditions.append('account_id = ?')
+            parameters.append(str(account.id))
+        if remote_uri is not None:
+            conditions.append('remote_uri = ?')
+            parameters.append(remote_uri)
+        query = f"select {MessageRow.select_list()} from {Message.sqlmeta.table} where {' and '.join(conditions)} order by id limit ?"
+        try:
+            file = gzip.open(path, 'wt', encoding='utf-8')
+        except OSError as e:
+            log.warning(f'Failed to export message history to {path}: {e}')
+            NotificationCenter().post_notification('BlinkMessageHistoryExportDidFail', data=NotificationData(path=path, error=str(e)))
+            return
+        log.info(f'== Exporting message history to {path}')
+        self._export(file, path, query, parameters)
+
+    @run_in_thread('db')
+    def _export(self, file, path, query, parameters, last_id=0, count=0):
+        columns = MessageRow.columns[1:]
+        rows = 0
+        connection = self.db.getConnection()
+        try:
+            for row in connection.execute(query, [last_id, *parameters, self.export_chunk_size]):
+                last_id = row[0]
+                file.write(json.dumps(dict(zip(columns, row[1:])), ensure_ascii=False))
+                file.write('\n')
+                rows += 1
+        except (sqlite3.Error, OSError) as e:
+            file.close()
+            log.warning(f'Failed to export message history to {path}: {e}')
+            NotificationCenter().post_notification('BlinkMessageHistoryExportDidFail', data=NotificationData(path=path, error=str(e)))
+            return
+        finally:
+            self.db.releaseConnection(connection)
+        count += rows
+        if rows == self.export_chunk_size:
+            # a direct call would run synchronously in the db thread, this one is queued after the pending calls
+            call_in_gui_thread(self._export, file, path, query, parameters, last_id, count)
+            return
+        file.close()
+        log.info(f'== Exported {count} messages to {path}')
+        NotificationCenter().post_notification('BlinkMessageHistoryExportDidSucceed', data=NotificationData(path=path, count=count))
+
+    @run_in_thread('db')
+    def import_(self, path):
+        """
+        Add the messages from a file written by export. The messages that are
+        already stored, with the same message_id, account_id and remote_uri,
+        are skipped.
+        """
+        try:
+            file = gzip.open(path, 'rt', encoding='utf-8')
+        except OSError as e:
+            log.warning(f'Failed to import message history from {path}: {e}')
+            NotificationCenter().post_notification('BlinkMessageHistoryImportDidFail', data=NotificationData(path=path, error=str(e)))
+            return
+        log.info(f'== Importing message history from {path}')
+        self._import(file, path)
+
+    @run_in_thread('db')
+    def _import(self, file, path, added=0, skipped=0):
+        columns = MessageRow.columns[1:] + ('content_hash',)
+        rows = []
+        blobs = {}
+        lines = 0
+        try:
+            for line in islice(file, self.import_chunk_size):
+                lines += 1
+                try:
+                    record = json.loads(line)
+                    values = dict(self.message_defaults, **{column: record[column] for column in columns[:-2] if column in record})
+                    values['kind'] = message_kind(values['content_type'])
+                    blob = self._blob(values)
+                    row = tuple(values[column] for column in columns)
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    skipped += 1
+                    continue
+                if blob is not None:
+                    blobs[blob[0]] = blob
+                rows.append(row)
+        except (OSError, EOFError) as e:
+            file.close()
+            log.warning(f'Failed to import message history from {path}: {e}')
+            NotificationCenter().post_notification('BlinkMessageHistoryImportDidFail', data=NotificationData(path=path, error=str(e)))
+            return
+
+        def store(cursor):
+            messages = Message.sqlmeta.table
+            cursor.executemany(f'insert or ignore into {MessageBlob.sqlmeta.table} (hash, content, size) values (?, ?, ?)', blobs.values())
+            cursor.executemany(f"insert or ignore into {messages} ({', '.join(columns)}) values ({', '.join('?' * len(columns))})", rows)
+            stored = cursor.rowcount
+            # the blobs of the messages that were already stored and reference another blob are not kept
+            cursor.executemany(f'delete from {MessageBlob.sqlmeta.table} where hash = ? and not exists (select 1 from {messages} where content_hash = ?)', [(hash, hash) for hash in blobs])
+            return stored
+
+        if rows:
+            stored = self.writer.run(store)
+            if stored is None:
+                file.close()
+                NotificationCenter().post_notification('BlinkMessageHistoryImportDidFail', data=NotificationData(path=path, error='database error'))
+                return
+            added += stored
+            skipped += len(rows) - stored
+        if lines == self.import_chunk_size:
+            call_in_gui_thread(self._import, file, path, added, skipped)
+            return
+        file.close()
+        log.info(f'== Imported {added} messages from {path}, {skipped} skipped')
+        NotificationCenter().post_notification('BlinkMessageHistoryImportDidSucceed', data=NotificationData(path=path, added=added, skipped=skipped))
+        self.get_unread_messages()
+        self.get_all_contacts()
 
     @run_in_thread('db')
     def get_unread_messages(self):
-        query = f"""select remote_uri, count(*) as c from messages where state != 'displayed' and direction='incoming' and {self._get_enabled_account_filter()} group by remote_uri"""
+        # The counts of all the accounts, UnreadMessages only shows the ones of the enabled accounts
+        self.writer.flush()
+        query_time = monotonic()
+        query = f"""select account_id, remote_uri, unread from {Conversation.sqlmeta.table} where unread > 0"""
         try:
             result = self.db.queryAll(query)
-        except Exception as e:
+        except Exception:
             return
 
         unread_messages = {}
-        for (remote_uri, c) in result:
-            unread_messages[remote_uri] = c
+        for (account_id, remote_uri, count) in result:
+            unread_messages.setdefault(account_id, {})[remote_uri] = count
 
         notification_center = NotificationCenter()
-        notification_center.post_notification('BlinkMessageHistoryUnreadMessagesDidLoad', data=NotificationData(unread_messages=unread_messages))
+        notification_center.post_notification('BlinkMessageHistoryUnreadMessagesDidLoad', data=NotificationData(unread_messages=unread_messages, query_time=query_time))
 
     @run_in_thread('db')
     def get_all_contacts(self):
+        self.writer.flush()
         log.debug('== Getting all contacts with messages')
 
         query = f"""
-            select im.display_name, am.remote_uri from messages as am
-            left join (select display_name, remote_uri from messages where direction='incoming' group by remote_uri) as im
-            on (am.remote_uri = im.remote_uri)
-            where
-            am.content_type not like '%pgp%'
-            and not am.content_type like '%sylk-api%'
-            and am.content_type != "application/blink-call-history"
-            and am.state != 'deleted'
-            and {self._get_enabled_account_filter('am')}
-            group by am.remote_uri
-            """
+            select display_name, remote_uri from (
+                select display_name, remote_uri, row_number() over (partition by remote_uri order by last_timestamp desc) as position
+                from {Conversation.sqlmeta.table}
+                where {self._get_enabled_account_filter()})
+            where position = 1"""
 
         notification_center = NotificationCenter()
         try:
-            result = self.db.queryAll(query)
-        except Exception as e:
+            results = self.db.queryAll(query)
+        except Exception:
             return
 
-        results = []
-        for r in result:
-            # find the display name sent by remote party
-            display_name = r[0]
-            uri = r[1]
-            query = f"""select display_name from messages
-                where remote_uri = '{uri}'
-                and direction = 'incoming' and remote_uri != display_name"""
-            try:
-                c = self.db.queryAll(query)
-            except Exception as e:
-                pass
-            else:
-                if len(list(c)) > 0:
-                    display_name = list(c)[0][0]
-
-            results.append((display_name, uri))
-
-        log.debug(f"== Contacts fetched: {len(list(result))}")
+        log.debug(f"== Contacts fetched: {len(results)}")
         notification_center.post_notification('BlinkMessageHistoryAllContactsDidSucceed', data=NotificationData(contacts=results))
 
     @run_in_thread('db')
     def remove(self, account):
+        self.writer.flush()
         Message.deleteBy(account=account)
 
     @run_in_thread('db')
     def remove_contact_messages(self, account, contact, timestamp=None, session=None):
         if not timestamp:
             timestamp = ISOTimestamp.now()
-
-        timestamp_native = timestamp
-        timestamp_utc = timestamp_native.replace(tzinfo=timezone.utc)
-        timestamp_fixed = timestamp_utc - timestamp.utcoffset()
-        timestamp = parse(str(timestamp_fixed))
+        timestamp = sql_timestamp(timestamp.astimezone(timezone.utc))
 
         log.info(f'== Removing conversation between {account.id} <-> {contact} < {timestamp}')
-        result = Message.selectBy(remote_uri=contact, account_id=str(account.id))
-        for message in result:
-            if message.timestamp.replace(tzinfo=timezone.utc) <= timestamp:
-                message.destroySelf()
-        if session:
+        self._remove_contact_messages(str(account.id), contact, timestamp, session)
+
+    @run_in_thread('db')
+    def _remove_contact_messages(self, account_id, contact, timestamp, session):
+        # Each chunk is deleted in its own transaction, so that removing a large conversation doesn't block
+        # the other queries until it is done.
+        table = Message.sqlmeta.table
+        query = f"""delete from {table} where id in
+            (select id from {table} where account_id = ? and remote_uri = ? and timestamp <= ? limit ?)"""
+        removed = self.writer.execute_many(query, [(account_id, contact, timestamp, self.removal_chunk_size)])
+        if removed == self.removal_chunk_size:
+            # a direct call would run synchronously in the db thread, this one is queued after the pending calls
+            call_in_gui_thread(self._remove_contact_messages, account_id, contact, timestamp, session)
+        elif session:
             self.load(contact, session)
 
+    @run_in_thread('db')
+    def apply_retention(self):
+        # Removes the messages past the retention limits of their account or contact in small chunks,
+        # with a pause between them, then gives the free pages back to the file system.
+        if self._retention_tasks:
+            return
+
+        def cutoff(days):
+            return sql_timestamp(datetime.now(timezone.utc) - timedelta(days=days))
+
+        # the contact URIs are matched with the remote_uri of the conversations the same way as the display names
+        contact_days = {}
+        contact_messages = {}
+        for contact in AddressbookManager().get_contacts():
+            for address in contact.uris:
+                uri = AddressbookIndex.normalize(address.uri)
+                if contact.history_retention_days is not None:
+                    contact_days[uri] = contact.history_retention_days
+                if contact.history_retention_messages is not None:
+                    contact_messages[uri] = contact.history_retention_messages
+
+        tasks = []
+        for account in AccountManager().iter_accounts():
+            account_id = str(account.id)
+            settings = account.sms
+            archive = settings.history_archive
+            query = f"select remote_uri, message_count from {Conversation.sqlmeta.table} where account_id = {Conversation.sqlrepr(account_id)}"
+            try:
+                conversations = self.db.queryAll(query)
+            except Exception:
+                conversations = []
+
+            days = {}
+            limits = {}
+            for remote_uri, message_count in conversations:
+                uri = AddressbookIndex.normalize(remote_uri)
+                if uri in contact_days:
+                    days[remote_uri] = contact_days[uri]
+                limit = contact_messages.get(uri, settings.history_retention_messages)
+                if limit and message_count > limit:
+                    limits[remote_uri] = limit
+
+            if settings.history_tombstone_days:
+                tasks.append(("account_id = ? and state = 'deleted' and timestamp < ?", (account_id, cutoff(settings.history_tombstone_days)), False))
+            if settings.history_retention_days:
+                uris = list(days)
+                tasks.append((f"account_id = ? and timestamp < ? and remote_uri not in ({', '.join('?' * len(uris))})", (account_id, cutoff(settings.history_retention_days), *uris), archive))
+            tasks.extend(('account_id = ? and remote_uri = ? and timestamp < ?', (account_id, uri, cutoff(retention_days)), archive) for uri, retention_days in days.items() if retention_days)
+
+            # the messages are counted the same way as in message_count, the other ones are only removed by the rules above
+            condition = f"""id in (select id from {Message.sqlmeta.table} where account_id = ? and remote_uri = ? and kind = 'chat' and state != 'deleted'
+                order by timestamp desc, id desc limit -1 offset ?)"""
+            tasks.extend((condition, (account_id, uri, limit), archive) for uri, limit in limits.items())
+
+        if not tasks:
+            return
+        if any(archive for condition, parameters, archive in tasks) and not self._attach_archive():
+            tasks = [task for task in tasks if not task[2]]
+
+        log.info(f'== Applying {len(tasks)} message history retention rules')
+        self._retention_tasks = tasks
+        self._apply_retention()
+
+    @run_in_thread('db')
+    def _apply_retention(self):
+        while self._retention_tasks:
+            condition, parameters, archive = self._retention_tasks[0]
+            removed = self.writer.run(partial(self._expire_messages, condition=condition, parameters=parameters, archive=archive))
+            if removed != self.retention_chunk_size:
+                self._retention_tasks.pop(0)
+            if removed:
+                log.debug(f'== Removed {removed} expired messages from history')
+                # a pause between the chunks leaves the database to the other queries
+                call_in_gui_thread(call_later, self.retention_interval, self._apply_retention)
+                return
+        self._vacuum()
+
+    def _expire_messages(self, cursor, condition, parameters, archive):
+        table = Message.sqlmeta.table
+        ids = [id for id, in cursor.execute(f'select id from {table} where {condition} limit ?', (*parameters, self.retention_chunk_size))]
+        if not ids:
+            return 0
+        placeholders = ', '.join('?' * len(ids))
+        if archive:
+            columns = MessageRow.columns[1:]
+            content = columns.index('content')
+            rows = []
+            for row in cursor.execute(f"select {MessageRow.select_list(columns)} from {table} where id in ({placeholders})", ids):
+                row = list(row)
+                row[content] = zlib.compress((row[content] or '').encode())
+                rows.append(row)
+            cursor.executemany(f"insert or ignore into archive.{table} ({', '.join(columns)}) values ({', '.join('?' * len(columns))})", rows)
+        cursor.execute(f'delete from {table} where id in ({placeholders})', ids)
+        return len(ids)
+
+    def _attach_archive(self):
+        # The archived messages are kept in a separate database, with the content compressed
+        table = Message.sqlmeta.table
+        columns = MessageRow.columns[1:]
+        connection = self.db.getConnection()
+        try:
+            if any(name == 'archive' for seq, name, path in connection.execute('PRAGMA database_list')):
+                return True
+            connection.execute('ATTACH DATABASE ? AS archive', (ApplicationData.get('message_history_archive.db'),))
+            connection.execute(f"create table if not exists archive.{table} (id integer primary key, {', '.join(columns)})")
+            connection.execute(f'create unique index if not exists archive.{table}_unique_idx on {table} (message_id, account_id, remote_uri)')
+        except sqlite3.Error as e:
+            log.warning(f'Failed to open the message history archive: {e}')
+            return False
+        finally:
+            self.db.releaseConnection(connection)
+        return True
+
+    @run_in_thread('db')
+    def _vacuum(self):
+        connection = self.db.getConnection()
+        try:
+            auto_vacuum, = connection.execute('PRAGMA auto_vacuum').fetchone()
+            free_pages, = connection.execute('PRAGMA freelist_count').fetchone()
+            if auto_vacuum != 2:
+                # A database created before incremental vacuum was enabled can only be converted by a full VACUUM,
+                # which blocks the history while it rewrites the whole file, so it is left to compact
+                total_pages, = connection.execute('PRAGMA page_count').fetchone()
+                if free_pages * 10 > total_pages:
+                    log.info(f'== {free_pages} of {total_pages} message history pages are free, compacting the history would give them back')
+                return
+            if free_pages:
+                # each step of the statement frees one page, executescript runs it to completion
+                connection.executescript(f'PRAGMA incremental_vacuum({self.vacuum_pages})')
+        except sqlite3.Error as e:
+            log.warning(f'Failed to vacuum message history: {e}')
+            return
+        finally:
+            self.db.releaseConnection(connection)
+        if free_pages > self.vacuum_pages:
+            call_in_gui_thread(call_later, self.retention_interval, self._vacuum)
+
+    @run_in_thread('db')
+    def compact(self):
+        """
+        Rewrite the database without its free pages with a full VACUUM, which
+        also enables the incremental vacuum for a database created before it
+        was used. The history cannot be read or written while it runs.
+        """
+        self.writer.flush()
+        notification_center = NotificationCenter()
+        connection = self.db.getConnection()
+        try:
+            connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            connection.execute('VACUUM')
+        except sqlite3.Error as e:
+            log.warning(f'Failed to compact message history: {e}')
+            notification_center.post_notification('BlinkMessageHistoryCompactDidFail', data=NotificationData(error=str(e)))
+            return
+        finally:
+            self.db.releaseConnection(connection)
+        log.info('== Compacted message history')
+        notification_center.post_notification('BlinkMessageHistoryCompactDidSucceed')
 
     @run_in_thread('db')
     def remove_message(self, id):
+        self.writer.flush()
         log.debug(f'== Trying to removing message: {id}')
         result = Message.selectBy(message_id=id)
         for message in result:
@@ -1049,7 +2479,9 @@ class HistoryEntry(object):
     incoming_failed_icon = IconDescriptor(Resources.get('icons/arrow-inward-red.svg'))
     outgoing_failed_icon = IconDescriptor(Resources.get('icons/arrow-outward-red.svg'))
 
-    def __init__(self, direction, name, uri, account_id, call_time, duration, failed=False, reason=None):
+    columns = ('id', 'account_id', 'remote_uri', 'display_name', 'direction', 'media', 'call_time', 'duration', 'reason', 'failed', 'message_id')
+
+    def __init__(self, direction, name, uri, account_id, call_time, duration, failed=False, reason=None, media='audio', id=None, message_id=None):
         self.direction = direction
         self.name = name
         self.uri = uri
@@ -1058,9 +2490,9 @@ class HistoryEntry(object):
         self.duration = duration
         self.failed = failed
         self.reason = reason
-
-    def __reduce__(self):
-        return self.__class__, (self.direction, self.name, self.uri, self.account_id, self.call_time, self.duration, self.failed, self.reason)
+        self.media = media
+        self.id = id
+        self.message_id = message_id
 
     def __eq__(self, other):
         return self is other
@@ -1110,15 +2542,27 @@ class HistoryEntry(object):
             else:
                 result += call_time.strftime(translate("history", " on %Y-%m-%d"))
         if self.duration:
-            seconds = int(self.duration.total_seconds())
-            if seconds >= 3600:
-                result += """ (%dh%02d'%02d")""" % (seconds / 3600, (seconds % 3600) / 60, seconds % 60)
-            else:
-                result += """ (%d'%02d")""" % (seconds / 60, seconds % 60)
+            result += self.duration_text
         elif self.reason:
             result += ' (%s)' % self.reason.title()
         return result
 
+    @property
+    def duration_text(self):
+        if not self.duration:
+            return ''
+        seconds = int(self.duration.total_seconds())
+        if seconds >= 3600:
+            return """ (%dh%02d'%02d")""" % (seconds / 3600, (seconds % 3600) / 60, seconds % 60)
+        else:
+            return """ (%d'%02d")""" % (seconds / 60, seconds % 60)
+
+    @classmethod
+    def from_row(cls, id, account_id, remote_uri, display_name, direction, media, call_time, duration, reason, failed, message_id):
+        call_time = parse_sql_timestamp(call_time).replace(tzinfo=timezone.utc)
+        duration = timedelta(seconds=duration) if duration is not None else None
+        return cls(direction, display_name, remote_uri, account_id, call_time, duration, bool(failed), reason or None, media=media, id=id, message_id=message_id)
+
     @classmethod
     def from_session(cls, session):
         if session.start_time is None and session.end_time is not None:
@@ -1139,10 +2583,8 @@ class HistoryEntry(object):
         match = cls.phone_number_re.match(remote_uri)
         if match:
             remote_uri = match.group('number')
-        try:
-            contact = next(contact for contact in AddressbookManager().get_contacts() if remote_uri in (addr.uri for addr in contact.uris))
-        except StopIteration:
-            display_name = session.remote_identity.display_name
-        else:
-            display_name = contact.name
-        return cls(session.direction, display_name, remote_uri, str(session.account.id), call_time, duration)
+        display_name = AddressbookIndex().display_name(remote_uri, session.remote_identity.display_name)
+        streams = [stream.type for stream in session.streams or session.proposed_streams or ()]
+        media = 'video' if 'video' in streams else 'audio'
+        media = 'file-transfer' if 'file-transfer' in streams else media
+        return cls(session.direction, display_name, remote_uri, str(session.account.id), call_time, duration, media=media)
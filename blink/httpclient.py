@@ -0,0 +1,181 @@
+
+"""Shared HTTP client for all of Blink's HTTP requests"""
+
+import requests
+import ssl
+
+from application import log
+from application.notification import IObserver, NotificationCenter
+from application.python import Null
+from application.python.types import Singleton
+from copy import copy
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from threading import Lock
+from time import perf_counter
+from urllib.parse import urlsplit
+from zope.interface import implementer
+
+from sipsimple.configuration.settings import SIPSimpleSettings
+
+from blink.util import trusted_cas
+
+
+__all__ = ['HTTPClient', 'HTTPStatistics']
+
+
+class HTTPStatistics(object):
+    """Request metrics for one host"""
+
+    def __init__(self, host):
+        self.host = host
+        self.requests = 0
+        self.failures = 0
+        self.connections = 0
+        self.time = 0.0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(host={self.host!r}, requests={self.requests}, failures={self.failures}, connections={self.connections}, time={self.time:.3f})'
+
+
+class TLSAdapter(HTTPAdapter):
+    def __init__(self, ssl_context, **kw):
+        self.ssl_context = ssl_context
+        super(TLSAdapter, self).__init__(**kw)
+
+    def init_poolmanager(self, *args, **kw):
+        kw['ssl_context'] = self.ssl_context
+        super(TLSAdapter, self).init_poolmanager(*args, **kw)
+
+
+@implementer(IObserver)
+class HTTPClient(object, metaclass=Singleton):
+    """
+    A thread-safe HTTP client that keeps the connections to every host open in
+    a pool, so that the TCP connection and the TLS handshake are done once per
+    host instead of once per request. The server certificates are verified
+    against the system CAs and the CAs in the tls.ca_list setting, unless
+    tls.verify_server is disabled.
+    """
+
+    connect_timeout = 5
+    read_timeout = 30
+
+    pool_hosts = 20         # the number of hosts whose connections are kept open
+    pool_connections = 10   # the number of connections kept open to a host, one for every thread that uses it at the same time
+
+    def __init__(self):
+        self._session = None
+        self._lock = Lock()
+        self._statistics = {}
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='CFGSettingsObjectDidChange')
+
+    def request(self, method, url, timeout=None, **kw):
+        """
+        Send a request with the shared session and return the requests.Response.
+        The timeout defaults to (connect_timeout, read_timeout). The exceptions
+        are the ones raised by requests.
+        """
+        session = self._get_session()
+        host = self._host(url)
+        start = perf_counter()
+        try:
+            response = session.request(method, url, timeout=timeout or (self.connect_timeout, self.read_timeout), **kw)
+        except requests.RequestException:
+            self._update_statistics(host, perf_counter() - start, failed=True)
+            raise
+        self._update_statistics(host, perf_counter() - start, failed=response.status_code >= 400)
+        return response
+
+    def get(self, url, **kw):
+        return self.request('GET', url, **kw)
+
+    def post(self, url, **kw):
+        return self.request('POST', url, **kw)
+
+    @property
+    def statistics(self):
+        """The HTTPStatistics of every host, with the connections opened to it"""
+        with self._lock:
+            statistics = {host: copy(host_statistics) for host, host_statistics in self._statistics.items()}
+            pools = self._session.get_adapter('https://').poolmanager.pools if self._session is not None else {}
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host = pool.host if pool.port in (None, 80, 443) else f'{pool.host}:{pool.port}'
+                statistics.setdefault(host, HTTPStatistics(host)).connections = pool.num_connections
+        return statistics
+
+    def close(self):
+        with self._lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
+
+    @staticmethod
+    def _host(url):
+        url = urlsplit(url)
+        return url.hostname if url.port in (None, 80, 443) else f'{url.hostname}:{url.port}'
+
+    def _get_session(self):
+        with self._lock:
+            if self._session is None:
+                self._session = self._create_session()
+            return self._session
+
+    def _create_session(self):
+        settings = SIPSimpleSettings()
+        ssl_context = ssl.create_default_context()
+        if settings.tls.verify_server:
+            if settings.tls.ca_list is not None:
+                self._load_cas(ssl_context, settings.tls.ca_list.normalized)
+        else:
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+        session = requests.Session()
+        session.verify = settings.tls.verify_server
+        # The session is shared by all the accounts and threads, it must not carry cookies from one request to another
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = TLSAdapter(ssl_context, pool_connections=self.pool_hosts, pool_maxsize=self.pool_connections)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @staticmethod
+    def _load_cas(ssl_context, filename):
+        # the certificates that cannot be parsed are skipped instead of making the whole file fail to load
+        try:
+            with open(filename) as ca_file:
+                certificates = trusted_cas(ca_file.read())
+        except OSError as e:
+            log.warning(f'Could not read the TLS CA list {filename}: {e}')
+            return
+        if not certificates:
+            log.warning(f'The TLS CA list {filename} has no valid certificates')
+            return
+        pem_certificates = (certificate.export() for certificate in certificates)
+        try:
+            ssl_context.load_verify_locations(cadata=''.join(pem.decode() if isinstance(pem, bytes) else pem for pem in pem_certificates))
+        except (ssl.SSLError, ValueError) as e:
+            log.warning(f'Could not load the TLS CA list {filename}: {e}')
+
+    def _update_statistics(self, host, duration, failed):
+        with self._lock:
+            try:
+                statistics = self._statistics[host]
+            except KeyError:
+                statistics = self._statistics[host] = HTTPStatistics(host)
+            statistics.requests += 1
+            statistics.failures += failed
+            statistics.time += duration
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_CFGSettingsObjectDidChange(self, notification):
+        if notification.sender is SIPSimpleSettings() and {'tls.ca_list', 'tls.verify_server'}.intersection(notification.data.modified):
+            # the next request creates a session with the new settings, the requests in progress finish with the old one
+            self.close()
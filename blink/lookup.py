@@ -0,0 +1,159 @@
+
+"""Cache for the routes of the outgoing SIP requests"""
+
+from application.notification import IObserver, NotificationCenter, NotificationData
+from application.python import Null
+from application.python.types import Singleton
+from threading import Lock
+from time import time
+from twisted.internet import reactor
+from zope.interface import implementer
+
+from sipsimple.lookup import DNSLookup
+
+
+__all__ = ['RouteCache', 'RouteLookup']
+
+
+class RouteCacheEntry(object):
+    def __init__(self, routes, expiration):
+        self.routes = routes
+        self.expiration = expiration
+
+
+@implementer(IObserver)
+class PendingRouteLookup(object):
+    """A DNS lookup whose result is waited for by one or more RouteLookups"""
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.route_lookups = []
+        self.expiration = None
+        self.invalidated = False
+        self.lookup = None
+
+    def start(self, uri, supported_transports, tls_name):
+        self.lookup = self.cache.lookup_class()
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, sender=self.lookup)
+        self.lookup.lookup_sip_proxy(uri, supported_transports, tls_name=tls_name)
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_DNSLookupTrace(self, notification):
+        # the routes expire together with the first of the DNS records they were found with
+        expiration = getattr(notification.data.answer, 'expiration', None)
+        if expiration is not None:
+            self.expiration = expiration if self.expiration is None else min(self.expiration, expiration)
+        with self.cache.lock:
+            route_lookups = list(self.route_lookups)
+        for route_lookup in route_lookups:
+            notification.center.post_notification('DNSLookupTrace', sender=route_lookup, data=notification.data)
+
+    def _NH_DNSLookupDidSucceed(self, notification):
+        notification.center.remove_observer(self, sender=notification.sender)
+        routes = notification.data.result
+        for route_lookup in self.cache._finish(self, routes):
+            notification.center.post_notification('DNSLookupDidSucceed', sender=route_lookup, data=NotificationData(result=list(routes)))
+
+    def _NH_DNSLookupDidFail(self, notification):
+        notification.center.remove_observer(self, sender=notification.sender)
+        for route_lookup in self.cache._finish(self, None):
+            notification.center.post_notification('DNSLookupDidFail', sender=route_lookup, data=notification.data)
+
+
+@implementer(IObserver)
+class RouteCache(object, metaclass=Singleton):
+    """
+    Keeps the routes found by the DNS lookups of the outgoing SIP requests, per
+    account and target, for as long as the DNS records they were found with are
+    valid. A lookup for a target that is already being looked up waits for the
+    result of that lookup instead of starting another one. All the routes are
+    dropped when the IP address of the system changes, and the ones of an
+    account when a request sent on them times out or cannot be delivered.
+    """
+
+    lookup_class = DNSLookup
+
+    default_ttl = 300   # for the routes that were found without DNS records, like the ones to an IP address
+    max_ttl = 3600
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = {}
+        self.pending = {}
+        self.lookups = 0    # the number of DNS lookups that were started
+        self.hits = 0       # the number of lookups answered from the cache
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='SystemIPAddressDidChange')
+
+    def lookup(self, route_lookup, uri, supported_transports, tls_name):
+        key = route_lookup.account.id, str(uri), tuple(supported_transports), tls_name
+        routes = pending = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expiration > time():
+                self.hits += 1
+                routes = entry.routes
+            else:
+                self.entries.pop(key, None)
+                if key not in self.pending:
+                    pending = self.pending[key] = PendingRouteLookup(self, key)
+                    self.lookups += 1
+                self.pending[key].route_lookups.append(route_lookup)
+        if routes is not None:
+            # posted later from the reactor thread, like the result of a DNSLookup, so that the observers of the
+            # RouteLookup can also be added after lookup_sip_proxy returns
+            notification_center = NotificationCenter()
+            reactor.callFromThread(notification_center.post_notification, 'DNSLookupDidSucceed', sender=route_lookup, data=NotificationData(result=list(routes)))
+        elif pending is not None:
+            pending.start(uri, supported_transports, tls_name)
+
+    def invalidate(self, account=None):
+        """Drop the routes of the account, or all of them if account is None"""
+        with self.lock:
+            if account is None:
+                self.entries.clear()
+            else:
+                for key in [key for key in self.entries if key[0] == account.id]:
+                    del self.entries[key]
+            # the lookups in progress may have used the DNS records or network that were just found to be stale, so
+            # their routes are not cached and the lookups started from now on do not wait for them but start new ones
+            for key in [key for key in self.pending if account is None or key[0] == account.id]:
+                self.pending.pop(key).invalidated = True
+
+    def _finish(self, pending, routes):
+        with self.lock:
+            if self.pending.get(pending.key) is pending:
+                del self.pending[pending.key]
+            if routes and not pending.invalidated:
+                now = time()
+                expiration = min(pending.expiration if pending.expiration is not None else now + self.default_ttl, now + self.max_ttl)
+                if expiration > now:
+                    self.entries[pending.key] = RouteCacheEntry(routes, expiration)
+            return pending.route_lookups
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_SystemIPAddressDidChange(self, notification):
+        self.invalidate()
+
+
+class RouteLookup(object):
+    """
+    A replacement for DNSLookup for the routes of the SIP requests of an
+    account, which gets them from the RouteCache. lookup_sip_proxy posts the
+    same notifications as the one of DNSLookup, with the RouteLookup as sender,
+    always after it returned, even when the routes are cached.
+    """
+
+    def __init__(self, account):
+        self.account = account
+
+    def lookup_sip_proxy(self, uri, supported_transports, tls_name=None):
+        RouteCache().lookup(self, uri, supported_transports, tls_name)
@@ -62,18 +62,15 @@ class MainWindow(base_class, ui_class):
         notification_center.add_observer(self, name='BlinkFileTransferNewOutgoing')
         notification_center.add_observer(self, name='BlinkUnreadMessagesChanged')
         notification_center.add_observer(self, name='ChatSessionUnreadMessagesCountChanged')
-        notification_center.add_observer(self, name='BlinkMessageHistoryUnreadMessagesDidLoad')
-        notification_center.add_observer(self, name='BlinkMessageNewUnread')
         notification_center.add_observer(self, name='BlinkMessageHistoryMessageDidStore')
-        notification_center.add_observer(self, name='BlinkSessionConfirmReadMessages')
-        notification_center.add_observer(self, name='BlinkConfirmReadMessagesOnOtherDevice')
+        notification_center.add_observer(self, name='BlinkCallHistoryDidChange')
 
         notification_center.add_observer(self, sender=AccountManager())
 
         icon_manager = IconManager()
 
         self.pending_watcher_dialogs = []
-        self.unread_messages = {}
+        self.history_menu_position = None
 
         self.mwi_icons = [QIcon(Resources.get('icons/mwi-%d.png' % i)) for i in range(0, 11)]
         self.mwi_icons.append(QIcon(Resources.get('icons/mwi-many.png')))
@@ -527,6 +524,10 @@ class MainWindow(base_class, ui_class):
                 action = self.history_menu.addAction(entry.icon, entry.text)
                 action.entry = entry
                 action.setToolTip(entry.uri)
+            if self.history_manager.more_calls:
+                self.history_menu.addSeparator()
+                action = self.history_menu.addAction(translate("main_window", "Show older calls"))
+                action.entry = None
         else:
             action = self.history_menu.addAction(translate("main_window", "Call history is empty"))
             action.setEnabled(False)
@@ -596,6 +597,11 @@ class MainWindow(base_class, ui_class):
             self.main_view.setCurrentWidget(self.sessions_panel)
 
     def _AH_HistoryMenuTriggered(self, action):
+        if action.entry is None:
+            # the menu is shown again at the same position once the older calls are loaded
+            self.history_menu_position = self.history_menu.pos()
+            self.history_manager.load_older_calls()
+            return
         account_manager = AccountManager()
         session_manager = SessionManager()
         try:
@@ -854,67 +860,28 @@ class MainWindow(base_class, ui_class):
             self.switch_view_button.view = SwitchViewButton.ContactView
 
     @property
-    def total_unread_messages(self):
-        new_messages = 0
-        for k in self.unread_messages.copy().keys():
-            new_messages = new_messages + self.unread_messages[k]
-        return new_messages
-
-    @run_in_gui_thread
-    def _NH_BlinkConfirmReadMessagesOnOtherDevice(self, notification):
-        try:
-            del(self.unread_messages[notification.data.remote_uri])
-        except KeyError:
-            pass
-        else:
-            NotificationCenter().post_notification('BlinkUnreadMessagesChanged')
+    def unread_messages(self):
+        return self.history_manager.unread_messages.counts
 
-    @run_in_gui_thread
-    def _NH_BlinkSessionConfirmReadMessages(self, notification):
-        uri = str(notification.sender.uri).partition(':')[2]
-        try:
-            del(self.unread_messages[uri])
-        except KeyError:
-            pass
-        else:
-            NotificationCenter().post_notification('BlinkUnreadMessagesChanged')
+    @property
+    def total_unread_messages(self):
+        return self.history_manager.unread_messages.total
 
     @run_in_gui_thread
     def _NH_BlinkUnreadMessagesChanged(self, notification):
-        self.active_sessions_label.setText(translate('main_window', 'There is 1 new message') if self.total_unread_messages == 1 else translate('main_window', 'There are %d new messages') % self.total_unread_messages)
-        self.active_sessions_label.setVisible(bool(self.total_unread_messages))
-        self.show_unread_messages_action.setEnabled(bool(self.total_unread_messages))
-        self.open_unread_messages_button.setEnabled(bool(self.total_unread_messages))
-        self.open_unread_messages_button.setText(translate('main_window', 'There is 1 new message') if self.total_unread_messages == 1 else translate('main_window', 'There are %d new messages') % self.total_unread_messages)
-        self.open_unread_messages_button.setVisible(bool(self.total_unread_messages))
+        total = notification.data.total
+        self.active_sessions_label.setText(translate('main_window', 'There is 1 new message') if total == 1 else translate('main_window', 'There are %d new messages') % total)
+        self.active_sessions_label.setVisible(bool(total))
+        self.show_unread_messages_action.setEnabled(bool(total))
+        self.open_unread_messages_button.setEnabled(bool(total))
+        self.open_unread_messages_button.setText(translate('main_window', 'There is 1 new message') if total == 1 else translate('main_window', 'There are %d new messages') % total)
+        self.open_unread_messages_button.setVisible(bool(total))
         self.active_sessions_label.setVisible(False)
 
-    def _NH_BlinkMessageNewUnread(self, notification):
-        uri = notification.sender
-
-        try:
-            self.unread_messages[uri]
-        except KeyError:
-            self.unread_messages[uri] = 1
-        else:
-            self.unread_messages[uri] = self.unread_messages[uri] + 1
-
-        NotificationCenter().post_notification('BlinkUnreadMessagesChanged')
-
-    def _NH_BlinkMessageHistoryUnreadMessagesDidLoad(self, notification):
-        unread_messages = notification.data.unread_messages
-        total = 0
-        self.unread_messages = {}
-        for k in unread_messages.keys():
-            try:
-                um = self.unread_messages[k]
-            except KeyError:
-                self.unread_messages[k] = unread_messages[k]
-            else:
-                self.unread_messages[k] = self.unread_messages[k] + unread_messages[k]
-            total = total + self.unread_messages[k]
-
-        NotificationCenter().post_notification('BlinkUnreadMessagesChanged')
+    def _NH_BlinkCallHistoryDidChange(self, notification):
+        if self.history_menu_position is not None:
+            self.history_menu.popup(self.history_menu_position)
+            self.history_menu_position = None
 
     def hide_new_messages_label(self):
         self.active_sessions_label.setVisible(False)
@@ -1,4 +1,5 @@
 import bisect
+import codecs
 import dns.resolver
 import json
 import os
@@ -10,9 +11,11 @@ import uuid
 import pgpy
 
 from collections import deque
+from functools import partial
+from threading import Event
 
 from PyQt5 import uic
-from PyQt5.QtCore import Qt, QObject, pyqtSignal
+from PyQt5.QtCore import Qt, QObject, QTimer, pyqtSignal
 from PyQt5.QtWidgets import QApplication, QDialogButtonBox, QStyle, QDialog
 
 from pgpy import PGPMessage
@@ -20,6 +23,7 @@ from pgpy.errors import PGPEncryptionError, PGPDecryptionError
 
 from application.notification import IObserver, NotificationCenter, NotificationData
 from application.python import Null
+from application.python.threadpool import ThreadPool
 from application.system import makedirs, host
 from application.python.types import Singleton
 from datetime import datetime, timezone, timedelta
@@ -32,7 +36,6 @@ from sipsimple.addressbook import AddressbookManager
 from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.core import SIPURI, FromHeader, ToHeader, Message, RouteHeader
 from sipsimple.core._core import PJSIPError
-from sipsimple.lookup import DNSLookup
 from sipsimple.payloads import ParserError
 from sipsimple.payloads.iscomposing import IsComposingDocument, IsComposingMessage, State, LastActive, Refresh, ContentType
 from sipsimple.payloads.imdn import IMDNDocument, DeliveryNotification, DisplayNotification
@@ -42,9 +45,11 @@ from sipsimple.threading import run_in_thread
 from sipsimple.util import ISOTimestamp
 
 from blink.configuration.datatypes import File
+from blink.httpclient import HTTPClient
 from blink.logging import MessagingTrace as log
+from blink.lookup import RouteCache, RouteLookup
 from blink.resources import Resources
-from blink.sessions import SessionManager, StreamDescription, IncomingDialogBase
+from blink.sessions import BlinkSessionList, SessionManager, StreamDescription, IncomingDialogBase
 from blink.util import run_in_gui_thread, translate
 
 __all__ = ['MessageManager', 'BlinkMessage']
@@ -378,7 +383,7 @@ class OutgoingMessage(object):
         else:
             uri = self.sip_uri
 
-        self.lookup = DNSLookup()
+        self.lookup = RouteLookup(self.account)
         notification_center = NotificationCenter()
         notification_center.add_observer(self, sender=self.lookup)
         self.lookup.lookup_sip_proxy(uri, settings.sip.transport_list, tls_name=self.account.sip.tls_name or uri.host)
@@ -467,10 +472,8 @@ class OutgoingMessage(object):
             notification_center = NotificationCenter()
             notification_center.post_notification('BlinkMessageIsPending', sender=self.session, data=NotificationData(message=self.message, id=self.id))
 
-        if self.session.routes and self.session.account == self.account:
-            self._send()
-        else:
-            self._lookup()
+        # the routes come from the RouteCache, which only looks them up again when their DNS records expired or they failed
+        self._lookup()
 
     @run_in_gui_thread
     def handle_notification(self, notification):
@@ -537,7 +540,14 @@ class OutgoingMessage(object):
         if self.session is not None:
             notification_center.post_notification('BlinkMessageDidSucceed', sender=self.session, data=NotificationData(data=notification.data, id=self.id))
 
+    def _check_routes(self, notification):
+        if getattr(notification.data, 'code', None) in (408, 503):
+            # the route did not answer or could not be reached, the next request looks it up again
+            RouteCache().invalidate(self.account)
+
     def _NH_SIPMessageDidFail(self, notification):
+        self._check_routes(notification)
+
         if self.__disabled_imdn_content_types__:
             return
 
@@ -608,10 +618,7 @@ class InternalOTROutgoingMessage(OutgoingMessage):
         if self.session is None:
             return
 
-        if self.session.routes:
-            self._send()
-        else:
-            self._lookup()
+        self._lookup()
 
     def _NH_DNSLookupDidSucceed(self, notification):
         notification.center.remove_observer(self, sender=notification.sender)
@@ -628,7 +635,7 @@ class InternalOTROutgoingMessage(OutgoingMessage):
         return
 
     def _NH_SIPMessageDidFail(self, notification):
-        return
+        self._check_routes(notification)
 
 
 class RequestList(list):
@@ -642,16 +649,201 @@ class RequestList(list):
             return [item for item in self if item.account is key]
 
 
+def iter_server_history_messages(chunks):
+    # Parses the {"messages": [...]} document returned by the history synchronization API as it is downloaded and yields the messages one by
+    # one, so that only a few of them are held in memory at a time. Raises ValueError if the document is not valid or incomplete.
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    messages_re = re.compile(r'"messages"\s*:\s*\[')
+    whitespace_re = re.compile(r'[\s,]*')
+    chunks = iter(chunks)
+    buffer = ''
+    position = None
+    done = False
+
+    while True:
+        if position is None:
+            match = messages_re.search(buffer)
+            if match is not None:
+                position = match.end()
+        if position is not None:
+            while True:
+                position = whitespace_re.match(buffer, position).end()
+                if buffer.startswith(']', position):
+                    return
+                try:
+                    message, position = decoder.raw_decode(buffer, position)
+                except ValueError:
+                    if done:
+                        raise
+                    break
+                yield message
+            buffer = buffer[position:]
+            position = 0
+        if done:
+            raise ValueError('incomplete history synchronization document')
+        try:
+            buffer += text_decoder.decode(next(chunks))
+        except StopIteration:
+            buffer += text_decoder.decode(b'', final=True)
+            done = True
+
+
+@implementer(IObserver)
+class ServerHistoryPage(object):
+    """Waits until the history messages of a page fetched from the server were stored"""
+
+    def __init__(self, account, cursor):
+        self.account = account
+        self.cursor = cursor
+        self.stored = False
+        self._event = Event()
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='BlinkMessageHistoryServerHistoryDidStore', sender=account)
+        notification_center.add_observer(self, name='BlinkMessageHistoryServerHistoryDidFail', sender=account)
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+        notification_center = NotificationCenter()
+        notification_center.remove_observer(self, name='BlinkMessageHistoryServerHistoryDidStore', sender=self.account)
+        notification_center.remove_observer(self, name='BlinkMessageHistoryServerHistoryDidFail', sender=self.account)
+        return self.stored
+
+    def handle_notification(self, notification):
+        if notification.data.cursor == self.cursor:
+            self.stored = notification.name == 'BlinkMessageHistoryServerHistoryDidStore'
+            self._event.set()
+
+
+class HistorySynchronizationState(object):
+    def __init__(self, interval):
+        self.interval = interval
+        self.failures = 0
+        self.running = False
+        self.pending = False
+        self.timer = None
+
+
+@implementer(IObserver)
+class HistorySynchronizationScheduler(object):
+    """
+    Decides when the server history of every account is synchronized. An
+    account is synchronized right away when asked to, otherwise again after an
+    interval that doubles every time nothing new was found and goes back to
+    the minimum when something was. A synchronization that fails is retried
+    with an exponential backoff. The delays are spread randomly, so that the
+    accounts do not synchronize at the same time, and the accounts are
+    synchronized concurrently in a pool of threads, which is stopped when the
+    SIP application ends. All methods must be called from the GUI thread.
+    """
+
+    interval = 300
+    max_interval = 3600
+    retry_interval = 15
+    max_retry_interval = 1800
+    jitter = 0.2  # the fraction by which the delays are randomly spread
+
+    def __init__(self, function):
+        self.function = function  # called with the account in a pool thread, returns the number of messages it got or None if it failed
+        self.accounts = {}
+        self.threadpool = ThreadPool(name='history-sync', min_threads=1, max_threads=4)
+        self.threadpool.start()
+        NotificationCenter().add_observer(self, name='SIPApplicationWillEnd')
+
+    def synchronize(self, account):
+        if self.threadpool is None:
+            return
+        state = self.accounts.get(account)
+        if state is None:
+            state = self.accounts[account] = HistorySynchronizationState(self.interval)
+        if state.running:
+            state.pending = True
+            return
+        if state.timer is not None:
+            state.timer.stop()
+            state.timer = None
+        state.running = True
+        self.threadpool.run(self._run, account)
+
+    def expedite(self, account):
+        # Something is known to be missing from the history, but it is not worth synchronizing right away. Brings
+        # a scheduled synchronization that was postponed because nothing new was found back to the minimum
+        # interval, while the accounts whose synchronization is running or failing are left alone.
+        state = self.accounts.get(account)
+        if state is None or state.running or state.failures or state.timer is None:
+            return
+        delay = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        if state.timer.remainingTime() > delay * 1000:
+            state.interval = self.interval
+            log.debug(f'Next history synchronization of {account.id} in {delay:.0f} seconds')
+            state.timer.start(int(delay * 1000))
+
+    def cancel(self, account):
+        state = self.accounts.pop(account, None)
+        if state is not None and state.timer is not None:
+            state.timer.stop()
+
+    def _run(self, account):
+        try:
+            count = self.function(account)
+        except Exception as e:
+            log.error(f'History synchronization of {account.id} failed: {e!s}')
+            count = None
+        self._finished(account, count)
+
+    @run_in_gui_thread
+    def _finished(self, account, count):
+        state = self.accounts.get(account)
+        if state is None or self.threadpool is None:
+            return
+        state.running = False
+        if state.pending:
+            state.pending = False
+            self.synchronize(account)
+            return
+        if not account.enabled or not account.sms.enable_history_synchronization:
+            del self.accounts[account]
+            return
+        if count is None:
+            delay = min(self.retry_interval * 2**state.failures, self.max_retry_interval)
+            state.failures += 1
+        else:
+            state.failures = 0
+            state.interval = self.interval if count else min(state.interval * 2, self.max_interval)
+            delay = state.interval
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        log.debug(f'Next history synchronization of {account.id} in {delay:.0f} seconds')
+        state.timer = QTimer()
+        state.timer.setSingleShot(True)
+        state.timer.timeout.connect(partial(self.synchronize, account))
+        state.timer.start(int(delay * 1000))
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_SIPApplicationWillEnd(self, notification):
+        notification.center.remove_observer(self, name='SIPApplicationWillEnd')
+        for account in list(self.accounts):
+            self.cancel(account)
+        self.threadpool.stop()
+        self.threadpool = None
+
+
 @implementer(IObserver)
 class MessageManager(object, metaclass=Singleton):
     __ignored_content_types__ = {IsComposingDocument.content_type, IMDNDocument.content_type,
                                  'text/pgp-public-key', 'text/pgp-private-key', 'application/sylk-message-remove', 'application/sylk-api'}
 
+    history_synchronization_page_size = 500
+    history_synchronization_store_timeout = 300  # seconds to wait for a page to be stored before giving up until the next synchronization
+
     def __init__(self):
-        self.sessions = []
+        self.sessions = BlinkSessionList()
         self._outgoing_message_queue = deque()
         self._incoming_encrypted_message_queue = deque()
-        self._sync_queue = deque()
+        self._registered_accounts = set()
+        self.history_synchronization = HistorySynchronizationScheduler(self._sync_messages)
         self.pgp_requests = RequestList()
 
         notification_center = NotificationCenter()
@@ -664,8 +856,13 @@ class MessageManager(object, metaclass=Singleton):
         notification_center.add_observer(self, name='PGPMessageDidDecrypt')
         notification_center.add_observer(self, name='PGPKeysShouldReload')
         notification_center.add_observer(self, name='SIPAccountRegistrationDidSucceed')
-        notification_center.add_observer(self, name='BlinkServerHistoryWasFetched')
+        notification_center.add_observer(self, name='SIPAccountRegistrationDidFail')
+        notification_center.add_observer(self, name='SIPAccountRegistrationDidEnd')
+        notification_center.add_observer(self, name='SIPAccountDidDeactivate')
+        notification_center.add_observer(self, name='SIPAccountManagerDidRemoveAccount')
+        notification_center.add_observer(self, name='SystemIPAddressDidChange')
         notification_center.add_observer(self, name='BlinkMessageHistoryFailedLocalFound')
+        notification_center.add_observer(self, name='BlinkMessageHistoryMessageWasNotFound')
         notification_center.add_observer(self, name='CFGSettingsObjectDidChange')
 
     @run_in_thread('file-io')
@@ -690,15 +887,19 @@ class MessageManager(object, metaclass=Singleton):
         with open(filename, 'wb') as f:
             data = data if isinstance(data, bytes) else data.encode()
             f.write(data)
-            try:
-                from blink.contacts import URIUtils
-                contact, contact_uri = URIUtils.find_contact(uri)
-                blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
-            except StopIteration:
-                pass
-            else:
-                notification_center = NotificationCenter()
-                notification_center.post_notification('PGPKeysShouldReload', sender=blink_session)
+            from blink.contacts import URIUtils
+            contact, contact_uri = URIUtils.find_contact(uri)
+            self._reload_pgp_keys(contact)
+
+    @run_in_gui_thread
+    def _reload_pgp_keys(self, contact):
+        try:
+            blink_session = next(self.sessions.find(contact=contact))
+        except StopIteration:
+            pass
+        else:
+            notification_center = NotificationCenter()
+            notification_center.post_notification('PGPKeysShouldReload', sender=blink_session)
 
     def check_encryption(self, content_type, body):
         if (content_type.lower().startswith('text/') and '-----BEGIN PGP MESSAGE-----' in body and body.strip().endswith('-----END PGP MESSAGE-----') and content_type != 'text/pgp-private-key'):
@@ -762,116 +963,178 @@ class MessageManager(object, metaclass=Singleton):
             message = self._outgoing_message_queue.popleft()
             message.send()
 
-    @run_in_thread('sync')
     def _sync_messages(self, account):
+        # Runs in a HistorySynchronizationScheduler thread. Returns the number of messages fetched from the server or None if it failed.
         if not account.sms.enable_history_synchronization:
             if account.sms.history_synchronization_timestamp:
                 account.sms.history_synchronization_timestamp = None
                 account.save()
-            return
+            return 0
 
         if not account.sms.history_synchronization_token:
             self._request_history_synchronization_token(account)
-            return
+            return None
 
         if not account.sms.history_synchronization_url:
-            return
+            return 0
 
-        if account.sms.history_synchronization_id is not None:
-            url = urllib.parse.urljoin(f'{account.sms.history_synchronization_url}/', account.sms.history_synchronization_id)
-        else:
-            url = account.sms.history_synchronization_url
-
-        scheme, netloc, path, query, fragment = urlsplit(url)
-        path = quote(path)
-        url = urlunsplit((scheme, netloc, path, query, fragment))
         headers = {'Authorization': f'Apikey {account.sms.history_synchronization_token}'}
+        page_size = self.history_synchronization_page_size
+        total = 0
+
+        # The messages after history_synchronization_id are requested a page at a time. Every page_size messages are stored
+        # before history_synchronization_id moves past them, so a synchronization that is interrupted resumes from there.
+        # Servers that ignore the limit return all the messages at once, which are then stored page_size at a time. Servers
+        # may also return fewer messages than the limit before the end, which is only reached when a page is empty.
+        while True:
+            last_id = account.sms.history_synchronization_id
+            if last_id is not None:
+                url = urllib.parse.urljoin(f'{account.sms.history_synchronization_url}/', last_id)
+            else:
+                url = account.sms.history_synchronization_url
 
-        if account.sms.history_synchronization_timestamp is not None:
-            last_sync = ISOTimestamp(account.sms.history_synchronization_timestamp)
-            expired_time = ISOTimestamp.now() - last_sync
-            if expired_time.total_seconds() < 500:
-                log.debug(f'History synchronization skipped for {account.id}, will only sync on interval > 500s ({expired_time.total_seconds()})')
-                return
-
-        log.info(f'Fetching message history for {account.id} from server {url}')
+            scheme, netloc, path, query, fragment = urlsplit(url)
+            path = quote(path)
+            url = urlunsplit((scheme, netloc, path, query, fragment))
 
-        settings = SIPSimpleSettings()
+            log.info(f'Fetching message history for {account.id} from server {url}')
 
-        try:
-            r = requests.get(url, headers=headers, timeout=10, verify=settings.tls.verify_server)
-            r.raise_for_status()
-        except (requests.ConnectionError, requests.Timeout) as e:
-            log.warning(f'SylkServer API connection error: {e}')
-        except requests.HTTPError as e:
-            code = e.response.status_code
-            if code == 401:
-                log.debug('SylkServer API token expired')
-                self._request_history_synchronization_token(account)
-                return
-            log.warning(f'SylkServer API error {e}')
-        except requests.RequestException as e:
-            log.warning(f'SylkServer API error {e}')
-        else:
+            count = 0
             try:
-                data = r.json()
-            except ValueError:
-                pass
-            else:
-                notification_center = NotificationCenter()
-                notification_center.post_notification('BlinkServerHistoryWasFetched', sender=account, data=data)
+                with HTTPClient().get(url, headers=headers, params={'limit': page_size}, timeout=10, stream=True) as r:
+                    r.raise_for_status()
+                    page = []
+                    for message in iter_server_history_messages(r.iter_content(chunk_size=65536)):
+                        page.append(message)
+                        count += 1
+                        if len(page) == page_size:
+                            if not self._process_server_history_messages(account, page):
+                                return None
+                            page = []
+                    if page and not self._process_server_history_messages(account, page):
+                        return None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                log.warning(f'SylkServer API connection error: {e}')
+                return None
+            except requests.HTTPError as e:
+                code = e.response.status_code
+                if code == 401:
+                    log.debug('SylkServer API token expired')
+                    self._request_history_synchronization_token(account)
+                    return None
+                log.warning(f'SylkServer API error {e}')
+                return None
+            except requests.RequestException as e:
+                log.warning(f'SylkServer API error {e}')
+                return None
+            except ValueError as e:
+                log.warning(f'SylkServer API returned an invalid history: {e}')
+                return None
+
+            total += count
+
+            if count == 0:
+                break
+            if account.sms.history_synchronization_id == last_id:
+                log.warning(f'SylkServer API returned the messages after {last_id} again, stopping the history synchronization of {account.id}')
+                break
+
+        account.sms.history_synchronization_timestamp = ISOTimestamp.now()
+        account.save()
+        return total
 
-    @run_in_thread('sync')
     def _process_server_history_messages(self, account, messages):
+        # Runs in the synchronization thread. The messages of the page are stored with a single BlinkGotHistoryMessages
+        # notification. Everything else that depends on them (unread counts, dispositions, removals, the messages
+        # shown in the open sessions) is only done once the page was stored, in the GUI thread where the sessions
+        # are looked up, in the order in which the server sent it. Returns whether the page was stored, after which
+        # history_synchronization_id is moved past it.
+        from blink.contacts import URIUtils
+
         notification_center = NotificationCenter()
         last_id = None
-        new_messages = 0
+        history_messages = []
+        unread_messages = {}
+        deferred_calls = []
+        contacts = {}
+
+        def find_contact(uri):
+            try:
+                return contacts[uri]
+            except KeyError:
+                return contacts.setdefault(uri, URIUtils.find_contact(uri))
+
+        def find_session(contact):
+            return next(self.sessions.find(contact=contact), None)
+
+        def defer(function, *args, **kwargs):
+            deferred_calls.append(partial(function, *args, **kwargs))
+
+        @run_in_gui_thread
+        def run_deferred_calls():
+            for call in deferred_calls:
+                call()
+
+        def post_disposition(contact, data):
+            blink_session = find_session(contact)
+            if blink_session is not None:
+                notification_center.post_notification('BlinkGotDispositionNotification', sender=blink_session, data=data)
+            else:
+                notification_center.post_notification('BlinkGotDispositionNotification', data=data)
+
+        def post_conversation_remove(contact, contact_uri, timestamp):
+            blink_session = find_session(contact)
+            if blink_session is None:
+                notification_center.post_notification('BlinkGotHistoryConversationRemove', sender=account, data=NotificationData(contact=contact_uri.uri, timestamp=timestamp))
+            else:
+                notification_center.post_notification('BlinkConversationWillRemove', sender=blink_session, data=NotificationData(contact=blink_session.contact_uri.uri, timestamp=timestamp))
+
+        def post_message_delete(contact, message_id):
+            notification_center.post_notification('BlinkGotHistoryMessageDelete', data=message_id)
+            blink_session = find_session(contact)
+            if blink_session is not None:
+                notification_center.post_notification('BlinkGotMessageDelete', sender=blink_session, data=message_id)
+
+        def post_shared_file(contact, history_message, file, direction):
+            blink_session = find_session(contact)
+            if blink_session is None:
+                return
+            notification_center.post_notification('BlinkGotMessage', sender=blink_session, data=NotificationData(message=history_message, history=True, account=account))
+            notification_center.post_notification('BlinkSessionDidShareFile', sender=blink_session, data=NotificationData(file=file, direction=direction))
+
+        def post_message(contact, history_message, encryption):
+            blink_session = find_session(contact)
+            if blink_session is None:
+                return
+            if history_message.direction == 'incoming' and 'positive-delivery' in history_message.disposition:
+                log.debug("-- Should send delivered imdn for history message")
+                self.send_imdn_message(blink_session, history_message.id, history_message.timestamp, 'delivered')
+
+            notification_center.post_notification('BlinkGotMessage', sender=blink_session, data=NotificationData(message=history_message, history=True, account=account))
+            if encryption == 'OpenPGP':
+                if blink_session.fake_streams.get('messages').can_decrypt:
+                    blink_session.fake_streams.get('messages').decrypt(history_message)
+                else:
+                    self._incoming_encrypted_message_queue.append((history_message, account, contact))
 
         log.debug(f'-- {len(messages)} messages fetched from server for {account.id}')
-        while messages:
-            message = messages.pop(0)
+        for message in messages:
             last_id = message['message_id']
             content_type = message['content_type'].lower()
 
             if content_type == 'message/imdn':
                 payload = json.loads(message['content'])
-                data = NotificationData(id=payload['message_id'], status=message['state'])
-                kwargs = {'data': data}
-
-                from blink.contacts import URIUtils
-                contact, contact_uri = URIUtils.find_contact(message['contact'])
-                try:
-                    blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
-                except StopIteration:
-                    pass
-                else:
-                    kwargs['sender'] = blink_session
-
-                notification_center.post_notification('BlinkGotDispositionNotification', **kwargs)
+                contact, contact_uri = find_contact(message['contact'])
+                defer(post_disposition, contact, NotificationData(id=payload['message_id'], status=message['state']))
             elif content_type == 'application/sylk-conversation-remove':
-                from blink.contacts import URIUtils
-                contact, contact_uri = URIUtils.find_contact(message['content'])
-                timestamp = ISOTimestamp(message['timestamp'])
-                try:
-                    blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
-                except StopIteration:
-                    notification_center.post_notification('BlinkGotHistoryConversationRemove', sender=account, data=NotificationData(contact=contact_uri.uri, timestamp=timestamp))
-                else:
-                    NotificationCenter().post_notification('BlinkConversationWillRemove', sender=blink_session, data=NotificationData(contact=blink_session.contact_uri.uri, timestamp=timestamp))
+                contact, contact_uri = find_contact(message['content'])
+                defer(post_conversation_remove, contact, contact_uri, ISOTimestamp(message['timestamp']))
             elif content_type == 'application/sylk-message-remove':
                 payload = json.loads(message['content'])
-                notification_center.post_notification('BlinkGotHistoryMessageDelete', data=payload['message_id'])
-
-                from blink.contacts import URIUtils
-                contact, contact_uri = URIUtils.find_contact(message['contact'])
-                try:
-                    blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
-                except StopIteration:
-                    pass
-                else:
-                    notification_center.post_notification('BlinkGotMessageDelete', sender=blink_session, data=payload['message_id'])
+                contact, contact_uri = find_contact(message['contact'])
+                defer(post_message_delete, contact, payload['message_id'])
             elif content_type == 'application/sylk-conversation-read':
-                NotificationCenter().post_notification('BlinkConfirmReadMessagesOnOtherDevice', data=NotificationData(remote_uri=message['contact']))
+                defer(notification_center.post_notification, 'BlinkConfirmReadMessagesOnOtherDevice', data=NotificationData(remote_uri=message['contact']))
             elif content_type == 'text/pgp-public-key':
                 if message['contact'] != account.id:
                     self._save_pgp_key(message['content'], message['contact'])
@@ -882,8 +1145,7 @@ class MessageManager(object, metaclass=Singleton):
                     log.warning('Failed to parse file transfer history message: %s' % str(e))
                     continue
 
-                from blink.contacts import URIUtils
-                contact, contact_uri = URIUtils.find_contact(message['contact'])
+                contact, contact_uri = find_contact(message['contact'])
 
                 try:
                     until = document['until']
@@ -920,32 +1182,17 @@ class MessageManager(object, metaclass=Singleton):
                                                direction=message['direction'],
                                                is_secure=is_secure)
 
-                history_message_data = NotificationData(remote_uri=contact.uri.uri,
-                                                        message=history_message,
-                                                        state='accepted',
-                                                        encryption='OpenPGP' if is_secure else None)
-
-                notification_center.post_notification('BlinkGotHistoryMessage', sender=account, data=history_message_data)
+                history_messages.append(NotificationData(remote_uri=contact.uri.uri,
+                                                         message=history_message,
+                                                         state='accepted',
+                                                         encryption='OpenPGP' if is_secure else None))
                 if message['direction'] == 'incoming':
-                    NotificationCenter().post_notification('BlinkMessageNewUnread', sender=contact.uri.uri)
-
-                try:
-                    blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
-                except StopIteration:
-                    continue
+                    unread_messages[contact.uri.uri] = unread_messages.get(contact.uri.uri, 0) + 1
 
-                notification_center.post_notification('BlinkGotMessage',
-                                                      sender=blink_session,
-                                                      data=NotificationData(message=history_message,
-                                                                            history=True,
-                                                                            account=account))
                 file = File(document['filename'], document['filesize'], contact,
                             document['hash'], message['message_id'], ISOTimestamp(until),
                             document['url'], account=account, protocol='sylk')
-
-                notification_center.post_notification('BlinkSessionDidShareFile',
-                                                      sender=blink_session,
-                                                      data=NotificationData(file=file, direction=message['direction']))
+                defer(post_shared_file, contact, history_message, file, message['direction'])
             elif content_type.startswith('text/'):
                 if message['contact'] is None:
                     continue
@@ -953,8 +1200,7 @@ class MessageManager(object, metaclass=Singleton):
                 if message['content'].startswith("?OTR:") or message['content'].startswith('?OTRv3?'):
                     continue
 
-                from blink.contacts import URIUtils
-                contact, contact_uri = URIUtils.find_contact(message['contact'])
+                contact, contact_uri = find_contact(message['contact'])
 
                 sender = account
                 if message['direction'] == 'incoming':
@@ -971,43 +1217,33 @@ class MessageManager(object, metaclass=Singleton):
                                                direction=message['direction'])
 
                 encryption = self.check_encryption(history_message.content_type, history_message.content)
-                notification_center.post_notification('BlinkGotHistoryMessage',
-                                                      sender=account,
-                                                      data=NotificationData(
-                                                          remote_uri=message['contact'],
-                                                          message=history_message,
-                                                          encryption=encryption,
-                                                          state=message['state']))
+                history_messages.append(NotificationData(remote_uri=message['contact'],
+                                                         message=history_message,
+                                                         encryption=encryption,
+                                                         state=message['state']))
 
                 if message['direction'] == 'incoming':
-                    NotificationCenter().post_notification('BlinkMessageNewUnread', sender=contact.uri.uri)
+                    unread_messages[contact.uri.uri] = unread_messages.get(contact.uri.uri, 0) + 1
 
-                try:
-                    blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
-                except StopIteration:
-                    pass
-                else:
-                    if ['direction'] == 'incoming' and 'positive-delivery' in history_message.disposition:
-                        log.debug("-- Should send delivered imdn for history message")
-                        self.send_imdn_message(blink_session, history_message.id, history_message.timestamp, 'delivered')
+                defer(post_message, contact, history_message, encryption)
 
-                    notification_center.post_notification('BlinkGotMessage',
-                                                          sender=blink_session,
-                                                          data=NotificationData(
-                                                              message=history_message,
-                                                              history=True,
-                                                              account=account))
-                    if encryption == 'OpenPGP':
-                        if blink_session.fake_streams.get('messages').can_decrypt:
-                            blink_session.fake_streams.get('messages').decrypt(history_message)
-                        else:
-                            self._incoming_encrypted_message_queue.append((history_message, account, contact))
-
-        if last_id is not None:
-            account.sms.history_synchronization_id = last_id
+        page = ServerHistoryPage(account, last_id)
+        notification_center.post_notification('BlinkGotHistoryMessages', sender=account, data=NotificationData(messages=history_messages, cursor=last_id))
+
+        if not page.wait(self.history_synchronization_store_timeout):
+            # the page is fetched again by the next synchronization, nothing that depends on it is done until it is stored
+            log.warning(f'Failed to store the history messages of {account.id} fetched from the server')
+            return False
+
+        for uri, count in unread_messages.items():
+            notification_center.post_notification('BlinkMessageNewUnread', sender=uri, data=NotificationData(account=account, count=count))
+
+        run_deferred_calls()
+
+        account.sms.history_synchronization_id = last_id
         account.sms.history_synchronization_timestamp = ISOTimestamp.now()
         account.save()
-
+        return True
 
     @run_in_gui_thread
     def handle_notification(self, notification):
@@ -1047,8 +1283,11 @@ class MessageManager(object, metaclass=Singleton):
         request.account.sms.private_key = f'{filename}.privkey'
         request.account.sms.public_key = f'{filename}.pubkey'
         request.account.save()
+        self._enable_pgp(request.account)
 
-        for session in [session for session in self.sessions if session.account is request.account]:
+    @run_in_gui_thread
+    def _enable_pgp(self, account):
+        for session in list(self.sessions.find(account=account)):
             stream = session.fake_streams.get('messages')
             if stream and not stream.can_encrypt:
                 stream.enable_pgp()
@@ -1056,7 +1295,7 @@ class MessageManager(object, metaclass=Singleton):
         while self._incoming_encrypted_message_queue:
             message, account, contact = self._incoming_encrypted_message_queue.popleft()
             try:
-                blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
+                blink_session = next(self.sessions.find(contact=contact))
             except StopIteration:
                 pass
             else:
@@ -1084,14 +1323,35 @@ class MessageManager(object, metaclass=Singleton):
 
     def _NH_CFGSettingsObjectDidChange(self, notification):
         if isinstance(notification.sender, Account) and 'sms.enable_history_synchronization' in notification.data.modified:
-            self._sync_messages(notification.sender)
+            self.history_synchronization.synchronize(notification.sender)
 
     def _NH_SIPAccountRegistrationDidSucceed(self, notification):
-        if notification.sender is not BonjourAccount():
-            self._sync_queue.append(notification.sender)
-            while self._sync_queue:
-                sender = self._sync_queue.popleft()
-                self._sync_messages(sender)
+        # Only the first registration synchronizes the history right away, the refreshes are left to the scheduler
+        if notification.sender is not BonjourAccount() and notification.sender not in self._registered_accounts:
+            self._registered_accounts.add(notification.sender)
+            self.history_synchronization.synchronize(notification.sender)
+
+    def _NH_SIPAccountRegistrationDidFail(self, notification):
+        self._registered_accounts.discard(notification.sender)
+
+    _NH_SIPAccountRegistrationDidEnd = _NH_SIPAccountRegistrationDidFail
+
+    def _NH_SIPAccountDidDeactivate(self, notification):
+        self._registered_accounts.discard(notification.sender)
+        self.history_synchronization.cancel(notification.sender)
+
+    def _NH_SIPAccountManagerDidRemoveAccount(self, notification):
+        self._registered_accounts.discard(notification.data.account)
+        self.history_synchronization.cancel(notification.data.account)
+
+    def _NH_SystemIPAddressDidChange(self, notification):
+        for account in self._registered_accounts:
+            self.history_synchronization.synchronize(account)
+
+    def _NH_BlinkMessageHistoryMessageWasNotFound(self, notification):
+        # a disposition notification for a message that is not in the history, which was sent from another device
+        log.info(f'Message {notification.data.id} is not in the history of {notification.sender.id}, it will be synchronized with the server')
+        self.history_synchronization.expedite(notification.sender)
 
     def _NH_SIPEngineGotMessage(self, notification):
         account_manager = AccountManager()
@@ -1180,7 +1440,7 @@ class MessageManager(object, metaclass=Singleton):
             account.sms.history_synchronization_url = url
             account.sms.history_synchronization_timestamp = None
             account.save()
-            self._sync_messages(account)
+            self.history_synchronization.synchronize(account)
             return
 
         if content_type.lower() == 'text/pgp-private-key':
@@ -1229,7 +1489,7 @@ class MessageManager(object, metaclass=Singleton):
             notification_center.post_notification('BlinkGotHistoryMessageDelete', data=payload['message_id'])
 
             try:
-                blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
+                blink_session = next(self.sessions.find(contact=contact))
             except StopIteration:
                 pass
             else:
@@ -1246,7 +1506,7 @@ class MessageManager(object, metaclass=Singleton):
             contact, contact_uri = URIUtils.find_contact(payload['contact'])
             timestamp = ISOTimestamp(payload['timestamp'])
             try:
-                blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
+                blink_session = next(self.sessions.find(contact=contact))
             except StopIteration:
                 notification_center.post_notification('BlinkGotHistoryConversationRemove', sender=account, data=NotificationData(contact=contact_uri.uri, timestamp=timestamp))
             else:
@@ -1268,7 +1528,7 @@ class MessageManager(object, metaclass=Singleton):
             message.direction = "outgoing"
 
         try:
-            blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings or (instance_id and instance_id == session.remote_instance_id))
+            blink_session = next(self.sessions.find(contact=contact, instance_id=instance_id or None))
         except StopIteration:
             blink_session = None
             if any(content_type.lower().startswith(prefix) for prefix in self.__ignored_content_types__):
@@ -1322,6 +1582,7 @@ class MessageManager(object, metaclass=Singleton):
             imdn_status = document.notification.status.__str__()
             imdn_datetime = document.datetime.__str__()
             notification_center.post_notification('BlinkGotDispositionNotification', sender=blink_session, data=NotificationData(id=imdn_message_id, status=imdn_status))
+            notification_center.post_notification('BlinkGotMessageReference', sender=account, data=NotificationData(id=imdn_message_id))
             return
         elif content_type.lower() == IMDNDocument.content_type:
             # print("-- IMDN received, ignored")
@@ -1427,11 +1688,6 @@ class MessageManager(object, metaclass=Singleton):
 
         self._handle_incoming_message(message, blink_session, account)
 
-    def _NH_BlinkServerHistoryWasFetched(self, notification):
-        account = notification.sender
-        messages = notification.data['messages']
-        self._process_server_history_messages(account, messages)
-
     def _NH_BlinkSessionWasCreated(self, notification):
         session = notification.sender
         self.sessions.append(session)
@@ -1548,7 +1804,7 @@ class MessageManager(object, metaclass=Singleton):
             instance_id = contact.settings.id if contact.type == 'bonjour' else None
 
             try:
-                blink_session = next(session for session in self.sessions if session.contact_uri.uri == contact_uri.uri or (instance_id and instance_id == session.remote_instance_id))
+                blink_session = next(self.sessions.find(uri=contact_uri.uri, instance_id=instance_id or None))
             except StopIteration:
                 log.info(f"Create message view from history for {contact_uri.uri} with instance_id {instance_id}")
                 created_views.add(contact_uri.uri)
@@ -1673,7 +1929,7 @@ class MessageManager(object, metaclass=Singleton):
         self._send_message(outgoing_message)
 
     def send_message(self, account, contact, content, content_type='text/plain', recipients=None, courtesy_recipients=None, subject=None, timestamp=None, required=None, additional_headers=None, id=None):
-        blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
+        blink_session = next(self.sessions.find(contact=contact))
         blink_session.last_failed_reason = None
         blink_session.updateTimestamp()
         outgoing_message = OutgoingMessage(account, contact, content, content_type, recipients, courtesy_recipients, subject, timestamp, required, additional_headers, id, blink_session)
@@ -2,9 +2,9 @@
 import base64
 import hashlib
 import re
+import requests
 import socket
 import uuid
-import urllib
 
 from PyQt5 import uic
 from PyQt5.QtCore import Qt, QTimer
@@ -15,7 +15,6 @@ from datetime import datetime
 from dateutil.tz import tzutc
 from itertools import chain
 from twisted.internet import reactor
-from twisted.internet.error import ConnectionLost
 from zope.interface import implementer
 
 from sipsimple import addressbook
@@ -30,6 +29,7 @@ from sipsimple.util import ISOTimestamp
 
 from blink.configuration.datatypes import IconDescriptor, FileURL, PresenceState
 from blink.configuration.settings import BlinkSettings
+from blink.httpclient import HTTPClient
 from blink.resources import IconManager, Resources
 from blink.util import run_in_gui_thread
 
@@ -304,15 +304,16 @@ class ContactIcon(object):
     @classmethod
     def fetch(cls, url, etag=None, descriptor_etag=None):
         headers = {'If-None-Match': etag} if etag else {}
-        req = urllib.request.Request(url, headers=headers)
         try:
-            response = urllib.request.urlopen(req)
-            content = response.read()
-            info = response.info()
-        except (ConnectionLost, urllib.error.URLError, urllib.error.HTTPError):
+            response = HTTPClient().get(url, headers=headers)
+            response.raise_for_status()
+        except requests.RequestException:
             return None
-        content_type = info.get('content-type')
-        etag = info.get('etag')
+        if response.status_code != 200:  # 304 Not Modified
+            return None
+        content = response.content
+        content_type = response.headers.get('content-type')
+        etag = response.headers.get('etag')
         if etag.startswith('W/'):
             etag = etag[2:]
         etag = etag.replace('\"', '')
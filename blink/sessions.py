@@ -16,7 +16,7 @@ from abc import ABCMeta, abstractproperty
 from collections import defaultdict, deque
 from datetime import datetime, timedelta, timezone
 from enum import Enum
-from itertools import chain
+from itertools import chain, count
 from operator import attrgetter
 from dateutil.tz import tzlocal
 
@@ -42,7 +42,6 @@ from sipsimple.audio import AudioConference, WavePlayer
 from sipsimple.configuration.datatypes import Path
 from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.core import SIPCoreError, SIPURI, ToHeader
-from sipsimple.lookup import DNSLookup
 from sipsimple.session import Session, IllegalStateError, IllegalDirectionError
 from sipsimple.streams import MediaStreamRegistry
 from sipsimple.streams.msrp.chat import OTRState, SMPStatus
@@ -52,8 +51,10 @@ from sipsimple.threading import run_in_thread, run_in_twisted_thread
 from sipsimple.util import ISOTimestamp
 
 from blink.logging import MessagingTrace as message_log
+from blink.lookup import RouteCache, RouteLookup
 from blink.configuration.datatypes import File
 from blink.configuration.settings import BlinkSettings
+from blink.httpclient import HTTPClient
 from blink.resources import ApplicationData, Resources
 from blink.screensharing import ScreensharingWindow, VNCClient, ServerDefault
 from blink.util import call_later, run_in_gui_thread, translate, copy_transfer_file
@@ -472,6 +473,28 @@ class SessionItemsDescriptor(object):
         raise AttributeError("Attribute cannot be deleted")
 
 
+class IndexedSessionAttribute(object):
+    """A BlinkSession attribute by which the sessions are indexed in a BlinkSessionList"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance.__dict__[self.name]
+
+    def __set__(self, instance, value):
+        old_value = instance.__dict__.get(self.name, None)
+        instance.__dict__[self.name] = value
+        if value is not old_value:
+            notification_center = NotificationCenter()
+            notification_center.post_notification('BlinkSessionDidChangeIndexedAttribute', sender=instance, data=NotificationData(name=self.name))
+
+    def __delete__(self, instance):
+        raise AttributeError("Attribute cannot be deleted")
+
+
 class BlinkSessionType(type):
     def __call__(cls, *args, **kw):
         instance = super(BlinkSessionType, cls).__call__(*args, **kw)
@@ -491,6 +514,10 @@ class BlinkSession(BlinkSessionBase):
     items = SessionItemsDescriptor()
     fake_streams = StreamListDescriptor()
 
+    account = IndexedSessionAttribute('account')
+    contact_uri = IndexedSessionAttribute('contact_uri')
+    remote_instance_id = IndexedSessionAttribute('remote_instance_id')
+
     def __init__(self):
         self._initialize()
 
@@ -566,6 +593,7 @@ class BlinkSession(BlinkSessionBase):
         new_contact = self.__dict__['contact'] = value
         if new_contact != old_contact:
             notification_center = NotificationCenter()
+            notification_center.post_notification('BlinkSessionDidChangeIndexedAttribute', sender=self, data=NotificationData(name='contact'))
             if old_contact is not None:
                 notification_center.remove_observer(self, sender=old_contact)
             if new_contact is not None:
@@ -806,7 +834,7 @@ class BlinkSession(BlinkSessionBase):
         else:
             uri = self.uri
 
-        self.lookup = DNSLookup()
+        self.lookup = RouteLookup(account)
         notification_center.add_observer(self, sender=self.lookup)
         self.lookup.lookup_sip_proxy(uri, settings.sip.transport_list, tls_name=self.account.sip.tls_name or uri.host)
 
@@ -1065,6 +1093,9 @@ class BlinkSession(BlinkSessionBase):
             notification.center.post_notification('BlinkSessionInfoUpdated', sender=self, data=NotificationData(elements={'session', 'media'}))
 
     def _NH_SIPSessionDidFail(self, notification):
+        if self.direction == 'outgoing' and notification.data.code in (408, 503):
+            # the route did not answer or could not be reached, the next request looks it up again
+            RouteCache().invalidate(self.account)
         if notification.data.failure_reason == 'user request':
             if notification.data.code == 487:
                 reason = 'Call cancelled'
@@ -3461,7 +3492,8 @@ class ChatSessionItem(object):
         notification.center.post_notification('ChatSessionItemDidChange', sender=self)
 
     def _NH_BlinkUnreadMessagesChanged(self, notification):
-        if self.widget:
+        contact_uri = self.blink_session.contact.uri
+        if self.widget and contact_uri is not None and contact_uri.uri in notification.data.remote_uris:
             self.widget.update_content(self)
             notification.center.post_notification('ChatSessionItemDidChange', sender=self)
 
@@ -4276,12 +4308,12 @@ class BlinkFileTransfer(BlinkSessionBase):
         else:
             uri = self._uri
 
-        lookup = DNSLookup()
+        self.state = 'connecting/dns_lookup'
+
+        lookup = RouteLookup(self.account)
         notification_center.add_observer(self, sender=lookup)
         lookup.lookup_sip_proxy(uri, settings.sip.transport_list, tls_name=self.account.sip.tls_name or uri.host)
 
-        self.state = 'connecting/dns_lookup'
-
     def end(self):
         assert self.state is not None
         if self.state in ('ending', 'ended'):
@@ -6690,6 +6722,101 @@ class RequestList(list):
             return [item for item in self if item.session is key]
 
 
+@implementer(IObserver)
+class BlinkSessionList(object):
+    """
+    A list of BlinkSessions that can be searched by contact, remote URI,
+    remote instance id and account without going through all the sessions.
+    The indexes are updated when a session is added or removed and when one of
+    these attributes of a session changes, and are only used from the GUI
+    thread.
+    """
+
+    def __init__(self):
+        self._sessions = []
+        self._positions = {}
+        self._keys = {}
+        self._indexes = dict(contact=defaultdict(list), uri=defaultdict(list), instance_id=defaultdict(list), account=defaultdict(list))
+        self._counter = count()
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='BlinkSessionDidChangeIndexedAttribute')
+        notification_center.add_observer(self, name='BlinkSessionContactDidChange')
+
+    def __iter__(self):
+        return iter(self._sessions)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session):
+        return session in self._positions
+
+    def append(self, session):
+        self._sessions.append(session)
+        self._positions[session] = next(self._counter)
+        self._add_keys(session)
+
+    def remove(self, session):
+        self._sessions.remove(session)
+        self._remove_keys(session)
+        del self._positions[session]
+
+    def find(self, contact=None, uri=None, instance_id=None, account=None):
+        """
+        Yield the sessions with the same contact, remote URI, remote instance
+        id or account as the given ones, in the order in which they were added.
+        """
+        keys = dict(contact=self._contact_key(contact) if contact is not None else None,
+                    uri=uri,
+                    instance_id=instance_id,
+                    account=account.id if account is not None else None)
+        matches = [self._indexes[name].get(key, []) for name, key in keys.items() if key is not None]
+        if len(matches) == 1:
+            yield from list(matches[0])
+        else:
+            yield from sorted(set(chain(*matches)), key=self._positions.__getitem__)
+
+    @staticmethod
+    def _contact_key(contact):
+        # the dummy contacts have no id and only match themselves
+        return getattr(contact.settings, 'id', contact.settings)
+
+    def _session_keys(self, session):
+        return dict(contact=self._contact_key(session.contact) if session.contact is not None else None,
+                    uri=session.contact_uri.uri if session.contact_uri is not None else None,
+                    instance_id=session.remote_instance_id or None,
+                    account=session.account.id if session.account is not None else None)
+
+    def _add_keys(self, session):
+        keys = self._keys[session] = self._session_keys(session)
+        for name, key in keys.items():
+            if key is not None:
+                sessions = self._indexes[name][key]
+                sessions.append(session)
+                sessions.sort(key=self._positions.__getitem__)
+
+    def _remove_keys(self, session):
+        for name, key in self._keys.pop(session).items():
+            if key is not None:
+                sessions = self._indexes[name][key]
+                sessions.remove(session)
+                if not sessions:
+                    del self._indexes[name][key]
+
+    @run_in_gui_thread
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_BlinkSessionDidChangeIndexedAttribute(self, notification):
+        session = notification.sender
+        if session in self._positions:
+            self._remove_keys(session)
+            self._add_keys(session)
+
+    _NH_BlinkSessionContactDidChange = _NH_BlinkSessionDidChangeIndexedAttribute
+
+
 @implementer(IObserver)
 class SessionManager(object, metaclass=Singleton):
 
@@ -6701,7 +6828,7 @@ class SessionManager(object, metaclass=Singleton):
     hold_tone         = RingtoneDescriptor()
 
     def __init__(self):
-        self.sessions = []
+        self.sessions = BlinkSessionList()
         self.file_transfers = []
         self.incoming_requests = RequestList()
         self.last_dialed_uri = None
@@ -6740,7 +6867,7 @@ class SessionManager(object, metaclass=Singleton):
                 account = AccountManager().default_account
 
         try:
-            session = next(session for session in self.sessions if session.reusable and session.contact.settings is contact.settings)
+            session = next(session for session in self.sessions.find(contact=contact) if session.reusable)
             reinitialize = True
         except StopIteration:
             session = BlinkSession()
@@ -6851,7 +6978,7 @@ class SessionManager(object, metaclass=Singleton):
         notification_center = NotificationCenter()
 
         try:
-            r = requests.get(file.url, timeout=10, stream=True, headers=resume_header)
+            r = HTTPClient().get(file.url, timeout=10, stream=True, headers=resume_header)
             r.raise_for_status()
         except (requests.ConnectionError, requests.Timeout) as e:
             message_log.warning(f'HTTP filetransfer connection error: {e}')
@@ -7009,7 +7136,7 @@ class SessionManager(object, metaclass=Singleton):
             blink_session.accept_proposal(accepted_streams)
         else:
             try:
-                blink_session = next(session for session in self.sessions if session.reusable and session.contact.settings is incoming_request.contact.settings)
+                blink_session = next(session for session in self.sessions.find(contact=incoming_request.contact) if session.reusable)
                 reinitialize = True
             except StopIteration:
                 blink_session = BlinkSession()
@@ -7086,7 +7213,7 @@ class SessionManager(object, metaclass=Singleton):
 
             if chat_stream and not (audio_stream or video_stream or screensharing_stream) and contact.type != 'dummy' and settings.chat.auto_accept:
                 try:
-                    blink_session = next(session for session in self.sessions if session.reusable and session.contact.settings is contact.settings)
+                    blink_session = next(session for session in self.sessions.find(contact=contact) if session.reusable)
                     reinitialize = True
                 except StopIteration:
                     blink_session = BlinkSession()
@@ -7113,7 +7240,7 @@ class SessionManager(object, metaclass=Singleton):
 
             contact, contact_uri = URIUtils.find_contact(sip_session.remote_identity.uri)
             try:
-                blink_session = next(session for session in self.sessions if session.reusable and session.contact.settings is contact.settings)
+                blink_session = next(session for session in self.sessions.find(contact=contact) if session.reusable)
                 reinitialize = True
             except StopIteration:
                 blink_session = BlinkSession()
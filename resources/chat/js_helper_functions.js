@@ -8,9 +8,13 @@ function getElement(query) {
 
 function fix_index() {
     insert = getElement('#insert')
-    if (insert) {
+    if (insert || detachedElements['insert'] !== undefined) {
         return
     }
+    let chat_element = getElementById('chat');
+    if (chat_element.lastElementChild && chat_element.lastElementChild.classList.contains('detached')) {
+        attachDetached(chat_element.lastElementChild.id);
+    }
     console.log('Adding insert')
     let messages = document.querySelectorAll('[id^=message-]')
     let last_message = [...messages].pop()
@@ -94,6 +98,11 @@ function emptyElement(query) {
         while (elem.firstChild) {
             elem.firstChild.remove();
         }
+        if (elem.id === 'chat') {
+            detachedElements = {};
+            detachedPlaceholders = {};
+            chat._JH_ClearDetached();
+        }
     }
 }
 
@@ -144,6 +153,13 @@ function prependOutside(id, content) {
     }
 }
 
+function insertHtml(id, position, content) {
+    let elem = getElementById(id);
+    if (elem) {
+        elem.insertAdjacentHTML(position, content);
+    }
+}
+
 function updateElement(query, content) {
     let elem = getElement(query);
     if (elem) {
@@ -186,6 +202,169 @@ function scrollToBottom() {
     setTimeout(window.scrollTo(0, document.body.scrollHeight), 5);
 }
 
+function applyOperations(operations) {
+    // Each operation is [function name, arguments...], they are applied in order and an operation that fails does not stop the others
+    let results = [];
+    for (let operation of operations) {
+        try {
+            attachTarget(operation);
+            results.push(window[operation[0]].apply(null, operation.slice(1)));
+        } catch (error) {
+            console.error(operation[0] + ': ' + error);
+            results.push(null);
+        }
+    }
+    scheduleVirtualize();
+    return results;
+}
+
+// The top level elements of #chat that are far from the viewport are replaced with placeholders of the same height, up to detachMaximum
+// elements for each. Their HTML is kept by the chat object until they come close to the viewport again or an operation needs one of their
+// elements, so that the number of nodes in the page does not grow with the length of the conversation.
+
+const detachMargin = 3;  // in viewport heights
+const attachMargin = 2;
+const detachMinimum = 20;  // elements
+const detachMaximum = 50;  // elements in one placeholder, so that coming back to them attaches only a part of a long range
+
+let detachedElements = {};  // element id -> placeholder id
+let detachedPlaceholders = {};  // placeholder id -> element ids
+let detachedCount = 0;
+let virtualizeTimer = null;
+
+function scheduleVirtualize() {
+    if (virtualizeTimer === null) {
+        virtualizeTimer = setTimeout(virtualize, 100);
+    }
+}
+
+function rangeHeight(first, last) {
+    let next = last.nextElementSibling;
+    return (next ? next.offsetTop : last.offsetTop + last.offsetHeight) - first.offsetTop;
+}
+
+function detachRange(elements) {
+    let first = elements[0];
+    let last = elements[elements.length - 1];
+    let height = rangeHeight(first, last);
+    let html = '';
+    let ids = [];
+    for (let elem of elements) {
+        html += elem.outerHTML;
+        if (elem.id) {
+            ids.push(elem.id);
+        }
+        for (let child of elem.querySelectorAll('[id]')) {
+            ids.push(child.id);
+        }
+    }
+
+    let id = 'detached-' + (++detachedCount);
+    let placeholder = document.createElement('div');
+    placeholder.setAttribute('id', id);
+    placeholder.setAttribute('class', 'detached');
+    placeholder.style.height = height + 'px';
+    chat._JH_StoreDetached(id, html);
+
+    first.before(placeholder);
+    for (let elem of elements) {
+        elem.remove();
+    }
+    for (let element_id of ids) {
+        detachedElements[element_id] = id;
+    }
+    detachedPlaceholders[id] = ids;
+}
+
+function detachRanges(elements) {
+    if (elements.length >= detachMinimum) {
+        for (let index = 0; index < elements.length; index += detachMaximum) {
+            detachRange(elements.slice(index, index + detachMaximum));
+        }
+    }
+}
+
+function attachDetached(id) {
+    let placeholder = getElementById(id);
+    let ids = detachedPlaceholders[id] || [];
+    for (let element_id of ids) {
+        delete detachedElements[element_id];
+    }
+    delete detachedPlaceholders[id];
+    let content = parseHtml(chat._JH_RestoreDetached(id));
+    if (!placeholder) {
+        return;
+    }
+    let elements = Array.from(content.childNodes).filter(node => node.nodeType === Node.ELEMENT_NODE);
+    let above = placeholder.offsetTop + placeholder.offsetHeight <= window.pageYOffset;
+    let height = placeholder.offsetHeight;
+    placeholder.replaceWith(content);
+    for (let elem of elements) {
+        let messages = Array.from(elem.querySelectorAll('[id^=message-]'));
+        if (elem.id.startsWith('message-')) {
+            messages.push(elem);
+        }
+        for (let message of messages) {
+            message.addEventListener('contextmenu', handleContextMenu);
+        }
+    }
+    if (above && elements.length !== 0) {
+        // keep the messages in the viewport where they were
+        window.scrollBy(0, rangeHeight(elements[0], elements[elements.length - 1]) - height);
+    }
+}
+
+function attachTarget(operation) {
+    // Attaches the elements an operation works on, if they were detached
+    let target = operation[0] === 'appendMessageToChat' ? '#insert' : operation[1];
+    if (typeof target !== 'string') {
+        return;
+    }
+    let id = detachedElements[target.split('#').pop()];
+    if (id !== undefined) {
+        attachDetached(id);
+    }
+    if (operation[0] === 'previousSibling') {
+        let elem = getElementById(target);
+        if (elem && elem.previousElementSibling && elem.previousElementSibling.classList.contains('detached')) {
+            attachDetached(elem.previousElementSibling.id);
+        }
+    }
+}
+
+function virtualize() {
+    virtualizeTimer = null;
+    let chat_element = getElementById('chat');
+    if (!chat_element || typeof chat === 'undefined') {
+        return;
+    }
+    let top = window.pageYOffset;
+    let bottom = top + window.innerHeight;
+
+    for (let elem of Array.from(chat_element.children)) {
+        if (elem.classList.contains('detached') && elem.offsetTop + elem.offsetHeight >= top - attachMargin * window.innerHeight && elem.offsetTop <= bottom + attachMargin * window.innerHeight) {
+            attachDetached(elem.id);
+        }
+    }
+
+    top = window.pageYOffset;
+    bottom = top + window.innerHeight;
+    let range = [];
+    for (let elem of Array.from(chat_element.children)) {
+        let outside = elem.offsetTop + elem.offsetHeight < top - detachMargin * window.innerHeight || elem.offsetTop > bottom + detachMargin * window.innerHeight;
+        if (outside && !elem.classList.contains('detached')) {
+            range.push(elem);
+            continue;
+        }
+        detachRanges(range);
+        range = [];
+    }
+    detachRanges(range);
+}
+
+window.addEventListener('scroll', scheduleVirtualize);
+window.addEventListener('resize', scheduleVirtualize);
+
 function print(content) {
     console.error(content);
 }
@@ -0,0 +1,126 @@
+"""Runs the history synchronization client against the history-sync-server script"""
+
+import importlib.machinery
+import importlib.util
+import os
+import threading
+
+import pytest
+
+pytest.importorskip('PyQt5')
+pytest.importorskip('sipsimple')
+
+import requests
+
+from types import SimpleNamespace
+
+from blink import messages
+from blink.messages import MessageManager
+
+
+def load_script(name):
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), name)
+    loader = importlib.machinery.SourceFileLoader(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    return module
+
+
+history_sync_server = load_script('history-sync-server')
+
+
+class Account(object):
+    def __init__(self, url, token):
+        self.id = 'alice@example.com'
+        self.sms = SimpleNamespace(enable_history_synchronization=True, history_synchronization_url=url, history_synchronization_token=token,
+                                   history_synchronization_id=None, history_synchronization_timestamp=None)
+
+    def save(self):
+        pass
+
+
+class SynchronizationClient(object):
+    def __init__(self, page_size):
+        self.manager = object.__new__(MessageManager)
+        self.manager.history_synchronization_page_size = page_size
+        self.manager._process_server_history_messages = self._process_server_history_messages
+        self.pages = []
+
+    def _process_server_history_messages(self, account, page):
+        # what the real method does once the page was stored
+        self.pages.append([message['message_id'] for message in page])
+        account.sms.history_synchronization_id = page[-1]['message_id']
+        return True
+
+    def synchronize(self, account):
+        return self.manager._sync_messages(account)
+
+    @property
+    def message_ids(self):
+        return [id for page in self.pages for id in page]
+
+
+@pytest.fixture
+def server_factory(monkeypatch):
+    # the shared client needs the configuration of a running application, the requests are the same
+    monkeypatch.setattr(messages, 'HTTPClient', lambda: requests)
+    servers = []
+
+    def create_server(**options):
+        server = history_sync_server.create_server('alice@example.com', **options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, Account(f'http://127.0.0.1:{server.server_port}/history/alice@example.com', server.token)
+
+    yield create_server
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def server_ids(server):
+    return [message['message_id'] for message in server.messages]
+
+
+def test_paged_history(server_factory):
+    server, account = server_factory(messages=1234)
+    client = SynchronizationClient(page_size=500)
+    assert client.synchronize(account) == 1234
+    assert client.message_ids == server_ids(server)
+    assert [len(page) for page in client.pages] == [500, 500, 234]
+    assert account.sms.history_synchronization_id == server.messages[-1]['message_id']
+    assert account.sms.history_synchronization_timestamp is not None
+
+
+def test_pages_smaller_than_the_limit(server_factory):
+    server, account = server_factory(messages=1234, page_size=300)
+    client = SynchronizationClient(page_size=500)
+    assert client.synchronize(account) == 1234
+    assert client.message_ids == server_ids(server)
+
+
+def test_server_that_ignores_the_limit(server_factory):
+    server, account = server_factory(messages=1234, ignore_limit=True)
+    client = SynchronizationClient(page_size=500)
+    assert client.synchronize(account) == 1234
+    assert client.message_ids == server_ids(server)
+    assert [len(page) for page in client.pages] == [500, 500, 234]
+
+
+def test_interrupted_synchronization_resumes(server_factory):
+    server, account = server_factory(messages=1234, ignore_limit=True, fail_after=700)
+    client = SynchronizationClient(page_size=500)
+    assert client.synchronize(account) is None
+    assert client.message_ids == server_ids(server)[:500]
+    assert account.sms.history_synchronization_id == server.messages[499]['message_id']
+    assert client.synchronize(account) == 734
+    assert client.message_ids == server_ids(server)
+
+
+def test_up_to_date_history(server_factory):
+    server, account = server_factory(messages=10)
+    client = SynchronizationClient(page_size=500)
+    assert client.synchronize(account) == 10
+    assert client.synchronize(account) == 0
+    assert client.message_ids == server_ids(server)
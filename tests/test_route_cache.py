@@ -0,0 +1,140 @@
+"""Counts the DNS lookups done by the RouteCache for the routes of the outgoing messages"""
+
+import threading
+
+import pytest
+
+pytest.importorskip('sipsimple.lookup')
+
+from application.notification import IObserver, NotificationCenter, NotificationData
+from time import time
+from twisted.internet import reactor
+from types import SimpleNamespace
+from zope.interface import implementer
+
+from blink.lookup import RouteCache, RouteLookup
+
+
+class StubAnswer(object):
+    def __init__(self, ttl):
+        self.expiration = time() + ttl
+
+
+class StubDNSLookup(object):
+    """Answers the lookups of the RouteCache from the reactor thread, the way DNSLookup does"""
+
+    ttl = 60
+    lookups = 0
+
+    def lookup_sip_proxy(self, uri, supported_transports, tls_name=None):
+        StubDNSLookup.lookups += 1
+        reactor.callFromThread(self._answer, uri, supported_transports)
+
+    def _answer(self, uri, supported_transports):
+        notification_center = NotificationCenter()
+        notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=uri, answer=StubAnswer(self.ttl), error=None))
+        notification_center.post_notification('DNSLookupDidSucceed', sender=self, data=NotificationData(result=[f'{uri};transport={supported_transports[0]}']))
+
+
+@implementer(IObserver)
+class Message(object):
+    """Looks up its route the way OutgoingMessage does"""
+
+    def __init__(self, account, uri):
+        self.account = account
+        self.uri = uri
+        self.routes = None
+        self.routed = threading.Event()
+
+    def send(self, observe_after_lookup=False):
+        lookup = RouteLookup(self.account)
+        notification_center = NotificationCenter()
+        if not observe_after_lookup:
+            notification_center.add_observer(self, sender=lookup)
+        lookup.lookup_sip_proxy(self.uri, ['tls', 'tcp', 'udp'], tls_name=self.uri)
+        if observe_after_lookup:
+            notification_center.add_observer(self, sender=lookup)
+
+    def handle_notification(self, notification):
+        if notification.name in ('DNSLookupDidSucceed', 'DNSLookupDidFail'):
+            notification.center.remove_observer(self, sender=notification.sender)
+            self.routes = notification.data.result if notification.name == 'DNSLookupDidSucceed' else None
+            self.routed.set()
+
+
+@pytest.fixture(scope='module', autouse=True)
+def running_reactor():
+    if not reactor.running:
+        threading.Thread(target=reactor.run, kwargs=dict(installSignalHandlers=False), name='Twisted Reactor', daemon=True).start()
+    yield
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(RouteCache, 'lookup_class', StubDNSLookup)
+    cache = RouteCache()
+    cache.invalidate()
+    yield cache
+    cache.invalidate()
+
+
+account = SimpleNamespace(id='alice@example.com')
+targets = ['sip:contact%d@domain%d.example.com' % (index, index) for index in range(10)]
+
+
+def send_messages(count, sequential=False, observe_after_lookup=False):
+    messages = [Message(account, targets[index % len(targets)]) for index in range(count)]
+    lookups = StubDNSLookup.lookups
+    for message in messages:
+        message.send(observe_after_lookup)
+        if sequential:
+            assert message.routed.wait(5)
+    for message in messages:
+        assert message.routed.wait(5)
+        assert message.routes == [f'{message.uri};transport=tls']
+    return StubDNSLookup.lookups - lookups
+
+
+def test_burst_of_messages(cache):
+    assert send_messages(1000) == len(targets)
+
+
+def test_sequential_messages(cache):
+    assert send_messages(1000, sequential=True) == len(targets)
+    assert send_messages(1000, sequential=True) == 0
+
+
+def test_invalidated_routes(cache):
+    assert send_messages(1000) == len(targets)
+    NotificationCenter().post_notification('SystemIPAddressDidChange', sender=None, data=NotificationData(old_ip_address='10.0.0.1', new_ip_address='10.0.0.2'))
+    assert send_messages(1000) == len(targets)
+    cache.invalidate(account)
+    assert send_messages(1000) == len(targets)
+    cache.invalidate(SimpleNamespace(id='bob@example.com'))
+    assert send_messages(1000) == 0
+
+
+def test_observers_added_after_the_lookup(cache):
+    # the cached routes are posted from the reactor thread, like the ones that are looked up, so they are not posted
+    # before lookup_sip_proxy returns even when the reactor is held until all the messages were sent
+    assert send_messages(1000) == len(targets)
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold_reactor():
+        held.set()
+        release.wait(5)
+
+    reactor.callFromThread(hold_reactor)
+    assert held.wait(5)
+    messages = [Message(account, targets[index % len(targets)]) for index in range(1000)]
+    try:
+        for message in messages:
+            message.send(observe_after_lookup=True)
+        assert not any(message.routed.is_set() for message in messages)
+    finally:
+        release.set()
+    for message in messages:
+        assert message.routed.wait(5)
+        assert message.routes == [f'{message.uri};transport=tls']
+    assert cache.hits >= 1000